@@ -0,0 +1,328 @@
+import asyncio
+import contextvars
+import json
+import logging
+import time
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:  # асинхронный режим необязателен
+    aiohttp = web = None
+
+from requests.exceptions import ConnectionError as RequestsConnectionError, HTTPError, Timeout
+
+from app import metrics
+from app.poster_cache import PosterTooLarge
+from app.scheduler import TokenBucket, telegram_retry_after
+from app.upstream import CircuitOpen
+
+logger = logging.getLogger("jellysay")
+
+RETRY_STATUSES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+# ошибки aiohttp, которые не приводятся к исключениям requests (например, при потоковой передаче)
+CLIENT_ERRORS = (asyncio.TimeoutError,) + ((aiohttp.ClientError,) if aiohttp else ())
+
+
+def require_aiohttp():
+    if aiohttp is None:
+        raise RuntimeError("Async server mode requires aiohttp: pip install aiohttp")
+
+
+class HttpResult:
+    """
+    Прочитанный ответ aiohttp с тем же интерфейсом, что у requests.Response
+    (status_code, ok, headers, text, json(), raise_for_status()), чтобы общий код
+    (разбор retry_after, file_id и т.п.) работал в обоих режимах.
+    """
+
+    __slots__ = ("status_code", "headers", "content", "url")
+
+    def __init__(self, status_code, headers, content, url=""):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+def client_timeout(timeout):
+    """Таймаут в формате requests (число или пара (connect, read)) -> aiohttp.ClientTimeout."""
+    if isinstance(timeout, (tuple, list)):
+        connect, read = timeout
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+    return aiohttp.ClientTimeout(total=timeout)
+
+
+async def request(http, method, url, retries=3, backoff_factor=0.3, timeout=10, **kwargs):
+    """
+    Запрос через общий aiohttp.ClientSession с ретраями на 5xx и ошибки соединения
+    (как urllib3 Retry у синхронной session: повторяются только идемпотентные методы).
+    Ошибки aiohttp приводятся к исключениям requests, чтобы обработка ошибок была
+    общей для обоих режимов.
+    """
+    if method.upper() not in IDEMPOTENT_METHODS:
+        retries = 0
+    upstream = metrics.upstream_of(url)
+    attempt = 0
+    while True:
+        try:
+            async with http.request(method, url, timeout=client_timeout(timeout), **kwargs) as resp:
+                content = await resp.read()
+                result = HttpResult(resp.status, resp.headers, content, str(resp.url))
+        except asyncio.TimeoutError as e:
+            error = Timeout(str(e) or "timeout")
+        except aiohttp.ClientError as e:
+            error = RequestsConnectionError(str(e))
+        else:
+            metrics.UPSTREAM_RESPONSES.inc(upstream, str(result.status_code))
+            if result.status_code not in RETRY_STATUSES or attempt >= retries:
+                return result
+            error = None
+        if error is not None:
+            metrics.UPSTREAM_ERRORS.inc(upstream)
+        if attempt >= retries:
+            raise error
+        metrics.UPSTREAM_RETRIES.inc(upstream, "error" if error is not None else "status")
+        await asyncio.sleep(backoff_factor * (2 ** attempt))
+        attempt += 1
+
+
+async def fetch_poster(cache, key, url, client):
+    """
+    Асинхронный аналог PosterCache.fetch: тот же кеш, загрузка через AsyncUpstreamClient.
+    Работа с диском (мета, временный файл, переименование, вытеснение) — в пуле потоков
+    по умолчанию, чтобы не останавливать цикл событий.
+    """
+    path, meta = await asyncio.to_thread(cache.lookup, key)
+    if path and cache.is_fresh(meta):
+        return await asyncio.to_thread(cache.hit, path)
+    try:
+        try:
+            async with client.stream("GET", url, headers=cache.conditional_headers(meta)) as resp:
+                if resp.status == 304 and meta:
+                    return await asyncio.to_thread(cache.revalidated, key, meta, path)
+                if resp.status >= 400:
+                    raise HTTPError(f"{resp.status} Error for url: {url}")
+                writer = await asyncio.to_thread(cache.writer, resp.headers.get("Content-Length"))
+                try:
+                    async for chunk in resp.content.iter_chunked(cache.chunk_size):
+                        await asyncio.to_thread(writer.write, chunk)
+                except Exception:
+                    await asyncio.to_thread(writer.abort)
+                    raise
+                return await asyncio.to_thread(writer.commit, key, resp.headers)
+        except asyncio.TimeoutError as e:
+            raise Timeout(str(e) or "timeout")
+        except aiohttp.ClientError as e:
+            raise RequestsConnectionError(str(e))
+    except Exception:
+        if not path:
+            raise
+        # stale пробрасывает текущее исключение, поэтому вызывается только при наличии копии
+        return await asyncio.to_thread(cache.stale, key, path)
+
+
+async def iter_limited(resp, max_image_bytes=None, chunk_size=64 * 1024):
+    """Асинхронный аналог poster_cache.iter_limited для ответа aiohttp."""
+    if max_image_bytes:
+        declared = resp.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > max_image_bytes:
+            raise PosterTooLarge(f"poster is {declared} bytes, limit is {max_image_bytes}")
+    size = 0
+    async for chunk in resp.content.iter_chunked(chunk_size):
+        size += len(chunk)
+        if max_image_bytes and size > max_image_bytes:
+            raise PosterTooLarge(f"poster exceeds {max_image_bytes} bytes")
+        yield chunk
+
+
+class AsyncUpstreamClient:
+    """
+    Асинхронный аналог upstream.UpstreamClient: свой aiohttp.ClientSession (пул соединений),
+    таймауты (connect, read), число повторов и CircuitBreaker — общий с синхронным клиентом
+    того же сервиса. Ошибки приводятся к исключениям requests, открытый breaker — CircuitOpen.
+    """
+
+    def __init__(self, name, pool_size, timeout, retries, breaker):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = breaker
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+
+    def _allow(self):
+        if not self.breaker.allow():
+            metrics.CIRCUIT_REJECTED.inc(self.name)
+            raise CircuitOpen(f"{self.name} is unavailable (circuit open)")
+
+    def _record(self, status):
+        if status >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    async def request(self, method, url, **kwargs):
+        self._allow()
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("retries", self.retries)
+        try:
+            result = await request(self.http, method, url, **kwargs)
+        except asyncio.CancelledError:
+            self.breaker.record_cancelled()
+            raise
+        except Exception:
+            # любое исключение — как в UpstreamClient.request: пробный запрос HALF_OPEN должен завершиться
+            self.breaker.record_failure()
+            raise
+        self._record(result.status_code)
+        return result
+
+    def stream(self, method, url, **kwargs):
+        """Потоковый запрос без ретраев: async with client.stream("GET", url) as resp (ответ aiohttp)."""
+        return _StreamRequest(self, method, url, kwargs)
+
+    async def close(self):
+        await self.http.close()
+
+
+class _StreamRequest:
+    def __init__(self, client, method, url, kwargs):
+        self.client = client
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self._context = None
+
+    async def __aenter__(self):
+        client = self.client
+        client._allow()
+        upstream = metrics.upstream_of(self.url)
+        timeout = client_timeout(self.kwargs.pop("timeout", client.timeout))
+        self._context = client.http.request(self.method, self.url, timeout=timeout, **self.kwargs)
+        try:
+            resp = await self._context.__aenter__()
+        except asyncio.TimeoutError as e:
+            metrics.UPSTREAM_ERRORS.inc(upstream)
+            client.breaker.record_failure()
+            raise Timeout(str(e) or "timeout")
+        except aiohttp.ClientError as e:
+            metrics.UPSTREAM_ERRORS.inc(upstream)
+            client.breaker.record_failure()
+            raise RequestsConnectionError(str(e))
+        except asyncio.CancelledError:
+            client.breaker.record_cancelled()
+            raise
+        except Exception:
+            client.breaker.record_failure()
+            raise
+        metrics.UPSTREAM_RESPONSES.inc(upstream, str(resp.status))
+        client._record(resp.status)
+        return resp
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self._context.__aexit__(exc_type, exc, tb)
+
+
+class _ChatLimits:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.paused_until = 0.0
+
+
+class _AsyncChatLane:
+    def __init__(self, limits):
+        # limits — bucket и paused_until чата, при общем лимите — те же, что у TelegramScheduler
+        self.limits = limits
+        self.queue = asyncio.Queue()
+
+
+class AsyncTelegramScheduler:
+    """
+    Асинхронный аналог TelegramScheduler: те же token bucket'ы и пауза чата по retry_after,
+    у каждого чата своя FIFO-очередь и своя задача-отправитель.
+    send — корутинная функция без аргументов, возвращающая HttpResult.
+    limits — синхронный TelegramScheduler, с которым делятся глобальный лимит, лимиты
+    и паузы чатов: отправки из фоновых потоков (outbox, сверка) и из цикла событий
+    расходуют один и тот же лимит.
+    """
+
+    def __init__(self, global_rate=30, chat_rate_per_minute=20, chat_burst=1, max_retries=5, limits=None):
+        self.limits = limits
+        self.global_bucket = limits.global_bucket if limits is not None else TokenBucket(global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate_per_minute / 60.0
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._lanes = {}
+
+    async def send(self, chat_id, send):
+        chat_id = str(chat_id)
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            if self.limits is not None:
+                lane = _AsyncChatLane(self.limits.chat_limits(chat_id))
+            else:
+                lane = _AsyncChatLane(_ChatLimits(TokenBucket(self.chat_rate, capacity=self.chat_burst)))
+            self._lanes[chat_id] = lane
+            asyncio.get_running_loop().create_task(self._run(chat_id, lane))
+        future = asyncio.get_running_loop().create_future()
+        await lane.queue.put((send, future, contextvars.copy_context()))
+        return await future
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            chat_id: {"queued": lane.queue.qsize(), "paused_for": round(max(0.0, lane.limits.paused_until - now), 1)}
+            for chat_id, lane in self._lanes.items()
+        }
+
+    async def _run(self, chat_id, lane):
+        while True:
+            send, future, context = await lane.queue.get()
+            if future.cancelled():
+                continue
+            # задача чата живёт дольше запроса: переносим в неё контекст отправителя (correlation_id)
+            for var, value in context.items():
+                var.set(value)
+            # отправитель мог отменить ожидание, пока шла отправка: future уже завершён,
+            # и set_result/set_exception подняли бы InvalidStateError и остановили бы очередь чата
+            try:
+                result = await self._deliver(chat_id, lane.limits, send)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    async def _deliver(self, chat_id, lane, send):
+        attempt = 0
+        while True:
+            pause = lane.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await asyncio.sleep(lane.bucket.reserve())
+            await asyncio.sleep(self.global_bucket.reserve())
+            resp = await send()
+            if getattr(resp, "status_code", None) != 429 or attempt >= self.max_retries:
+                return resp
+            attempt += 1
+            metrics.UPSTREAM_RETRIES.inc("telegram", "flood")
+            retry_after = telegram_retry_after(resp)
+            lane.paused_until = time.monotonic() + retry_after
+            logger.warning("Telegram flood limit for chat %s, pausing %.0fs (attempt %d)", chat_id, retry_after, attempt)
@@ -0,0 +1,77 @@
+import logging
+import threading
+
+logger = logging.getLogger("jellysay")
+
+
+class Coalescer:
+    """
+    Собирает элементы с одинаковым ключом в течение окна (в секундах)
+    и передаёт их одной пачкой в flush(key, items).
+    Окно отсчитывается от первого элемента пачки.
+
+    Пачки живут только в памяти процесса: если процесс упадёт внутри окна, элементы не
+    будут отправлены, а их заявки дедупликации (inflight) останутся до перехвата зависших
+    заявок (DEDUP_CLAIM_TIMEOUT) — до тех пор повторный вебхук о них считается дублем.
+    """
+
+    def __init__(self, window, flush):
+        self.window = float(window)
+        self.flush = flush
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def add(self, key, item, dedup_key=None):
+        """Добавляет элемент. Возвращает False, если такой dedup_key уже ждёт отправки."""
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                timer = threading.Timer(self.window, self._fire, args=(key,))
+                timer.daemon = True
+                batch = {"items": [], "keys": set(), "timer": timer}
+                self._pending[key] = batch
+                timer.start()
+            if dedup_key is not None:
+                if dedup_key in batch["keys"]:
+                    return False
+                batch["keys"].add(dedup_key)
+            batch["items"].append(item)
+            return True
+
+    def _fire(self, key):
+        with self._lock:
+            batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        try:
+            self.flush(key, batch["items"])
+        except Exception as e:
+            logger.exception("Coalesced flush failed for %s: %s", key, e)
+
+    def flush_all(self):
+        """Немедленно отправляет всё накопленное (например, при остановке)."""
+        with self._lock:
+            keys = list(self._pending)
+            for key in keys:
+                self._pending[key]["timer"].cancel()
+        for key in keys:
+            self._fire(key)
+
+
+def format_number_range(numbers):
+    """["1", "2", "3", "5"] -> "1–3, 5". Нечисловые значения выводятся как есть."""
+    ints = sorted({int(n) for n in numbers if str(n).isdigit()})
+    other = [str(n) for n in numbers if not str(n).isdigit()]
+    parts = []
+    start = prev = None
+    for n in ints:
+        if start is None:
+            start = prev = n
+        elif n == prev + 1:
+            prev = n
+        else:
+            parts.append(str(start) if start == prev else f"{start}–{prev}")
+            start = prev = n
+    if start is not None:
+        parts.append(str(start) if start == prev else f"{start}–{prev}")
+    return ", ".join(parts + sorted(set(other)))
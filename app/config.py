@@ -7,6 +7,7 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 JELLYFIN_BASE_URL = os.getenv("JELLYFIN_BASE_URL")  # Базовый URL сервера Jellyfin
 JELLYFIN_API_KEY = os.getenv("JELLYFIN_API_KEY")    # API-ключ для Jellyfin
 NOTIFICATION_PAUSE = int(os.getenv("NOTIFICATION_PAUSE", 5))  # Пауза между отправками (в секундах)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")  # Адрес Bot API (для тестовых заглушек)
 
 print(f"JELLYFIN_BASE_URL: {JELLYFIN_BASE_URL}")
 print(f"JELLYFIN_API_KEY: {JELLYFIN_API_KEY}")
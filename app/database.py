@@ -1,14 +1,52 @@
-﻿import sqlite3
+﻿import json
 import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
 
 DB_PATH = "app/data/webhooks.db"
 
-def init_db():
-    """Инициализация базы данных."""
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+_local = threading.local()
+
+# Состояния строки webhooks (колонка sent)
+PENDING = 0
+SENT = 1
+DEAD = 2
+
+def get_connection(path=DB_PATH):
+    """Долгоживущее соединение с базой: одно на поток и процесс, в режиме WAL."""
+    path = str(path)
+    if getattr(_local, "pid", None) != os.getpid():
+        # соединения sqlite нельзя переносить через fork
+        _local.pid = os.getpid()
+        _local.connections = {}
+    conn = _local.connections.get(path)
+    if conn is None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.connections[path] = conn
+    return conn
+
+# Колонки outbox, добавленные к исходной таблице webhooks (для баз, созданных старой версией)
+_OUTBOX_COLUMNS = {
+    "caption": "TEXT",
+    "image_tag": "TEXT",
+    "dedup_keys": "TEXT",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "next_attempt_at": "REAL NOT NULL DEFAULT 0",
+    "last_error": "TEXT",
+    "created_at": "REAL",
+    "claim": "TEXT",
+    # получатель (app.routing.Destination в виде «чат[:тема]»); NULL — TELEGRAM_CHAT_ID
+    "destination": "TEXT",
+}
+
+def ensure_schema(conn):
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS webhooks (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             item_id TEXT NOT NULL,
@@ -23,37 +61,145 @@ def init_db():
             sent INTEGER DEFAULT 0
         )
     """)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(webhooks)")}
+    for name, definition in _OUTBOX_COLUMNS.items():
+        if name not in columns:
+            conn.execute(f"ALTER TABLE webhooks ADD COLUMN {name} {definition}")
+    conn.execute("CREATE INDEX IF NOT EXISTS webhooks_sent_due ON webhooks (sent, next_attempt_at)")
+    # claim() выбирает забранную пачку по токену — без индекса это полный просмотр таблицы
+    conn.execute("CREATE INDEX IF NOT EXISTS webhooks_claim ON webhooks (claim)")
     conn.commit()
-    conn.close()
+
+def init_db():
+    """Инициализация базы данных."""
+    ensure_schema(get_connection(DB_PATH))
 
 def insert_webhook(data):
     """Добавление вебхука в базу."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO webhooks (item_id, item_type, name, year, overview, series_name, season_number, episode_number, poster_path, sent)
-        VALUES (:item_id, :item_type, :name, :year, :overview, :series_name, :season_number, :episode_number, :poster_path, :sent)
-    """, data)
-    conn.commit()
-    conn.close()
+    conn = get_connection(DB_PATH)
+    with conn:
+        conn.execute("""
+            INSERT INTO webhooks (item_id, item_type, name, year, overview, series_name, season_number, episode_number, poster_path, sent)
+            VALUES (:item_id, :item_type, :name, :year, :overview, :series_name, :season_number, :episode_number, :poster_path, :sent)
+        """, data)
 
 def get_unsent_webhooks(limit=10):
     """Получение неотправленных вебхуков."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+    return get_connection(DB_PATH).execute("""
         SELECT * FROM webhooks WHERE sent = 0 LIMIT ?
-    """, (limit,))
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    """, (limit,)).fetchall()
 
 def mark_webhook_as_sent(webhook_id):
     """Пометка вебхука как отправленного."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE webhooks SET sent = 1 WHERE id = ?
-    """, (webhook_id,))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    conn = get_connection(DB_PATH)
+    with conn:
+        conn.execute("""
+            UPDATE webhooks SET sent = 1 WHERE id = ?
+        """, (webhook_id,))
+
+
+class Outbox:
+    """
+    Очередь недоставленных уведомлений на таблице webhooks (переживает перезапуск).
+    Строка — готовое сообщение одному получателю: caption, фото (item_id + image_tag), чат и ключи дедупликации.
+    Повторы с экспоненциальной задержкой retry_delay * 2^(attempts-1) (не больше max_delay),
+    после max_attempts попыток строка переходит в состояние DEAD (sent = 2).
+
+    claim() забирает пачку готовых к отправке строк атомарно (одной UPDATE-инструкцией),
+    поэтому разбирать очередь могут несколько процессов; забранные строки сдвигаются на
+    lease секунд вперёд — если процесс упадёт, не дождавшись результата, они вернутся в очередь.
+    Результаты пачки фиксируются одной транзакцией (complete / retry); доставленные строки
+    удаляются, в таблице остаются только ожидающие и DEAD.
+    """
+
+    def __init__(self, path, max_attempts=10, retry_delay=30, max_delay=3600, lease=300):
+        self.path = path
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_delay = float(retry_delay)
+        self.max_delay = float(max_delay)
+        self.lease = float(lease)
+        conn = get_connection(self.path)
+        ensure_schema(conn)
+        with conn:
+            # строки outbox, доставленные прежней версией (она помечала их SENT, а не удаляла)
+            conn.execute("DELETE FROM webhooks WHERE sent = ? AND created_at IS NOT NULL", (SENT,))
+
+    def _delay(self, attempts):
+        delay = min(self.max_delay, self.retry_delay * (2 ** max(0, attempts - 1)))
+        # разброс, чтобы строки, отложенные одновременно, не уходили одной волной
+        return delay * random.uniform(0.8, 1.0)
+
+    def add(self, item_id, item_type, name, caption, image_tag=None, dedup_keys=(), error=None, destination=None, **fields):
+        """Откладывает уведомление после первой неудачной попытки. Возвращает id строки."""
+        now = time.time()
+        row = {
+            "item_id": str(item_id or ""), "item_type": item_type, "name": name or "", "caption": caption,
+            "image_tag": image_tag, "dedup_keys": json.dumps(list(dedup_keys)), "attempts": 1,
+            "next_attempt_at": now + self._delay(1), "last_error": error, "created_at": now,
+            "destination": str(destination) if destination else None,
+            "year": fields.get("year"), "series_name": fields.get("series_name"),
+            "season_number": fields.get("season_number"), "episode_number": fields.get("episode_number"),
+        }
+        conn = get_connection(self.path)
+        with conn:
+            cursor = conn.execute(f"""
+                INSERT INTO webhooks ({", ".join(row)}, sent) VALUES ({", ".join(":" + k for k in row)}, {PENDING})
+            """, row)
+        return cursor.lastrowid
+
+    def claim(self, limit=50):
+        """Забирает до limit строк, готовых к отправке (по порядку добавления): список dict."""
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn = get_connection(self.path)
+        with conn:
+            conn.execute("""
+                UPDATE webhooks SET claim = ?, next_attempt_at = ?
+                WHERE id IN (SELECT id FROM webhooks WHERE sent = ? AND next_attempt_at <= ? ORDER BY id LIMIT ?)
+            """, (token, now + self.lease, PENDING, now, int(limit)))
+        cursor = conn.execute(
+            "SELECT id, item_id, item_type, name, caption, image_tag, dedup_keys, attempts, destination FROM webhooks WHERE claim = ? ORDER BY id",
+            (token,))
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, values)) for values in cursor.fetchall()]
+
+    def complete(self, ids):
+        """Удаляет доставленные строки: история отправок не нужна, а таблица не должна расти."""
+        if not ids:
+            return
+        conn = get_connection(self.path)
+        with conn:
+            conn.executemany("DELETE FROM webhooks WHERE id = ?", [(i,) for i in ids])
+
+    def retry(self, failures):
+        """failures — [(строка из claim(), текст ошибки)]. Возвращает строки, перешедшие в DEAD."""
+        now = time.time()
+        dead, updates = [], []
+        for row, error in failures:
+            attempts = row["attempts"] + 1
+            if attempts >= self.max_attempts:
+                dead.append(row)
+                updates.append((DEAD, attempts, now, error, row["id"]))
+            else:
+                updates.append((PENDING, attempts, now + self._delay(attempts), error, row["id"]))
+        if updates:
+            conn = get_connection(self.path)
+            with conn:
+                conn.executemany(
+                    "UPDATE webhooks SET sent = ?, attempts = ?, next_attempt_at = ?, last_error = ?, claim = NULL WHERE id = ?",
+                    updates)
+        return dead
+
+    def release(self, rows):
+        """Возвращает забранные строки в очередь без траты попытки (например, Telegram снова недоступен)."""
+        if not rows:
+            return
+        now = time.time()
+        conn = get_connection(self.path)
+        with conn:
+            conn.executemany("UPDATE webhooks SET next_attempt_at = ?, claim = NULL WHERE id = ?", [(now, row["id"]) for row in rows])
+
+    def stats(self):
+        counts = dict(get_connection(self.path).execute(
+            "SELECT sent, COUNT(*) FROM webhooks WHERE sent IN (?, ?) GROUP BY sent", (PENDING, DEAD)).fetchall())
+        return {"pending": counts.get(PENDING, 0), "dead": counts.get(DEAD, 0)}
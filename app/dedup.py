@@ -0,0 +1,195 @@
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from app.database import get_connection
+
+logger = logging.getLogger("jellysay")
+
+INFLIGHT = "inflight"
+SENT = "sent"
+FAILED = "failed"
+
+
+def _claimable(state, since, now, ttl, claim_timeout):
+    if state == FAILED:
+        return True
+    if state == INFLIGHT:
+        return since < now - claim_timeout
+    return since < now - ttl
+
+
+class MemoryDedupStore:
+    """
+    Хранилище отправленных уведомлений в памяти процесса (без сохранения между запусками).
+    Заявки (claim) атомарны только в пределах одного процесса.
+    """
+
+    def __init__(self, ttl, claim_timeout=600):
+        self.ttl = float(ttl)
+        self.claim_timeout = float(claim_timeout)
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def contains(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            return entry is not None and entry[1] == SENT and entry[0] >= time.time() - self.ttl
+
+    def claim(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and not _claimable(entry[1], entry[0], now, self.ttl, self.claim_timeout):
+                return False
+            self._items[key] = (now, INFLIGHT)
+            return True
+
+    def add(self, key):
+        self.add_many([key])
+
+    def add_many(self, keys):
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                self._items[key] = (now, SENT)
+
+    def mark_sent(self, key):
+        self.add(key)
+
+    def mark_failed(self, key):
+        with self._lock:
+            self._items[key] = (time.time(), FAILED)
+
+    def release(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None and entry[1] == INFLIGHT:
+                del self._items[key]
+
+    def count(self):
+        with self._lock:
+            return len(self._items)
+
+
+class SQLiteDedupStore:
+    """
+    Хранилище отправленных уведомлений в SQLite: вставка — одна строка по первичному ключу,
+    без перезаписи всего файла. Записи старше ttl секунд не учитываются и периодически удаляются.
+
+    claim() — атомарная заявка «отправляю я» перед отправкой, общая для всех процессов
+    (например, воркеров gunicorn): одна UPSERT-инструкция под блокировкой записи SQLite.
+    Состояния: inflight -> sent | failed; зависшая inflight-заявка старше claim_timeout
+    и failed-запись могут быть заявлены снова.
+    """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, ttl, claim_timeout=600):
+        self.path = path
+        self.ttl = float(ttl)
+        self.claim_timeout = float(claim_timeout)
+        self._inserts = 0
+        conn = get_connection(self.path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS notified_items (
+                key TEXT PRIMARY KEY,
+                notified_at REAL NOT NULL,
+                state TEXT NOT NULL DEFAULT 'sent'
+            )
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(notified_items)")}
+        if "state" not in columns:
+            conn.execute("ALTER TABLE notified_items ADD COLUMN state TEXT NOT NULL DEFAULT 'sent'")
+        conn.execute("CREATE INDEX IF NOT EXISTS notified_items_notified_at ON notified_items (notified_at)")
+        conn.commit()
+
+    def contains(self, key):
+        row = get_connection(self.path).execute(
+            "SELECT 1 FROM notified_items WHERE key = ? AND state = 'sent' AND notified_at >= ?", (key, time.time() - self.ttl)
+        ).fetchone()
+        return row is not None
+
+    def claim(self, key):
+        now = time.time()
+        conn = get_connection(self.path)
+        with conn:
+            cursor = conn.execute("""
+                INSERT INTO notified_items (key, notified_at, state) VALUES (?, ?, 'inflight')
+                ON CONFLICT (key) DO UPDATE SET notified_at = excluded.notified_at, state = 'inflight'
+                WHERE notified_items.state = 'failed'
+                   OR (notified_items.state = 'inflight' AND notified_items.notified_at < ?)
+                   OR (notified_items.state = 'sent' AND notified_items.notified_at < ?)
+            """, (key, now, now - self.claim_timeout, now - self.ttl))
+        return cursor.rowcount == 1
+
+    def add(self, key):
+        self.add_many([key])
+
+    def add_many(self, keys):
+        now = time.time()
+        conn = get_connection(self.path)
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO notified_items (key, notified_at, state) VALUES (?, ?, 'sent')", [(k, now) for k in keys]
+            )
+        self._inserts += len(keys)
+        if self._inserts >= self.PURGE_EVERY:
+            self._inserts = 0
+            self.purge()
+
+    def mark_sent(self, key):
+        self.add(key)
+
+    def mark_failed(self, key):
+        conn = get_connection(self.path)
+        with conn:
+            conn.execute("UPDATE notified_items SET state = 'failed', notified_at = ? WHERE key = ?", (time.time(), key))
+
+    def release(self, key):
+        conn = get_connection(self.path)
+        with conn:
+            conn.execute("DELETE FROM notified_items WHERE key = ? AND state = 'inflight'", (key,))
+
+    def purge(self):
+        now = time.time()
+        conn = get_connection(self.path)
+        with conn:
+            deleted = conn.execute(
+                "DELETE FROM notified_items WHERE notified_at < ? OR (state = 'inflight' AND notified_at < ?)",
+                (now - self.ttl, now - self.claim_timeout),
+            ).rowcount
+        if deleted:
+            logger.info("Purged %d expired notified items", deleted)
+
+    def count(self):
+        return get_connection(self.path).execute("SELECT COUNT(*) FROM notified_items").fetchone()[0]
+
+
+def create_dedup_store(backend, path, ttl, claim_timeout=600):
+    if backend == "memory":
+        return MemoryDedupStore(ttl, claim_timeout)
+    if backend == "sqlite":
+        return SQLiteDedupStore(path, ttl, claim_timeout)
+    raise ValueError(f"Unknown dedup backend: {backend}")
+
+
+def migrate_json_file(store, json_path):
+    """
+    Переносит ключи из старого notified_items.json в хранилище (один раз):
+    после переноса файл переименовывается в *.migrated.
+    """
+    json_path = Path(json_path)
+    if not json_path.exists():
+        return 0
+    try:
+        keys = list(json.loads(json_path.read_text(encoding="utf-8")))
+    except Exception as e:
+        logger.error("Cannot read notified items file for migration: %s", e)
+        return 0
+    store.add_many(keys)
+    json_path.replace(json_path.with_name(json_path.name + ".migrated"))
+    logger.info("Migrated %d notified items from %s", len(keys), json_path)
+    return len(keys)
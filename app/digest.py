@@ -0,0 +1,278 @@
+import logging
+import re
+import threading
+import time
+import uuid
+
+from app.coalesce import format_number_range
+from app.database import get_connection
+
+logger = logging.getLogger("jellysay")
+
+# Лимиты Telegram: текст сообщения, подпись к фото и число фото в альбоме (sendMediaGroup)
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+
+_COLUMNS = ("kind", "name", "year", "series_name", "season_number", "episode_number", "overview", "trailer",
+            "item_id", "image_tag", "season_id", "season_image_tag", "unique_key", "destinations")
+
+
+class DigestStore:
+    """
+    Накопитель дайджеста на SQLite (таблица digest_items, переживает перезапуск): элементы,
+    прошедшие дедупликацию и фильтры по датам, ждут периодической отправки одним сообщением.
+    Как и Outbox, claim() забирает строки атомарно с арендой lease секунд, поэтому
+    отправлять дайджест могут несколько процессов — каждая строка уйдёт один раз.
+    """
+
+    def __init__(self, path, lease=300):
+        self.path = path
+        self.lease = float(lease)
+        conn = get_connection(self.path)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS digest_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {", ".join(name + " TEXT" for name in _COLUMNS)},
+                created_at REAL NOT NULL,
+                claim TEXT,
+                claimed_until REAL NOT NULL DEFAULT 0
+            )
+        """)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(digest_items)")}
+        for name in _COLUMNS:
+            if name not in columns:
+                conn.execute(f"ALTER TABLE digest_items ADD COLUMN {name} TEXT")
+        conn.commit()
+
+    def add(self, item, destinations=(), trailer=None):
+        """
+        Добавляет MediaItem (app.media) в дайджест. destinations — получатели (app.routing.Destination),
+        хранятся строкой «чат[:тема],...»; пусто — чат по умолчанию. Возвращает id строки.
+        """
+        row = {name: getattr(item, name, None) for name in _COLUMNS}
+        row["trailer"] = trailer
+        row["destinations"] = ",".join(str(destination) for destination in destinations)
+        row["created_at"] = time.time()
+        conn = get_connection(self.path)
+        with conn:
+            cursor = conn.execute(
+                f"INSERT INTO digest_items ({', '.join(row)}) VALUES ({', '.join(':' + k for k in row)})", row)
+        return cursor.lastrowid
+
+    def oldest(self):
+        """Время добавления самого старого ожидающего элемента (time.time()) или None."""
+        row = get_connection(self.path).execute(
+            "SELECT MIN(created_at) FROM digest_items WHERE claimed_until < ?", (time.time(),)).fetchone()
+        return row[0] if row else None
+
+    def claim(self):
+        """Забирает все ожидающие элементы (по порядку добавления): список dict."""
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn = get_connection(self.path)
+        with conn:
+            conn.execute("UPDATE digest_items SET claim = ?, claimed_until = ? WHERE claimed_until < ?",
+                         (token, now + self.lease, now))
+        cursor = conn.execute(
+            f"SELECT id, {', '.join(_COLUMNS)} FROM digest_items WHERE claim = ? ORDER BY id", (token,))
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, values)) for values in cursor.fetchall()]
+
+    def complete(self, ids):
+        if not ids:
+            return
+        conn = get_connection(self.path)
+        with conn:
+            conn.executemany("DELETE FROM digest_items WHERE id = ?", [(i,) for i in ids])
+
+    def release(self, ids):
+        """Возвращает забранные элементы в накопитель (отправка не состоялась)."""
+        if not ids:
+            return
+        conn = get_connection(self.path)
+        with conn:
+            conn.executemany("UPDATE digest_items SET claim = NULL, claimed_until = 0 WHERE id = ?", [(i,) for i in ids])
+
+    def stats(self):
+        count, oldest = get_connection(self.path).execute("SELECT COUNT(*), MIN(created_at) FROM digest_items").fetchone()
+        return {"pending": count, "oldest_age": round(time.time() - oldest, 1) if oldest else None}
+
+
+class DigestScheduler:
+    """
+    Поток отправки дайджеста: раз в poll_interval секунд проверяет накопитель и, если самый
+    старый элемент ждёт не меньше interval секунд, забирает все элементы и передаёт их
+    в flush(rows, done); flush вызывает done(отправленные строки) после каждого сообщения —
+    они сразу удаляются из накопителя. Строки, для которых done не вызван (ошибка посреди
+    отправки или сообщение, которое стоит повторить позже), возвращаются в накопитель. Интервал отсчитывается от первого элемента (как окно склейки эпизодов),
+    поэтому расписание не сбрасывается при перезапуске. Пока ready() ложно (Telegram недоступен),
+    элементы остаются в накопителе.
+    """
+
+    def __init__(self, store, flush, interval=86400, ready=None, poll_interval=60):
+        self.store = store
+        self.flush = flush
+        self.interval = float(interval)
+        self.ready = ready
+        self.poll_interval = min(float(poll_interval), self.interval)
+        self.digests = 0
+        self.items = 0
+        self.last_flush = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="digest", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.flush_once()
+            except Exception as e:
+                logger.warning("Digest flush failed: %s", e)
+
+    def flush_once(self, force=False):
+        """Отправляет дайджест, если пора (или force). Возвращает число отправленных элементов."""
+        if self.ready is not None and not self.ready():
+            return 0
+        oldest = self.store.oldest()
+        if oldest is None or (not force and time.time() - oldest < self.interval):
+            return 0
+        rows = self.store.claim()
+        if not rows:
+            return 0
+        sent = set()
+
+        def done(sent_rows):
+            ids = [row["id"] for row in sent_rows if row["id"] not in sent]
+            self.store.complete(ids)
+            sent.update(ids)
+
+        try:
+            self.flush(rows, done)
+        finally:
+            self.store.release([row["id"] for row in rows if row["id"] not in sent])
+        if sent:
+            self.digests += 1
+            self.items += len(sent)
+            self.last_flush = time.time()
+        return len(sent)
+
+    def stats(self):
+        return dict(self.store.stats(), interval=self.interval, digests=self.digests, items=self.items,
+                    last_flush_ago=round(time.time() - self.last_flush, 1) if self.last_flush else None)
+
+
+def escape_markdown(text):
+    """Экранирует символы разметки Telegram Markdown (parse_mode=Markdown) в тексте вне сущностей."""
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
+
+
+def bold(text):
+    """
+    *text* для Telegram Markdown. Внутри сущности экранирование не работает, поэтому
+    звёздочка в тексте закрывает жирный шрифт, выводится экранированной и открывает его снова.
+    """
+    return "\\*".join(f"*{part}*" if part else "" for part in str(text).split("*"))
+
+
+def _episode_number(row):
+    return int(row["episode_number"]) if str(row["episode_number"] or "").isdigit() else 0
+
+
+def digest_sections(rows):
+    """
+    Группирует элементы дайджеста: фильмы, сериалы (по сериалу и сезону, с диапазоном эпизодов)
+    и прочие видео. Возвращает [(заголовок раздела, [(строка, [строки накопителя])])].
+    """
+    movies, videos, series, seasons = [], [], [], {}
+    for row in rows:
+        if row["kind"] == "Movie":
+            line = f"• {bold(row['name'])} ({escape_markdown(row['year'])})" if row["year"] else f"• {bold(row['name'])}"
+            if row["trailer"]:
+                line += f" — [Трейлер]({row['trailer']})"
+            movies.append((line, [row]))
+        elif row["kind"] == "Episode":
+            seasons.setdefault((row["series_name"] or "", row["season_number"] or "?"), []).append(row)
+        elif row["kind"] == "Season":
+            # у сезона в episode_number — диапазон его эпизодов
+            line = f"• {bold(row['series_name'] or row['name'])} — новый сезон {escape_markdown(row['season_number'] or '?')}"
+            if row["episode_number"]:
+                line += f", эпизоды {escape_markdown(row['episode_number'])}"
+            series.append((line, [row]))
+        else:
+            videos.append((f"• {bold(row['name'])}", [row]))
+
+    for (series_name, season), episodes in seasons.items():
+        episodes.sort(key=_episode_number)
+        season = escape_markdown(season)
+        if len(episodes) == 1:
+            episode = escape_markdown(episodes[0]["episode_number"] or "?")
+            line = f"• {bold(series_name)} — сезон {season}, эпизод {episode}: {escape_markdown(episodes[0]['name'])}"
+        else:
+            episode_range = escape_markdown(format_number_range([row["episode_number"] or "?" for row in episodes]))
+            line = f"• {bold(series_name)} — сезон {season}, эпизоды {episode_range}"
+        series.append((line, episodes))
+    series.sort(key=lambda entry: entry[0])
+
+    sections = [("*🍿 Фильмы*", movies), ("*🎬 Сериалы*", series), ("*📼 Другое*", videos)]
+    return [(title, lines) for title, lines in sections if lines]
+
+
+def format_digest(rows, limit=MESSAGE_LIMIT, header="*📰 Новое в библиотеке*"):
+    """
+    Сообщения дайджеста не длиннее limit символов: [(текст, [строки накопителя])].
+    Разделы переносятся в следующее сообщение целиком, если помещаются в него, иначе построчно.
+    """
+    messages = []
+    text, included = header, []
+    for title, lines in digest_sections(rows):
+        section = "\n\n" + title + "".join("\n" + line for line, _rows in lines)
+        if len(text) + len(section) > limit and included:
+            messages.append((text, included))
+            text, included = header, []
+        text += "\n\n" + title
+        for line, line_rows in lines:
+            if len(text) + len(line) + 1 > limit and included:
+                messages.append((text, included))
+                text, included = title, []
+            text += "\n" + line
+            included.extend(line_rows)
+    if included:
+        messages.append((text, included))
+    return messages
+
+
+def digest_posters(rows, limit=MEDIA_GROUP_LIMIT):
+    """Постеры для альбома сообщения дайджеста: [(id изображения, image_tag)] без повторов, не больше limit."""
+    posters = []
+    for row in rows:
+        if row["kind"] == "Episode" and row["season_id"]:
+            poster = (row["season_id"], row["season_image_tag"])
+        elif row["kind"] in ("Movie", "Season", "Episode") and row["item_id"]:
+            poster = (row["item_id"], row["image_tag"])
+        else:
+            continue
+        if poster not in posters:
+            posters.append(poster)
+        if len(posters) >= limit:
+            break
+    return posters
+
+
+def digest_poster(rows):
+    """(фото, image_tag) для первого сообщения дайджеста: постер первого фильма или сезона; (None, None) — без фото."""
+    for row in rows:
+        if row["kind"] == "Movie" and row["item_id"]:
+            return row["item_id"], row["image_tag"]
+    for row in rows:
+        if row["kind"] in ("Season", "Episode") and (row["season_id"] or row["item_id"]):
+            if row["season_id"]:
+                return row["season_id"], row["season_image_tag"]
+            return row["item_id"], row["image_tag"]
+    return None, None
@@ -0,0 +1,201 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger("jellysay")
+
+
+class ItemNotFound(LookupError):
+    """Jellyfin не вернул элемент с таким Id."""
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кеш с ограничением по времени жизни записей."""
+
+    def __init__(self, maxsize=2000, ttl=300):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class ItemBatcher:
+    """
+    Склеивает одновременные запросы элементов в один запрос Ids=a,b,c.
+    Первый поток, пришедший за элементом, ждёт window секунд, собирает все Id,
+    запрошенные за это время, и выполняет fetch_many(ids) -> {id: item}.
+    """
+
+    def __init__(self, fetch_many, window=0.005, max_batch=50):
+        self.fetch_many = fetch_many
+        self.window = float(window)
+        self.max_batch = int(max_batch)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._collecting = False
+        self.requests = 0
+        self.batches = 0
+
+    def get(self, item_id):
+        with self._lock:
+            self.requests += 1
+            future = self._pending.get(item_id)
+            if future is None:
+                future = Future()
+                self._pending[item_id] = future
+            leader = not self._collecting
+            if leader:
+                self._collecting = True
+        if leader:
+            if self.window > 0:
+                time.sleep(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._collecting = False
+            self._run(batch)
+        return future.result()
+
+    def _run(self, batch):
+        ids = list(batch)
+        for start in range(0, len(ids), self.max_batch):
+            chunk = ids[start:start + self.max_batch]
+            with self._lock:
+                self.batches += 1
+            try:
+                items = self.fetch_many(chunk)
+            except Exception as e:
+                for item_id in chunk:
+                    batch[item_id].set_exception(e)
+                continue
+            for item_id in chunk:
+                item = items.get(item_id)
+                if item is None:
+                    batch[item_id].set_exception(ItemNotFound(item_id))
+                else:
+                    batch[item_id].set_result(item)
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "batches": self.batches}
+
+
+class AsyncItemBatcher:
+    """То же, что ItemBatcher, для asyncio: fetch_many — корутина."""
+
+    def __init__(self, fetch_many, window=0.005, max_batch=50):
+        self.fetch_many = fetch_many
+        self.window = float(window)
+        self.max_batch = int(max_batch)
+        self._pending = {}
+        self._collecting = False
+        self.requests = 0
+        self.batches = 0
+
+    async def get(self, item_id):
+        self.requests += 1
+        future = self._pending.get(item_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[item_id] = future
+        if not self._collecting:
+            self._collecting = True
+            await asyncio.sleep(self.window)
+            batch, self._pending = self._pending, {}
+            self._collecting = False
+            await self._run(batch)
+        return await future
+
+    async def _run(self, batch):
+        ids = list(batch)
+        for start in range(0, len(ids), self.max_batch):
+            chunk = ids[start:start + self.max_batch]
+            self.batches += 1
+            try:
+                items = await self.fetch_many(chunk)
+            except Exception as e:
+                for item_id in chunk:
+                    batch[item_id].set_exception(e)
+                continue
+            for item_id in chunk:
+                item = items.get(item_id)
+                if item is None:
+                    batch[item_id].set_exception(ItemNotFound(item_id))
+                else:
+                    batch[item_id].set_result(item)
+
+    def stats(self):
+        return {"requests": self.requests, "batches": self.batches}
+
+
+class JellyfinItems:
+    """Слой метаданных Jellyfin: TTL/LRU-кеш элементов поверх пакетных запросов."""
+
+    def __init__(self, fetch_many, ttl=300, maxsize=2000, window=0.005, max_batch=50):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.batcher = ItemBatcher(fetch_many, window=window, max_batch=max_batch)
+        self.async_batcher = None
+
+    def get(self, item_id):
+        item_id = str(item_id)
+        item = self.cache.get(item_id)
+        if item is None:
+            item = self.batcher.get(item_id)
+            self.cache.set(item_id, item)
+        return item
+
+    def enable_async(self, fetch_many):
+        """Подключает асинхронный источник (корутину fetch_many) для aget(); кеш общий."""
+        self.async_batcher = AsyncItemBatcher(fetch_many, window=self.batcher.window, max_batch=self.batcher.max_batch)
+
+    async def aget(self, item_id):
+        item_id = str(item_id)
+        item = self.cache.get(item_id)
+        if item is None:
+            item = await self.async_batcher.get(item_id)
+            self.cache.set(item_id, item)
+        return item
+
+    def prime(self, items):
+        """Кладёт в кеш элементы, полученные другим запросом (например, эпизоды сезона по ParentId)."""
+        for item in items:
+            if item.get("Id"):
+                self.cache.set(str(item["Id"]), item)
+
+    def invalidate(self, item_id):
+        self.cache.pop(str(item_id))
+
+    def stats(self):
+        batcher = self.async_batcher or self.batcher
+        return dict(self.cache.stats(), **batcher.stats())
@@ -0,0 +1,127 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+# Идентификатор вебхука, к которому относятся записи лога (в потоке/задаче обработки)
+correlation_id = contextvars.ContextVar("correlation_id", default="-")
+# Длительности этапов текущего запроса [(этап, мс, ошибка)] — только пока запрос профилируется (app.profiling)
+stage_timings = contextvars.ContextVar("stage_timings", default=None)
+
+# Стандартные атрибуты LogRecord: всё остальное в record.__dict__ — поля из extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "correlation_id"}
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex[:12]
+
+
+class CorrelationFilter(logging.Filter):
+    """Добавляет в запись correlation_id текущего вебхука."""
+
+    def filter(self, record):
+        if not hasattr(record, "correlation_id"):
+            record.correlation_id = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON: время, уровень, сообщение, correlation_id и поля из extra=."""
+
+    def format(self, record):
+        data = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "correlation_id": getattr(record, "correlation_id", "-"),
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _ContextQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # correlation_id нужно взять в потоке запроса, а не в потоке записи лога
+        if not hasattr(record, "correlation_id"):
+            record.correlation_id = correlation_id.get()
+        return super().prepare(record)
+
+
+def setup_async_logging(logger, handlers, fmt="text"):
+    """
+    Переводит logger на асинхронную запись: в потоке запроса запись только кладётся
+    в очередь, форматирование и дисковый ввод-вывод выполняет QueueListener в своём потоке.
+    fmt: "text" или "json".
+    """
+    formatter = JsonFormatter() if fmt == "json" else logging.Formatter(
+        "%(asctime)s - %(levelname)s - [%(correlation_id)s] %(message)s"
+    )
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        handler.addFilter(CorrelationFilter())
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(_ContextQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    # после fork (воркеры gunicorn) поток записи остаётся только в родителе — запускаем свой
+    os.register_at_fork(after_in_child=listener.start)
+    return listener
+
+
+class PayloadLogPolicy:
+    """
+    Решает, логировать ли тело вебхука целиком: mode "off", "full" или "sample"
+    (каждый вебхук с вероятностью sample_rate); тело обрезается до max_chars.
+    """
+
+    def __init__(self, mode="sample", sample_rate=0.1, max_chars=2000):
+        self.mode = mode
+        self.sample_rate = float(sample_rate)
+        self.max_chars = int(max_chars)
+
+    def should_log(self):
+        if self.mode == "full":
+            return True
+        if self.mode == "sample":
+            return random.random() < self.sample_rate
+        return False
+
+    def truncate(self, text):
+        text = str(text)
+        if len(text) <= self.max_chars:
+            return text
+        return text[:self.max_chars] + f"...<{len(text) - self.max_chars} more chars>"
+
+
+@contextmanager
+def log_stage(logger, stage, **fields):
+    """Логирует длительность этапа обработки: event=stage, stage, duration_ms (и error при исключении)."""
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        extra = dict(fields, event="stage", stage=stage, duration_ms=duration_ms)
+        if error:
+            extra["error"] = error
+        logger.info("stage %s: %.1f ms", stage, duration_ms, extra=extra)
+        timings = stage_timings.get()
+        if timings is not None:
+            timings.append((stage, duration_ms, error))
@@ -0,0 +1,166 @@
+import json
+from collections.abc import Mapping
+
+# Тела вебхука, которые разбираются как форма (остальные — как JSON)
+FORM_CONTENT_TYPES = ("application/x-www-form-urlencoded", "multipart/form-data")
+
+
+def parse_body(raw_body, form=None):
+    """
+    Разбирает тело вебхука один раз: данные формы (form-data/urlencoded), иначе JSON
+    (независимо от Content-Type — плагин Jellyfin не всегда его выставляет).
+    Возвращает dict или None, если тело не разобрать.
+    """
+    if form:
+        return dict(form)
+    if not raw_body:
+        return None
+    try:
+        return json.loads(raw_body)
+    except ValueError:
+        return None
+
+
+def _first_non_empty(*values):
+    for value in values:
+        if value is None:
+            continue
+        # допускаем 0 как валидное значение, поэтому проверяем на пустую строку и None
+        if isinstance(value, (int, float)) or (isinstance(value, str) and value.strip() != ""):
+            return str(value)
+    return ""
+
+
+def first_item(details):
+    """Items[0] ответа Jellyfin /Items или {}, если элемента нет."""
+    if not isinstance(details, dict):
+        return {}
+    items = details.get("Items") or [{}]
+    return items[0] or {}
+
+
+def _date_only(value):
+    return (value or "").split("T")[0]
+
+
+class MediaItem:
+    """
+    Нормализованный элемент уведомления: данные вебхука, дополненные деталями из Jellyfin.
+    Собирается один раз (from_webhook) — дальше все этапы и шаблоны работают с атрибутами,
+    а не с цепочками payload.get(...) / details["Items"][0].get(...).
+    Значения из вебхука приоритетнее деталей Jellyfin.
+    """
+
+    __slots__ = (
+        "kind", "item_type", "item_id", "name", "series_name", "season_number", "episode_number",
+        "year", "overview", "image_tag", "season_id", "season_image_tag", "premiere_date",
+        "date_created", "path", "unique_key", "payload",
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_webhook(cls, payload, details=None):
+        """payload — разобранный вебхук, details — элемент Jellyfin (Items[0]) или None."""
+        details = details or {}
+        item_type = details.get("Type") or payload.get("ItemType") or payload.get("Type") or "Video"
+        kind = {"movie": "Movie", "episode": "Episode", "season": "Season"}.get(str(item_type).lower(), "Video")
+
+        # год — часть ключа дедупликации
+        year = payload.get("Year") or details.get("ProductionYear") or _date_only(details.get("PremiereDate")).split("-")[0]
+        item_id = payload.get("ItemId")
+        image_tag = (details.get("ImageTags") or {}).get("Primary")
+        if kind == "Season":
+            # у сезона IndexNumber — номер самого сезона, эпизода нет
+            season_number = _first_non_empty(
+                payload.get("SeasonNumber00"), payload.get("SeasonNumber"), payload.get("IndexNumber"), details.get("IndexNumber"),
+            )
+            episode_number = ""
+            season_id = item_id
+        else:
+            season_number = _first_non_empty(
+                payload.get("SeasonNumber00"), payload.get("SeasonNumber"), payload.get("ParentIndexNumber"),
+                payload.get("SeasonIndex"), details.get("ParentIndexNumber"), details.get("SeasonNumber"),
+            )
+            episode_number = _first_non_empty(
+                payload.get("EpisodeNumber00"), payload.get("EpisodeNumber"), payload.get("IndexNumber"),
+                payload.get("EpisodeIndex"), details.get("IndexNumber"),
+            )
+            season_id = payload.get("SeasonId") or details.get("SeasonId")
+        return cls(
+            kind=kind,
+            item_type=item_type,
+            item_id=item_id,
+            name=payload.get("Name") or details.get("Name") or "Unknown",
+            series_name=payload.get("SeriesName") or details.get("SeriesName") or "",
+            season_number=season_number,
+            episode_number=episode_number,
+            year=str(year or ""),
+            overview=payload.get("Overview") or details.get("Overview") or "",
+            image_tag=image_tag,
+            season_id=season_id,
+            season_image_tag=image_tag if kind == "Season" else None,
+            premiere_date=_date_only(details.get("PremiereDate")) or None,
+            date_created=_date_only(details.get("DateCreated")) or None,
+            path=details.get("Path"),
+            # название сезона («Season 1») не уникально между сериалами — для сезона ключ по Id
+            unique_key=str((item_id if kind == "Season" else None) or year or item_id or payload.get("Timestamp") or ""),
+            payload=payload,
+        )
+
+    def template_fields(self):
+        return TemplateFields(self)
+
+    def __repr__(self):
+        return f"MediaItem({self.kind} {self.name!r} {self.year} id={self.item_id})"
+
+
+def _padded(value):
+    return value.zfill(2) if value.isdigit() else value
+
+
+class TemplateFields(Mapping):
+    """
+    Поля MediaItem под прежними именами ключей вебхука для шаблонов app/templates.json
+    ({Name}, {SeasonNumber00} и т.д.); прочие ключи берутся из исходного вебхука.
+    Использование: template.format_map(item.template_fields()).
+    """
+
+    __slots__ = ("item",)
+
+    FIELDS = {
+        "Name": lambda item: item.name,
+        "ItemId": lambda item: item.item_id,
+        "ItemType": lambda item: item.item_type,
+        "SeriesName": lambda item: item.series_name,
+        "SeasonId": lambda item: item.season_id,
+        "Year": lambda item: item.year,
+        "Overview": lambda item: item.overview,
+        "SeasonNumber": lambda item: item.season_number,
+        "EpisodeNumber": lambda item: item.episode_number,
+        "SeasonNumber00": lambda item: _padded(item.season_number),
+        "EpisodeNumber00": lambda item: _padded(item.episode_number),
+    }
+
+    def __init__(self, item):
+        self.item = item
+
+    def __getitem__(self, key):
+        field = self.FIELDS.get(key)
+        if field is not None:
+            return field(self.item)
+        return (self.item.payload or {})[key]
+
+    def __iter__(self):
+        keys = list(self.FIELDS)
+        keys.extend(key for key in (self.item.payload or {}) if key not in self.FIELDS)
+        return iter(keys)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def render_template(template, item):
+    return template.format_map(item.template_fields())
@@ -0,0 +1,191 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from urllib3.util.retry import Retry
+
+# Границы гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Счётчик с метками: inc(*значения меток). Значения хранятся в словаре по кортежу меток."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    @property
+    def family(self):
+        # в текстовом формате 0.0.4 HELP/TYPE счётчика должны называть ту же метрику, что и его сэмплы
+        return f"{self.name}_total"
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f"{self.family}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    """Гистограмма с метками: observe(секунды, *значения меток) или with time(*значения меток)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # счётчики корзин не накопительные: накопление делается при выводе
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self._values.items()}
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+    @property
+    def family(self):
+        return self.name
+
+
+class Registry:
+    """Набор метрик процесса; render() — текстовый формат Prometheus для /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.family} {metric.help}")
+            lines.append(f"# TYPE {metric.family} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Метрики приложения (на процесс: у каждого воркера gunicorn свои значения)
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "jellysay_stage_duration_seconds", "Duration of webhook processing stages", ("stage",))
+OUTCOMES = REGISTRY.counter(
+    "jellysay_notifications", "Webhook processing outcomes", ("outcome",))
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    "jellysay_upstream_responses", "HTTP responses from upstream services by status code", ("upstream", "code"))
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "jellysay_upstream_errors", "Upstream request attempts that failed without an HTTP response", ("upstream",))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "jellysay_upstream_retries", "Retried upstream requests", ("upstream", "reason"))
+TRAILER_LOOKUPS = REGISTRY.counter(
+    "jellysay_trailer_lookups", "Trailer lookups by result (cache hit, search, quota skip)", ("result",))
+ENRICHMENT_DROPPED = REGISTRY.counter(
+    "jellysay_enrichment_dropped", "Notifications sent without an optional part (trailer, poster)", ("part", "reason"))
+CIRCUIT_TRANSITIONS = REGISTRY.counter(
+    "jellysay_circuit_transitions", "Circuit breaker state changes per upstream", ("upstream", "state"))
+CIRCUIT_REJECTED = REGISTRY.counter(
+    "jellysay_circuit_rejected", "Upstream requests rejected by an open circuit breaker", ("upstream",))
+
+# Имена внешних сервисов по адресу (хост:порт): jellyfin, telegram, youtube
+_upstreams = {}
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _address(url):
+    parts = urlsplit(str(url))
+    if not parts.hostname:
+        return ""
+    return f"{parts.hostname}:{parts.port or _DEFAULT_PORTS.get(parts.scheme, 80)}"
+
+
+def register_upstream(name, url):
+    address = _address(url)
+    if address:
+        _upstreams[address] = name
+
+
+def upstream_of(url):
+    address = _address(url)
+    return _upstreams.get(address, address or "unknown")
+
+
+def record_response(resp, *args, **kwargs):
+    """Хук ответа requests.Session (hooks["response"]): считает коды ответа по сервисам."""
+    UPSTREAM_RESPONSES.inc(upstream_of(resp.url), str(resp.status_code))
+
+
+class MetricsRetry(Retry):
+    """urllib3 Retry, считающий повторные попытки в UPSTREAM_RETRIES."""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        address = f"{_pool.host}:{_pool.port}" if _pool is not None else ""
+        upstream = _upstreams.get(address, address or "unknown")
+        if error is not None:
+            UPSTREAM_ERRORS.inc(upstream)
+        # при исчерпании попыток super() бросает MaxRetryError — это уже не повтор
+        new_retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        UPSTREAM_RETRIES.inc(upstream, "error" if error is not None else "status")
+        return new_retry
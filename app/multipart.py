@@ -0,0 +1,61 @@
+import os
+import uuid
+
+
+class MultipartStream:
+    """
+    Тело multipart/form-data, которое отдаётся requests по частям, не собирая
+    изображение в памяти целиком. Передаётся как data=..., заголовок —
+    headers={"Content-Type": stream.content_type}.
+
+    chunks — функция без аргументов, возвращающая итератор байтов файла
+    (вызывается заново при каждой отправке, поэтому тело можно отправить повторно).
+    Если length известна — уходит Content-Length, иначе chunked transfer encoding.
+    """
+
+    def __init__(self, fields, name, filename, chunks, length=None, content_type="image/jpeg"):
+        self.boundary = uuid.uuid4().hex
+        head = []
+        for key, value in fields.items():
+            if value is None:
+                continue
+            head.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode("utf-8")
+            )
+        head.append(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode("utf-8")
+        )
+        self._head = b"".join(head)
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._chunks = chunks
+        if length is not None:
+            # requests берёт длину тела из атрибута len (см. requests.utils.super_len)
+            self.len = len(self._head) + length + len(self._tail)
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __iter__(self):
+        yield self._head
+        for chunk in self._chunks():
+            if chunk:
+                yield chunk
+        yield self._tail
+
+
+def file_chunks(path, chunk_size=64 * 1024):
+    """Функция-источник для MultipartStream, читающая файл блоками."""
+    def read():
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    return read
+
+
+def file_stream(fields, name, path, filename="poster.jpg", content_type="image/jpeg"):
+    return MultipartStream(fields, name, filename, file_chunks(path), length=os.path.getsize(path), content_type=content_type)
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger("jellysay")
+
+
+class PosterTooLarge(Exception):
+    """Изображение больше допустимого размера."""
+
+
+def iter_limited(resp, max_image_bytes=None, chunk_size=64 * 1024):
+    """
+    Итератор по телу ответа requests (stream=True) с ограничением размера:
+    проверяет Content-Length заранее и считает байты по ходу чтения.
+    """
+    if max_image_bytes:
+        declared = resp.headers.get("Content-Length")
+        if declared and declared.isdigit() and int(declared) > max_image_bytes:
+            raise PosterTooLarge(f"poster is {declared} bytes, limit is {max_image_bytes}")
+    size = 0
+    for chunk in resp.iter_content(chunk_size):
+        if not chunk:
+            continue
+        size += len(chunk)
+        if max_image_bytes and size > max_image_bytes:
+            raise PosterTooLarge(f"poster exceeds {max_image_bytes} bytes")
+        yield chunk
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def max_image_bytes_from_env():
+    """POSTER_MAX_BYTES: предел размера одного постера (и в кеше, и при передаче потоком)."""
+    return _env_int("POSTER_MAX_BYTES", 10 * 1024 * 1024)
+
+
+def from_env(directory):
+    """
+    Кеш постеров в directory по настройкам POSTER_CACHE_MAX_MB, POSTER_CACHE_MAX_AGE и
+    POSTER_MAX_BYTES. None при POSTER_CACHE_MAX_MB=0 (кеш выключен). Общий для jellysay.py
+    и app/server.py, чтобы оба читали одни и те же настройки.
+    """
+    max_mb = _env_int("POSTER_CACHE_MAX_MB", 200)
+    if max_mb <= 0:
+        return None
+    return PosterCache(
+        directory,
+        max_bytes=max_mb * 1024 * 1024,
+        max_age=_env_int("POSTER_CACHE_MAX_AGE", 3600),
+        max_image_bytes=max_image_bytes_from_env(),
+    )
+
+
+class PosterCache:
+    """
+    Дисковый кеш постеров с адресацией по содержимому.
+
+    Файлы изображений лежат как {sha256}.jpg (одинаковые картинки хранятся один раз),
+    для каждого ключа (id элемента или URL) в meta/ хранится sha, ETag и Last-Modified,
+    а в refs/{sha}/ — пустой файл-ссылка на мету каждого ключа, указывающего на изображение.
+    В пределах max_age файл отдаётся без обращения к Jellyfin, после — проверяется
+    условным запросом (If-None-Match / If-Modified-Since). Общий размер ограничен
+    max_bytes, при превышении удаляются давно не использованные файлы (LRU по mtime) вместе
+    с метой ссылавшихся на них ключей (по refs/, без просмотра всей meta/);
+    отдельное изображение больше max_image_bytes не скачивается (PosterTooLarge).
+    Все записи атомарны: временный файл + os.replace.
+    """
+
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024, max_age=3600, max_image_bytes=None, chunk_size=64 * 1024):
+        self.directory = str(directory)
+        self.meta_directory = os.path.join(self.directory, "meta")
+        self.refs_directory = os.path.join(self.directory, "refs")
+        self.max_bytes = int(max_bytes)
+        self.max_image_bytes = max_image_bytes
+        self.max_age = float(max_age)
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._total = None
+        self.hits = 0
+        self.revalidated_count = 0
+        self.misses = 0
+        os.makedirs(self.meta_directory, exist_ok=True)
+        os.makedirs(self.refs_directory, exist_ok=True)
+
+    def fetch(self, key, url, session, timeout=10):
+        """
+        Возвращает путь к файлу постера для key, при необходимости скачивая его по url.
+        При ошибке сети отдаёт устаревшую копию, если она есть, иначе пробрасывает исключение.
+        """
+        path, meta = self.lookup(key)
+        if path and self.is_fresh(meta):
+            return self.hit(path)
+
+        try:
+            resp = session.get(url, headers=self.conditional_headers(meta), timeout=timeout, stream=True)
+            try:
+                if resp.status_code == 304 and meta:
+                    return self.revalidated(key, meta, path)
+                resp.raise_for_status()
+                writer = self.writer(resp.headers.get("Content-Length"))
+                try:
+                    for chunk in resp.iter_content(self.chunk_size):
+                        writer.write(chunk)
+                except Exception:
+                    writer.abort()
+                    raise
+                return writer.commit(key, resp.headers)
+            finally:
+                resp.close()
+        except Exception:
+            return self.stale(key, path)
+
+    def lookup(self, key):
+        """(путь к файлу, мета) для key; (None, None), если в кеше ничего нет."""
+        meta = self._read_meta(key)
+        path = self._blob_path(meta["sha"]) if meta else None
+        if path and not os.path.exists(path):
+            # файл вытеснен — мета больше не годится для условного запроса
+            return None, None
+        return path, meta
+
+    def is_fresh(self, meta):
+        return bool(meta) and time.time() - meta.get("checked_at", 0) < self.max_age
+
+    def conditional_headers(self, meta):
+        headers = {}
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def hit(self, path):
+        self._touch(path)
+        self.hits += 1
+        return path
+
+    def revalidated(self, key, meta, path):
+        """Jellyfin ответил 304: файл актуален."""
+        meta["checked_at"] = time.time()
+        self._write_meta(key, meta)
+        self._touch(path)
+        self.revalidated_count += 1
+        return path
+
+    def stale(self, key, path):
+        """Вызывается из except: отдаёт устаревшую копию или пробрасывает текущее исключение."""
+        if not path:
+            raise
+        logger.warning("Poster revalidation failed, serving cached copy for %s", key)
+        self._touch(path)
+        return path
+
+    def writer(self, declared_length=None):
+        """Запись нового файла в кеш по частям: write(chunk)..., затем commit(key, headers) или abort()."""
+        return _PosterWriter(self, declared_length)
+
+    def stats(self):
+        return {"hits": self.hits, "revalidated": self.revalidated_count, "misses": self.misses,
+                "bytes": self._total or 0, "max_bytes": self.max_bytes}
+
+    def _blob_path(self, sha):
+        return os.path.join(self.directory, f"{sha}.jpg")
+
+    def _meta_name(self, key):
+        return hashlib.sha1(str(key).encode("utf-8")).hexdigest()
+
+    def _meta_path(self, key):
+        return os.path.join(self.meta_directory, self._meta_name(key) + ".json")
+
+    def _read_meta(self, key):
+        try:
+            with open(self._meta_path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, key, meta):
+        fd, tmp_path = tempfile.mkstemp(dir=self.meta_directory, suffix=".part")
+        with os.fdopen(fd, "w", encoding="utf-8") as tmp:
+            json.dump(meta, tmp)
+        os.replace(tmp_path, self._meta_path(key))
+        refs = os.path.join(self.refs_directory, meta["sha"])
+        os.makedirs(refs, exist_ok=True)
+        open(os.path.join(refs, self._meta_name(key)), "a").close()
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _blobs(self):
+        blobs = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".jpg"):
+                st = entry.stat()
+                blobs.append((st.st_mtime, st.st_size, entry.path))
+        return blobs
+
+    def _account(self, size):
+        with self._lock:
+            if self._total is None:
+                self._total = sum(b[1] for b in self._blobs())
+            else:
+                self._total += size
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # пересчитываем по диску: другие процессы могли добавить или удалить файлы
+        blobs = sorted(self._blobs())
+        total = sum(b[1] for b in blobs)
+        evicted = set()
+        for _mtime, size, path in blobs:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                evicted.add(os.path.basename(path)[:-len(".jpg")])
+                logger.info("Poster evicted from cache: %s", os.path.basename(path))
+            except OSError:
+                pass
+        self._total = total
+        if evicted:
+            self._drop_meta(evicted)
+
+    def _drop_meta(self, shas):
+        """
+        Удаляет мету ключей, указывающих на вытесненные файлы (одно изображение может быть
+        у нескольких ключей): по ссылкам из refs/{sha}/, затем и сами ссылки.
+        """
+        for sha in shas:
+            refs = os.path.join(self.refs_directory, sha)
+            try:
+                names = os.listdir(refs)
+            except OSError:
+                continue
+            for name in names:
+                meta_path = os.path.join(self.meta_directory, name + ".json")
+                try:
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        current = json.load(f).get("sha")
+                except (OSError, ValueError):
+                    current = None
+                # ключ мог с тех пор перейти на другое изображение — его мету не трогаем
+                if current == sha:
+                    try:
+                        os.unlink(meta_path)
+                    except OSError:
+                        pass
+            shutil.rmtree(refs, ignore_errors=True)
+
+
+class _PosterWriter:
+    def __init__(self, cache, declared_length=None):
+        self.cache = cache
+        self.max_image_bytes = cache.max_image_bytes
+        if self.max_image_bytes and declared_length and str(declared_length).isdigit() and int(declared_length) > self.max_image_bytes:
+            raise PosterTooLarge(f"poster is {declared_length} bytes, limit is {self.max_image_bytes}")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.directory, suffix=".part")
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.max_image_bytes and self.size > self.max_image_bytes:
+            raise PosterTooLarge(f"poster exceeds {self.max_image_bytes} bytes")
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+    def commit(self, key, headers):
+        """Переносит файл на место {sha256}.jpg и записывает мету ключа. None — если тело пустое."""
+        self.file.close()
+        cache = self.cache
+        cache.misses += 1
+        if self.size == 0:
+            os.unlink(self.tmp_path)
+            return None
+        sha = self.digest.hexdigest()
+        blob = cache._blob_path(sha)
+        if os.path.exists(blob):
+            os.unlink(self.tmp_path)
+            cache._touch(blob)
+        else:
+            os.replace(self.tmp_path, blob)
+            cache._account(self.size)
+        cache._write_meta(key, {
+            "sha": sha,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "checked_at": time.time(),
+        })
+        return blob
@@ -0,0 +1,69 @@
+import logging
+import time
+
+from app.database import get_connection
+
+logger = logging.getLogger("jellysay")
+
+
+class PosterIndex:
+    """
+    Постоянный индекс «изображение Jellyfin -> file_id Telegram».
+    Ключ — id элемента (или сериала/сезона), чьё изображение отправляется, и его ImageTag:
+    при смене ImageTag в Jellyfin запись считается устаревшей и перезаписывается.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        conn = get_connection(self.path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS poster_file_ids (
+                image_id TEXT PRIMARY KEY,
+                image_tag TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.commit()
+
+    def get(self, image_id, image_tag):
+        if not image_id or not image_tag:
+            return None
+        row = get_connection(self.path).execute(
+            "SELECT image_tag, file_id FROM poster_file_ids WHERE image_id = ?", (str(image_id),)
+        ).fetchone()
+        if not row or row[0] != image_tag:
+            return None
+        return row[1]
+
+    def known(self, image_id):
+        """Есть ли file_id для изображения (с любым ImageTag)."""
+        if not image_id:
+            return False
+        return get_connection(self.path).execute(
+            "SELECT 1 FROM poster_file_ids WHERE image_id = ?", (str(image_id),)
+        ).fetchone() is not None
+
+    def put(self, image_id, image_tag, file_id):
+        if not image_id or not image_tag or not file_id:
+            return
+        conn = get_connection(self.path)
+        conn.execute(
+            "INSERT OR REPLACE INTO poster_file_ids (image_id, image_tag, file_id, updated_at) VALUES (?, ?, ?, ?)",
+            (str(image_id), image_tag, file_id, time.time()),
+        )
+        conn.commit()
+
+    def forget(self, image_id):
+        conn = get_connection(self.path)
+        conn.execute("DELETE FROM poster_file_ids WHERE image_id = ?", (str(image_id),))
+        conn.commit()
+
+
+def photo_file_id(resp):
+    """file_id самого большого размера из ответа sendPhoto (или None)."""
+    try:
+        sizes = resp.json().get("result", {}).get("photo") or []
+        return sizes[-1].get("file_id") if sizes else None
+    except Exception:
+        return None
@@ -0,0 +1,127 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from pathlib import Path
+
+from app.logs import correlation_id, stage_timings
+
+logger = logging.getLogger("jellysay")
+
+
+class RequestProfiler:
+    """
+    Профилирование вебхуков по запросу: доля sample_rate запросов выполняется под cProfile
+    (файл .pstats на запрос в directory), а запросы дольше slow_ms миллисекунд сохраняют
+    длительности этапов (файл .json с этапами из log_stage). В directory хранится не больше
+    keep последних файлов.
+
+    Пока sample_rate и slow_ms нулевые, enabled ложно и обработчик вызывается напрямую —
+    профилировщик ничего не стоит. Под cProfile одновременно выполняется один запрос процесса
+    (в Python 3.12+ профилировщик в процессе может быть только один). cProfile видит только
+    поток запроса — параллельный сбор данных в enrich_pool попадает в профиль как ожидание,
+    а его этапы есть в .json; в асинхронном режиме в профиль попадает весь цикл событий.
+    """
+
+    def __init__(self, directory, sample_rate=0.0, slow_ms=0, keep=100):
+        self.directory = Path(directory)
+        self.keep = int(keep)
+        self.sampled = 0
+        self.slow = 0
+        self.last_file = None
+        self._lock = threading.Lock()
+        self.configure(sample_rate, slow_ms)
+
+    def configure(self, sample_rate=None, slow_ms=None):
+        """Меняет настройки на лету (эндпоинт /profile); в процессах gunicorn — только в текущем процессе."""
+        if sample_rate is not None:
+            self.sample_rate = min(max(float(sample_rate), 0.0), 1.0)
+        if slow_ms is not None:
+            self.slow_ms = max(float(slow_ms), 0.0)
+        self.enabled = self.sample_rate > 0 or self.slow_ms > 0
+
+    def run(self, label, func, *args):
+        """Выполняет func(*args) как запрос label (webhook, queued), профилируя его по настройкам."""
+        session = self._begin()
+        try:
+            return func(*args)
+        finally:
+            self._end(session, label)
+
+    async def run_async(self, label, func, *args):
+        session = self._begin()
+        try:
+            return await func(*args)
+        finally:
+            self._end(session, label)
+
+    def _begin(self):
+        profile = None
+        if self.sample_rate > 0 and random.random() < self.sample_rate and self._lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # профилировщик уже включён кем-то ещё (sys.monitoring в Python 3.12+)
+                self._lock.release()
+                profile = None
+        return profile, stage_timings.set([]), time.perf_counter()
+
+    def _end(self, session, label):
+        profile, token, started = session
+        if profile is not None:
+            profile.disable()
+            self._lock.release()
+        duration_ms = round((time.perf_counter() - started) * 1000, 2)
+        timings = stage_timings.get()
+        stage_timings.reset(token)
+        slow = self.slow_ms > 0 and duration_ms >= self.slow_ms
+        if profile is None and not slow:
+            return
+        try:
+            self._save(label, duration_ms, profile, timings if slow else None)
+        except OSError as e:
+            logger.warning("Cannot save request profile: %s", e)
+
+    def _save(self, label, duration_ms, profile, timings):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # correlation_id может прийти извне (X-Request-Id) — в имя файла только безопасные символы
+        request_id = re.sub(r"[^A-Za-z0-9_-]", "_", correlation_id.get())
+        base = self.directory / f"{time.strftime('%Y%m%d-%H%M%S')}-{request_id}-{label}"
+        profile_file = None
+        if profile is not None:
+            profile_file = base.with_suffix(".pstats")
+            profile.dump_stats(str(profile_file))
+            self.sampled += 1
+            self.last_file = profile_file.name
+        if timings is not None:
+            data = {
+                "label": label,
+                "correlation_id": correlation_id.get(),
+                "duration_ms": duration_ms,
+                "profile": profile_file.name if profile_file else None,
+                "stages": [{"stage": stage, "duration_ms": ms, "error": error} for stage, ms, error in timings],
+            }
+            timings_file = base.with_suffix(".json")
+            timings_file.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+            self.slow += 1
+            self.last_file = timings_file.name
+            logger.warning("Slow %s request: %.1f ms (limit %.0f ms), timings saved to %s",
+                           label, duration_ms, self.slow_ms, timings_file.name)
+        self._prune()
+
+    def _prune(self):
+        files = sorted(self.directory.iterdir(), key=lambda path: path.stat().st_mtime)
+        for path in files[:max(len(files) - self.keep, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {"enabled": self.enabled, "sample_rate": self.sample_rate, "slow_ms": self.slow_ms,
+                "sampled": self.sampled, "slow": self.slow, "last_file": self.last_file}
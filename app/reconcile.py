@@ -0,0 +1,156 @@
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from app.database import get_connection
+
+logger = logging.getLogger("jellysay")
+
+
+def parse_jellyfin_date(value):
+    """Дата Jellyfin ("2024-05-01T12:34:56.1234567Z") -> datetime UTC с точностью до секунды; None, если не разобрать."""
+    try:
+        return datetime.strptime(str(value)[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def format_jellyfin_date(value):
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Reconciler:
+    """
+    Фоновая сверка с библиотекой Jellyfin: находит фильмы и эпизоды, о которых не пришёл вебхук
+    (jellysay был перезапущен, Jellyfin не доставил запрос), и передаёт их в process(item).
+
+    Опрос инкрементальный: курсор — DateCreated последнего обработанного элемента, хранится
+    в SQLite (таблица reconcile_state). fetch_page(min_date, start_index, limit) запрашивает
+    у Jellyfin элементы с DateLastSaved >= min_date постранично; элементы, созданные раньше
+    курсора (у них просто обновились метаданные), пропускаются. Окно overlap перекрывает
+    предыдущий опрос (элементы с запоздавшей индексацией); уже обработанные в нём элементы
+    процесс помнит по Id, а после перезапуска повторы отсекает хранилище отправленных уведомлений.
+
+    Опрашивает только один процесс: аренда (owner, lease_until) в той же строке таблицы,
+    при остановке владельца её через 3 интервала забирает другой процесс.
+    """
+
+    def __init__(self, path, fetch_page, process, interval=300, page_size=200, overlap=60,
+                 initial_lookback=86400, name="jellyfin"):
+        self.path = path
+        self.fetch_page = fetch_page
+        self.process = process
+        self.interval = float(interval)
+        self.page_size = int(page_size)
+        self.overlap = float(overlap)
+        self.initial_lookback = float(initial_lookback)
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.polls = 0
+        self.found = 0
+        self.last_poll = None
+        self._seen = {}  # Id -> DateCreated элементов, обработанных в окне overlap
+        self._stop = threading.Event()
+        self._thread = None
+        conn = get_connection(self.path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS reconcile_state (
+                name TEXT PRIMARY KEY,
+                cursor TEXT,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("INSERT OR IGNORE INTO reconcile_state (name) VALUES (?)", (self.name,))
+        conn.commit()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="reconciler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # первый опрос сразу после запуска: догоняем то, что пришло, пока jellysay не работал
+        while True:
+            try:
+                if self.acquire_lease():
+                    self.poll_once()
+            except Exception as e:
+                logger.warning("Jellyfin reconcile poll failed: %s", e)
+            if self._stop.wait(self.interval):
+                return
+
+    def acquire_lease(self):
+        now = time.time()
+        conn = get_connection(self.path)
+        with conn:
+            cursor = conn.execute(
+                "UPDATE reconcile_state SET owner = ?, lease_until = ? WHERE name = ? AND (owner = ? OR owner IS NULL OR lease_until < ?)",
+                (self.owner, now + 3 * self.interval, self.name, self.owner, now))
+        return cursor.rowcount == 1
+
+    def get_cursor(self):
+        row = get_connection(self.path).execute("SELECT cursor FROM reconcile_state WHERE name = ?", (self.name,)).fetchone()
+        return parse_jellyfin_date(row[0]) if row and row[0] else None
+
+    def set_cursor(self, value):
+        conn = get_connection(self.path)
+        with conn:
+            conn.execute("UPDATE reconcile_state SET cursor = ? WHERE name = ?", (format_jellyfin_date(value), self.name))
+
+    def poll_once(self):
+        """Один проход сверки. Возвращает число переданных в process() элементов."""
+        cursor = self.get_cursor()
+        if cursor is None:
+            # первый запуск: не объявляем всю библиотеку, только последние initial_lookback секунд
+            cursor = datetime.now(timezone.utc) - timedelta(seconds=self.initial_lookback)
+        since = cursor - timedelta(seconds=self.overlap)
+        newest = cursor
+        failed = None
+        processed = 0
+        start_index = 0
+        while True:
+            items = self.fetch_page(format_jellyfin_date(since), start_index, self.page_size)
+            for item in items:
+                created = parse_jellyfin_date(item.get("DateCreated"))
+                if created is None or created < since:
+                    continue
+                if item.get("Id") in self._seen:
+                    newest = max(newest, created)
+                    continue
+                processed += 1
+                if self.process(item):
+                    self._seen[item.get("Id")] = created
+                else:
+                    # курсор не должен уйти дальше неотправленного элемента — повторим на следующем опросе
+                    failed = created if failed is None else min(failed, created)
+                newest = max(newest, created)
+            if len(items) < self.page_size:
+                break
+            start_index += self.page_size
+        if failed is not None:
+            newest = min(newest, failed - timedelta(seconds=1))
+        if newest > cursor:
+            self.set_cursor(newest)
+        horizon = max(newest, cursor) - timedelta(seconds=self.overlap)
+        self._seen = {key: created for key, created in self._seen.items() if created >= horizon}
+        self.polls += 1
+        self.found += processed
+        self.last_poll = time.time()
+        if processed:
+            logger.info("Jellyfin reconcile: %d items checked, cursor %s", processed, format_jellyfin_date(max(newest, cursor)))
+        return processed
+
+    def stats(self):
+        cursor = self.get_cursor()
+        return {
+            "cursor": format_jellyfin_date(cursor) if cursor else None,
+            "polls": self.polls,
+            "items": self.found,
+            "last_poll_ago": round(time.time() - self.last_poll, 1) if self.last_poll else None,
+        }
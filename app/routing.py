@@ -0,0 +1,100 @@
+from collections import namedtuple
+
+
+class Destination(namedtuple("Destination", ("chat_id", "thread_id"))):
+    """Чат Telegram и (необязательно) тема форума — message_thread_id."""
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, value):
+        """Разбирает «-100123», «-100123:45» (чат:тема) или «@channel»."""
+        chat_id, _, thread_id = str(value).strip().partition(":")
+        return cls(chat_id.strip(), thread_id.strip() or None)
+
+    def params(self):
+        """Поля запроса Telegram Bot API для этого получателя."""
+        if self.thread_id:
+            return {"chat_id": self.chat_id, "message_thread_id": self.thread_id}
+        return {"chat_id": self.chat_id}
+
+    def __str__(self):
+        return f"{self.chat_id}:{self.thread_id}" if self.thread_id else self.chat_id
+
+
+def parse_routes(spec):
+    """
+    TELEGRAM_ROUTES: правила через ";", в правиле — селекторы и получатели через "=":
+        Movie=-100111;Episode,Season=-100222:7,-100333;library:Аниме=-100444;*=-100111
+    Селектор — тип элемента (Movie, Episode, Season, Video), library:<название библиотеки Jellyfin>
+    или * (элементы, не подошедшие ни под одно другое правило). Получатель — чат или чат:тема.
+    Возвращает [(селекторы, [Destination])]; ValueError, если правило не разобрать.
+    """
+    rules = []
+    for rule in (spec or "").split(";"):
+        if not rule.strip():
+            continue
+        selectors, sep, destinations = rule.partition("=")
+        selectors = [s.strip() for s in selectors.split(",") if s.strip()]
+        destinations = [Destination.parse(d) for d in destinations.split(",") if d.strip()]
+        if not sep or not selectors or not destinations:
+            raise ValueError(f"Invalid TELEGRAM_ROUTES rule: {rule!r}")
+        rules.append((selectors, destinations))
+    return rules
+
+
+class Router:
+    """
+    Выбор получателей уведомления по правилам parse_routes. Элемент уходит во все чаты всех
+    подходящих правил (без повторов, в порядке правил); если ни одно не подошло — в правило «*»,
+    а без него — в default.
+    """
+
+    def __init__(self, rules, default=None):
+        self.types = {}
+        self.libraries = {}
+        self.fallback = []
+        for selectors, destinations in rules:
+            for selector in selectors:
+                if selector == "*":
+                    self.fallback.extend(destinations)
+                elif selector.lower().startswith("library:"):
+                    self.libraries.setdefault(selector[len("library:"):].strip().lower(), []).extend(destinations)
+                else:
+                    self.types.setdefault(selector.lower(), []).extend(destinations)
+        if not self.fallback and default is not None:
+            self.fallback = [default]
+
+    @property
+    def needs_library(self):
+        """Нужна ли библиотека элемента (есть правила library:...)."""
+        return bool(self.libraries)
+
+    def route(self, kind, library=None):
+        destinations = list(self.types.get(str(kind).lower(), ()))
+        if library:
+            destinations.extend(self.libraries.get(library.lower(), ()))
+        if not destinations:
+            destinations = list(self.fallback)
+        # без повторов, с сохранением порядка
+        return list(dict.fromkeys(destinations))
+
+    def destinations(self):
+        """Все известные получатели (для /stats и проверки конфигурации)."""
+        every = [d for group in list(self.types.values()) + list(self.libraries.values()) for d in group]
+        return list(dict.fromkeys(every + self.fallback))
+
+
+def library_of(path, libraries):
+    """
+    Библиотека Jellyfin по пути файла элемента: libraries — [(путь папки библиотеки, название)]
+    (из /Library/VirtualFolders); выбирается самая длинная совпавшая папка. None, если не нашлась.
+    """
+    if not path:
+        return None
+    best, best_len = None, -1
+    for location, name in libraries:
+        prefix = location.rstrip("/\\")
+        if (path == prefix or path.startswith(prefix + "/") or path.startswith(prefix + "\\")) and len(prefix) > best_len:
+            best, best_len = name, len(prefix)
+    return best
@@ -0,0 +1,159 @@
+import collections
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+from app import metrics
+
+logger = logging.getLogger("jellysay")
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Забирает токен (возможно, в долг) и возвращает, сколько секунд нужно подождать."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+def telegram_retry_after(resp):
+    """Достаёт parameters.retry_after из ответа 429 Telegram Bot API (или заголовка Retry-After)."""
+    try:
+        value = resp.json().get("parameters", {}).get("retry_after")
+    except Exception:
+        value = None
+    if value is None:
+        value = resp.headers.get("Retry-After") if getattr(resp, "headers", None) else None
+    try:
+        return max(1.0, float(value))
+    except (TypeError, ValueError):
+        return 1.0
+
+
+class _ChatLane:
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.tasks = collections.deque()
+        self.cond = threading.Condition()
+        self.paused_until = 0.0
+        self.started = False
+
+
+class TelegramScheduler:
+    """
+    Единая очередь исходящих запросов к Telegram.
+    Глобальный лимит и лимит на чат — token bucket'ы; на 429 ставится на паузу
+    только затронутый чат (по retry_after), порядок сообщений внутри чата сохраняется:
+    у каждого чата своя FIFO-очередь и свой поток-отправитель.
+    """
+
+    def __init__(self, global_rate=30, chat_rate_per_minute=20, chat_burst=1, max_retries=5):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_rate = chat_rate_per_minute / 60.0
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _lane(self, chat_id, start=True):
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                # после fork потоки-отправители родителя недоступны
+                self._lanes = {}
+                self._pid = pid
+            lane = self._lanes.get(chat_id)
+            if lane is None:
+                lane = _ChatLane(TokenBucket(self.chat_rate, capacity=self.chat_burst))
+                self._lanes[chat_id] = lane
+            if start and not lane.started:
+                lane.started = True
+                threading.Thread(target=self._run, args=(chat_id, lane), name=f"telegram-{chat_id}", daemon=True).start()
+            return lane
+
+    def chat_limits(self, chat_id):
+        """
+        Лимит чата (token bucket и пауза по retry_after, атрибуты bucket и paused_until) —
+        общий с AsyncTelegramScheduler(limits=...), чтобы у чата был один лимит в обоих режимах.
+        """
+        return self._lane(str(chat_id), start=False)
+
+    def submit(self, chat_id, send):
+        """
+        Ставит send() в очередь чата. send — функция без аргументов, возвращающая
+        requests.Response; вызывается повторно при 429. Возвращает Future с ответом.
+        """
+        future = Future()
+        lane = self._lane(str(chat_id))
+        # контекст вызывающего потока (correlation_id для логов) переносится в поток чата
+        context = contextvars.copy_context()
+        with lane.cond:
+            lane.tasks.append((send, future, context))
+            lane.cond.notify()
+        return future
+
+    def send(self, chat_id, send):
+        """Синхронная отправка через очередь: ждёт своей очереди и возвращает ответ."""
+        return self.submit(chat_id, send).result()
+
+    def stats(self):
+        with self._lock:
+            lanes = dict(self._lanes)
+        now = time.monotonic()
+        return {
+            chat_id: {"queued": len(lane.tasks), "paused_for": round(max(0.0, lane.paused_until - now), 1)}
+            for chat_id, lane in lanes.items()
+        }
+
+    def _run(self, chat_id, lane):
+        while True:
+            with lane.cond:
+                while not lane.tasks:
+                    lane.cond.wait()
+                send, future, context = lane.tasks.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(context.run(self._deliver, chat_id, lane, send))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _deliver(self, chat_id, lane, send):
+        attempt = 0
+        while True:
+            pause = lane.paused_until - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            lane.bucket.acquire()
+            self.global_bucket.acquire()
+            resp = send()
+            if getattr(resp, "status_code", None) != 429 or attempt >= self.max_retries:
+                return resp
+            attempt += 1
+            metrics.UPSTREAM_RETRIES.inc("telegram", "flood")
+            retry_after = telegram_retry_after(resp)
+            lane.paused_until = time.monotonic() + retry_after
+            logger.warning("Telegram flood limit for chat %s, pausing %.0fs (attempt %d)", chat_id, retry_after, attempt)
@@ -1,8 +1,11 @@
-import json
+import os
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from app.media import MediaItem, parse_body, render_template
+from app.poster_cache import from_env as poster_cache_from_env
 from app.telegram import send_telegram_message, send_telegram_photo
 from app.config import load_templates
-from app.utils import log, get_poster_url, save_poster
+from app.utils import log, get_poster_url, save_poster, set_poster_cache
 
 # Загрузка шаблонов сообщений
 templates = load_templates()
@@ -15,11 +18,17 @@ class WebhookHandler(BaseHTTPRequestHandler):
 
         try:
             # Парсинг JSON
-            payload = json.loads(post_data)
+            payload = parse_body(post_data)
+            if not isinstance(payload, dict):
+                self.send_response(400)
+                self.end_headers()
+                self.wfile.write(b"Invalid payload format")
+                return
             log(f"Получен вебхук: {payload}")
+            item = MediaItem.from_webhook(payload)
 
             # Определение типа элемента
-            item_type = payload.get("ItemType")
+            item_type = item.item_type
             if item_type not in templates:
                 self.send_response(400)
                 self.end_headers()
@@ -27,10 +36,10 @@ class WebhookHandler(BaseHTTPRequestHandler):
                 return
 
             # Формирование сообщения
-            message = templates[item_type].format(**payload)
+            message = render_template(templates[item_type], item)
 
             # Получение и отправка постера (если требуется)
-            item_id = payload.get("ItemId")
+            item_id = item.item_id
             poster_url = get_poster_url(item_id) if item_id else None
             poster_path = save_poster(item_id, poster_url) if poster_url else None
 
@@ -50,10 +59,13 @@ class WebhookHandler(BaseHTTPRequestHandler):
             self.wfile.write(b"Internal server error")
 
 def run_server(host="0.0.0.0", port=3535):
+    # тот же кеш постеров, что и у jellysay.py: каталог DATA_DIRECTORY/posters и настройки POSTER_CACHE_*
+    base_dir = Path(os.getenv("JELLYSAY_BASE_DIR", "/app"))
+    set_poster_cache(poster_cache_from_env(base_dir / "data" / "posters"))
     server = HTTPServer((host, port), WebhookHandler)
     log(f"Сервер запущен на {host}:{port}")
     server.serve_forever()
 
 if __name__ == "__main__":
     # Запуск сервера
-    run_server()
\ No newline at end of file
+    run_server(port=int(os.getenv("PORT", 3535)))
\ No newline at end of file
@@ -0,0 +1,36 @@
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # gunicorn нужен только для SERVER_MODE=gunicorn
+    BaseApplication = None
+
+
+def require_gunicorn():
+    if BaseApplication is None:
+        raise RuntimeError("This server mode requires gunicorn: pip install gunicorn")
+
+
+class _EmbeddedApplication(BaseApplication or object):
+    """Запуск gunicorn из кода с уже созданным приложением и настройками из словаря."""
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None and key in self.cfg.settings:
+                self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def run_gunicorn(application, **options):
+    """
+    Запускает gunicorn с приложением application (WSGI или aiohttp для worker_class
+    aiohttp.GunicornWebWorker). options — настройки gunicorn: bind, workers, threads,
+    worker_class, preload_app, post_fork и т.д.
+    """
+    require_gunicorn()
+    _EmbeddedApplication(application, options).run()
@@ -1,7 +1,13 @@
 import logging
-from app.config import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID
+import requests
+from app.config import TELEGRAM_API_BASE_URL, TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, NOTIFICATION_PAUSE
+from app.multipart import file_stream
+from app.scheduler import TelegramScheduler
 
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+TELEGRAM_API_URL = f"{TELEGRAM_API_BASE_URL}/bot{TELEGRAM_BOT_TOKEN}"
+
+# NOTIFICATION_PAUSE — минимальная пауза между сообщениями в чат (но не чаще лимита Telegram 20/мин)
+scheduler = TelegramScheduler(chat_rate_per_minute=min(20, 60 / NOTIFICATION_PAUSE) if NOTIFICATION_PAUSE > 0 else 20)
 
 def send_telegram_message(text):
     url = f"{TELEGRAM_API_URL}/sendMessage"
@@ -10,25 +16,23 @@ def send_telegram_message(text):
         "text": text,
         "parse_mode": "Markdown"
     }
-    response = requests.post(url, data=data)
+    response = scheduler.send(TELEGRAM_CHAT_ID, lambda: requests.post(url, data=data))
     if response.status_code != 200:
         logging.error(f"Ошибка отправки сообщения: {response.text}")
     return response
 
-def send_telegram_photo(photo_url, caption):
+def send_telegram_photo(photo_path, caption):
+    """Отправка постера из локального файла (см. app.utils.save_poster)."""
     url = f"{TELEGRAM_API_URL}/sendPhoto"
     try:
-        photo_response = requests.get(photo_url)
-        if photo_response.status_code != 200:
-            logging.warning(f"Ошибка получения изображения: {photo_response.status_code}")
-            return send_telegram_message(caption)
-        resp = requests.post(url, data={
-            'chat_id': TELEGRAM_CHAT_ID,
-            'caption': caption,
-            'parse_mode': 'Markdown'
-        }, files={
-            'photo': ('poster.jpg', photo_response.content)
-        })
+        def upload():
+            body = file_stream({
+                'chat_id': TELEGRAM_CHAT_ID,
+                'caption': caption,
+                'parse_mode': 'Markdown'
+            }, 'photo', photo_path)
+            return requests.post(url, data=body, headers={'Content-Type': body.content_type})
+        resp = scheduler.send(TELEGRAM_CHAT_ID, upload)
         if resp.status_code == 200:
             logging.info("Сообщение с фото успешно отправлено в Telegram")
         else:
@@ -0,0 +1,150 @@
+import logging
+import re
+import time
+import unicodedata
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from app.database import get_connection
+
+logger = logging.getLogger("jellysay")
+
+
+def normalize_title(title):
+    """Название для ключа кеша: без регистра, диакритики, пунктуации и лишних пробелов."""
+    text = unicodedata.normalize("NFKD", str(title or "")).casefold()
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^\w]+", " ", text).split())
+
+
+def trailer_key(title, year):
+    return f"{normalize_title(title)}|{year or ''}"
+
+
+class TrailerCache:
+    """
+    Постоянный кеш поиска трейлеров в SQLite: ключ — нормализованное название + год.
+    Хранит и найденные ссылки, и отрицательные результаты (url = NULL) — у каждой записи
+    свой срок жизни (expires_at), чтобы «не найдено» и ошибки перепроверялись раньше.
+    """
+
+    PURGE_EVERY = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._puts = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        conn = get_connection(self.path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS trailer_cache (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.commit()
+
+    def get(self, key):
+        """(True, url или None) — есть действующая запись; (False, None) — нужно искать."""
+        row = get_connection(self.path).execute(
+            "SELECT url FROM trailer_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        if row[0]:
+            self.hits += 1
+        else:
+            self.negative_hits += 1
+        return True, row[0]
+
+    def put(self, key, url, ttl):
+        conn = get_connection(self.path)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO trailer_cache (key, url, expires_at) VALUES (?, ?, ?)",
+                         (key, url, time.time() + ttl))
+        self._puts += 1
+        if self._puts >= self.PURGE_EVERY:
+            self._puts = 0
+            self.purge()
+
+    def purge(self):
+        conn = get_connection(self.path)
+        with conn:
+            deleted = conn.execute("DELETE FROM trailer_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+        if deleted:
+            logger.info("Purged %d expired trailer lookups", deleted)
+
+    def stats(self):
+        return {"hits": self.hits, "negative_hits": self.negative_hits, "misses": self.misses}
+
+
+def _pacific():
+    # квота YouTube Data API обнуляется в полночь по тихоокеанскому времени
+    try:
+        return ZoneInfo("America/Los_Angeles")
+    except ZoneInfoNotFoundError:  # в образе нет tzdata
+        return timezone(timedelta(hours=-8))
+
+
+class YouTubeQuota:
+    """
+    Учёт суточной квоты YouTube Data API (общий для всех процессов, в SQLite).
+    try_spend() атомарно списывает единицы, только если после списания останется не меньше
+    reserve; exhaust() отмечает квоту исчерпанной до конца суток (ответ 403 quotaExceeded).
+    """
+
+    def __init__(self, path, daily_budget=10000, reserve=0):
+        self.path = path
+        self.daily_budget = int(daily_budget)
+        self.reserve = int(reserve)
+        self.tz = _pacific()
+        conn = get_connection(self.path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS youtube_quota (
+                day TEXT PRIMARY KEY,
+                units INTEGER NOT NULL
+            )
+        """)
+        conn.commit()
+
+    def _today(self):
+        return datetime.now(self.tz).strftime("%Y-%m-%d")
+
+    def try_spend(self, units):
+        limit = self.daily_budget - self.reserve
+        if units > limit:
+            return False
+        conn = get_connection(self.path)
+        with conn:
+            cursor = conn.execute("""
+                INSERT INTO youtube_quota (day, units) VALUES (?, ?)
+                ON CONFLICT (day) DO UPDATE SET units = youtube_quota.units + excluded.units
+                WHERE youtube_quota.units + excluded.units <= ?
+            """, (self._today(), units, limit))
+        return cursor.rowcount == 1
+
+    def exhaust(self):
+        conn = get_connection(self.path)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO youtube_quota (day, units) VALUES (?, ?)", (self._today(), self.daily_budget))
+
+    def used(self):
+        row = get_connection(self.path).execute("SELECT units FROM youtube_quota WHERE day = ?", (self._today(),)).fetchone()
+        return row[0] if row else 0
+
+    def stats(self):
+        return {"used": self.used(), "budget": self.daily_budget, "reserve": self.reserve}
+
+
+def quota_exceeded(resp):
+    """403 YouTube с причиной quotaExceeded / dailyLimitExceeded."""
+    if getattr(resp, "status_code", None) != 403:
+        return False
+    try:
+        errors = resp.json().get("error", {}).get("errors") or []
+    except Exception:
+        return False
+    return any(e.get("reason") in ("quotaExceeded", "dailyLimitExceeded") for e in errors)
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+
+from app import metrics
+
+logger = logging.getLogger("jellysay")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(ConnectionError):
+    """Сервис считается недоступным: запрос не выполнялся (подкласс ConnectionError — срабатывают обычные fallback'и)."""
+
+
+class CircuitBreaker:
+    """
+    Автомат «предохранитель» для внешнего сервиса. После failure_threshold ошибок подряд
+    размыкается: запросы сразу получают CircuitOpen. Восстановление проверяет фоновая проба
+    (probe() раз в probe_interval секунд), а без пробы — один пробный запрос через reset_timeout.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, probe=None, probe_interval=5):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = float(reset_timeout)
+        self.probe = probe
+        self.probe_interval = float(probe_interval)
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._probe_thread = None
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.probe is None and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # единственный пробный запрос; остальные ждут его результата
+                self._set_state(HALF_OPEN)
+                return True
+            self.rejected += 1
+            return False
+
+    def available(self):
+        """Пропустит ли allow() запрос сейчас (без изменения состояния)."""
+        if self.state == CLOSED:
+            return True
+        return self.state == OPEN and self.probe is None and time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                logger.info("Upstream %s recovered, circuit closed", self.name)
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                self._open()
+
+    def record_cancelled(self):
+        """Запрос отменён (задача asyncio): не сбой, но пробный запрос HALF_OPEN завершён — следующий через reset_timeout."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._set_state(OPEN)
+                self.opened_at = time.monotonic()
+
+    def _open(self):
+        logger.warning("Upstream %s is failing (%d errors), circuit opened", self.name, self.failures)
+        self._set_state(OPEN)
+        self.opened_at = time.monotonic()
+        if self.probe is not None and (self._probe_thread is None or not self._probe_thread.is_alive()):
+            self._probe_thread = threading.Thread(target=self._probe_loop, name=f"probe-{self.name}", daemon=True)
+            self._probe_thread.start()
+
+    def _set_state(self, state):
+        self.state = state
+        metrics.CIRCUIT_TRANSITIONS.inc(self.name, state)
+
+    def _probe_loop(self):
+        while self.state == OPEN:
+            time.sleep(self.probe_interval)
+            try:
+                healthy = self.probe()
+            except Exception as e:
+                logger.debug("Upstream %s probe failed: %s", self.name, e)
+                healthy = False
+            if healthy:
+                self.record_success()
+
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+class UpstreamClient:
+    """
+    HTTP-клиент одного внешнего сервиса: свой пул соединений, таймауты (connect, read),
+    политика повторов и CircuitBreaker. Интерфейс как у requests.Session (get/post/request),
+    поэтому клиент можно передать туда, где ожидается session (например, PosterCache.fetch).
+    Ответы 5xx и любые исключения запроса считаются сбоями сервиса, 4xx — нет.
+    """
+
+    def __init__(self, name, pool_size=10, connect_timeout=3, read_timeout=10, retries=2,
+                 probe_url=None, failure_threshold=5, reset_timeout=30, probe_interval=5):
+        self.name = name
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.session = requests.Session()
+        # 429 не ретраим здесь: лимиты Telegram обрабатывает telegram_scheduler по retry_after
+        retry = metrics.MetricsRetry(total=int(retries), backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(pool_size), max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # коды ответов внешних сервисов для /metrics
+        self.session.hooks["response"].append(metrics.record_response)
+        self.probe_url = probe_url
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout,
+                                      probe=self._probe if probe_url else None, probe_interval=probe_interval)
+
+    def request(self, method, url, **kwargs):
+        if not self.breaker.allow():
+            metrics.CIRCUIT_REJECTED.inc(self.name)
+            raise CircuitOpen(f"{self.name} is unavailable (circuit open)")
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except BaseException:
+            # любое исключение, а не только ошибки соединения: иначе пробный запрос HALF_OPEN
+            # не закроет и не разомкнёт breaker, и сервис без пробы останется HALF_OPEN навсегда
+            self.breaker.record_failure()
+            raise
+        if resp.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def _probe(self):
+        resp = self.session.get(self.probe_url, timeout=self.timeout)
+        resp.close()
+        return resp.status_code < 500
+
+    def stats(self):
+        return dict(self.breaker.stats(), timeout=list(self.timeout))
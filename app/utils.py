@@ -10,14 +10,35 @@ def log(message):
 def get_poster_url(item_id):
     return f"{JELLYFIN_BASE_URL}/Items/{item_id}/Images/Primary?maxWidth=600&quality=90&X-Emby-Token={JELLYFIN_API_KEY}"
 
+# Дисковый кеш постеров (app.poster_cache.from_env: DATA_DIRECTORY/posters, настройки POSTER_CACHE_*)
+# передаётся сюда через set_poster_cache; None — кеш выключен
+poster_cache = None
+
+def set_poster_cache(cache):
+    global poster_cache
+    poster_cache = cache
+
 POSTERS_DIR = "app/posters"
 
 def save_poster(item_id, poster_url):
-    """Сохранение постера в локальную папку."""
+    """
+    Получение постера через дисковый кеш (скачивается, только если изменился).
+    Без кеша (POSTER_CACHE_MAX_MB=0) постер, как раньше, скачивается в POSTERS_DIR.
+    """
+    if poster_cache is None:
+        return download_poster(item_id, poster_url)
+    try:
+        return poster_cache.fetch(item_id, poster_url, requests)
+    except Exception as e:
+        log(f"Ошибка сохранения постера: {e}")
+        return None
+
+def download_poster(item_id, poster_url):
+    """Сохранение постера в локальную папку без кеша."""
     os.makedirs(POSTERS_DIR, exist_ok=True)
     poster_path = os.path.join(POSTERS_DIR, f"{item_id}.jpg")
     try:
-        response = requests.get(poster_url)
+        response = requests.get(poster_url, timeout=10)
         if response.status_code == 200:
             with open(poster_path, "wb") as file:
                 file.write(response.content)
@@ -27,4 +48,4 @@ def save_poster(item_id, poster_url):
             return None
     except Exception as e:
         log(f"Ошибка сохранения постера: {e}")
-        return None
\ No newline at end of file
+        return None
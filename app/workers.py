@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger("jellysay")
+
+
+class WorkerPool:
+    """
+    Ограниченная очередь задач + пул потоков-обработчиков.
+    submit() не блокирует: если очередь заполнена, возвращает False.
+    Потоки стартуют лениво при первой задаче (безопасно для fork в gunicorn).
+    """
+
+    def __init__(self, handler, workers=4, maxsize=1000, name="webhook"):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.maxsize = max(1, int(maxsize))
+        self.name = name
+        self._queue = queue.Queue(maxsize=self.maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._busy = 0
+        self._busy_time = 0.0
+        self._started_at = None
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _ensure_started(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # после fork потоки родителя не существуют — начинаем с чистого состояния
+            self._queue = queue.Queue(maxsize=self.maxsize)
+            self._threads = []
+            self._busy = 0
+            self._busy_time = 0.0
+            self._started_at = time.monotonic()
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"{self.name}-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = pid
+            logger.info("Started %d %s workers (queue size %d)", self.workers, self.name, self.maxsize)
+
+    def submit(self, task):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(task)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            with self._lock:
+                self._busy += 1
+            started = time.monotonic()
+            try:
+                self.handler(task)
+                ok = True
+            except Exception as e:
+                logger.exception("Worker failed to process task: %s", e)
+                ok = False
+            finally:
+                elapsed = time.monotonic() - started
+                with self._lock:
+                    self._busy -= 1
+                    self._busy_time += elapsed
+                    if ok:
+                        self.processed += 1
+                    else:
+                        self.failed += 1
+                self._queue.task_done()
+
+    def stats(self):
+        with self._lock:
+            uptime = (time.monotonic() - self._started_at) if self._started_at else 0.0
+            capacity = uptime * self.workers
+            return {
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self.maxsize,
+                "workers": self.workers,
+                "workers_busy": self._busy,
+                "utilisation": round(self._busy / self.workers, 3),
+                "utilisation_avg": round(self._busy_time / capacity, 3) if capacity else 0.0,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+
+class AsyncWorkerPool:
+    """То же, что WorkerPool, для asyncio: handler — корутина, обработчики — задачи в цикле событий."""
+
+    def __init__(self, handler, workers=4, maxsize=1000, name="webhook"):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.maxsize = max(1, int(maxsize))
+        self.name = name
+        self._queue = None
+        self._busy = 0
+        self._busy_time = 0.0
+        self._started_at = None
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._started_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        for _ in range(self.workers):
+            loop.create_task(self._run())
+        logger.info("Started %d async %s workers (queue size %d)", self.workers, self.name, self.maxsize)
+
+    def submit(self, task):
+        try:
+            self._queue.put_nowait(task)
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    async def _run(self):
+        while True:
+            task = await self._queue.get()
+            self._busy += 1
+            started = time.monotonic()
+            try:
+                await self.handler(task)
+                self.processed += 1
+            except Exception as e:
+                logger.exception("Worker failed to process task: %s", e)
+                self.failed += 1
+            finally:
+                self._busy -= 1
+                self._busy_time += time.monotonic() - started
+                self._queue.task_done()
+
+    def stats(self):
+        uptime = (time.monotonic() - self._started_at) if self._started_at else 0.0
+        capacity = uptime * self.workers
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "queue_capacity": self.maxsize,
+            "workers": self.workers,
+            "workers_busy": self._busy,
+            "utilisation": round(self._busy / self.workers, 3),
+            "utilisation_avg": round(self._busy_time / capacity, 3) if capacity else 0.0,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+class OutboxDispatcher:
+    """
+    Поток, разбирающий app.database.Outbox: забирает пачку готовых к отправке строк,
+    отправляет каждую через deliver(row) -> (True/False, текст ошибки) и фиксирует
+    результаты пачки одной транзакцией. Пока ready() ложно (например, Telegram недоступен
+    и circuit breaker разомкнут), строки не забираются и попытки не тратятся.
+    Полная пачка — сразу следующая, без паузы: накопленная очередь уходит с той скоростью,
+    которую позволяет очередь Telegram.
+    """
+
+    def __init__(self, outbox, deliver, ready=None, on_dead=None, interval=5, batch_size=50):
+        self.outbox = outbox
+        self.deliver = deliver
+        self.ready = ready
+        self.on_dead = on_dead
+        self.interval = float(interval)
+        self.batch_size = max(1, int(batch_size))
+        self.delivered = 0
+        self.retried = 0
+        self.dead = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _ready(self):
+        return self.ready is None or self.ready()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.drain_once()
+            except Exception as e:
+                logger.warning("Outbox dispatch failed: %s", e)
+                claimed = 0
+            if claimed < self.batch_size:
+                self._stop.wait(self.interval)
+
+    def drain_once(self):
+        """Одна пачка. Возвращает число забранных строк."""
+        if not self._ready():
+            return 0
+        rows = self.outbox.claim(self.batch_size)
+        done, failures = [], []
+        for index, row in enumerate(rows):
+            if not self._ready():
+                self.outbox.release(rows[index:])
+                break
+            try:
+                ok, error = self.deliver(row)
+            except Exception as e:
+                ok, error = False, str(e)
+            if ok:
+                done.append(row["id"])
+            else:
+                failures.append((row, error))
+        self.outbox.complete(done)
+        dead = self.outbox.retry(failures)
+        self.delivered += len(done)
+        self.retried += len(failures) - len(dead)
+        self.dead += len(dead)
+        for row in dead:
+            logger.error("Outbox: notification %s (%s) moved to dead letters after %d attempts",
+                         row["id"], row["name"], row["attempts"] + 1)
+            if self.on_dead is not None:
+                self.on_dead(row)
+        return len(rows)
+
+    def stats(self):
+        return dict(self.outbox.stats(), delivered=self.delivered, retried=self.retried, dead_lettered=self.dead)
@@ -0,0 +1,63 @@
+"""
+Сравнение двух отчётов bench.run: python -m bench.compare before.json after.json [--threshold 10]
+Код выхода 1, если какая-либо метрика ухудшилась больше чем на threshold процентов.
+"""
+import argparse
+import json
+import sys
+
+# (путь в отчёте, True — больше значит лучше)
+METRICS = (
+    (("throughput_rps",), True),
+    (("delivery_rps",), True),
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p99"), False),
+    (("delivery_duration_s",), False),
+    (("memory_kb", "after", "peak_rss"), False),
+)
+
+
+def lookup(report, path):
+    for key in path:
+        if not isinstance(report, dict):
+            return None
+        report = report.get(key)
+    return report
+
+
+def compare(before, after, threshold):
+    """Строки (метрика, было, стало, изменение в %, регрессия?)."""
+    rows = []
+    for path, higher_is_better in METRICS:
+        old, new = lookup(before, path), lookup(after, path)
+        if not old or new is None:
+            rows.append((".".join(path), old, new, None, False))
+            continue
+        change = (new - old) / old * 100
+        worse = -change if higher_is_better else change
+        rows.append((".".join(path), old, new, round(change, 1), worse > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two bench.run reports")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10, help="allowed regression, percent")
+    args = parser.parse_args(argv)
+
+    with open(args.before, "r", encoding="utf-8") as f:
+        before = json.load(f)
+    with open(args.after, "r", encoding="utf-8") as f:
+        after = json.load(f)
+
+    rows = compare(before, after, args.threshold)
+    print(f"{'metric':<28} {'before':>12} {'after':>12} {'change':>9}")
+    for name, old, new, change, regressed in rows:
+        change_text = f"{change:+.1f}%" if change is not None else "n/a"
+        print(f"{name:<28} {str(old):>12} {str(new):>12} {change_text:>9}{'  REGRESSION' if regressed else ''}")
+    sys.exit(1 if any(row[4] for row in rows) else 0)
+
+
+if __name__ == "__main__":
+    main()
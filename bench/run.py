@@ -0,0 +1,248 @@
+"""
+Нагрузочный тест вебхука: запускает заглушки Jellyfin/Telegram/YouTube, сервер (jellysay.py
+или app/server.py) в отдельном процессе, проигрывает поток вебхуков и пишет отчёт в JSON:
+пропускная способность, p50/p90/p99 времени ответа, число и скорость доставок в Telegram,
+память процесса сервера.
+
+Примеры:
+    python -m bench.run --scenario season-import --count 200 --concurrency 20
+    python -m bench.run --target server --scenario mixed --count 100
+    python -m bench.run --env WEBHOOK_ASYNC=true --telegram-latency-ms 50 --output after.json
+    python -m bench.compare before.json after.json
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+
+from bench import scenarios
+from bench.stubs import StubConfig, start_stubs, stub_env
+
+ROOT = Path(__file__).resolve().parent.parent
+
+TARGETS = {
+    "jellysay": ROOT / "jellysay.py",
+    "server": ROOT / "app" / "server.py",
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server did not start listening on port {port} within {timeout}s")
+
+
+def percentile(values, p):
+    """Процентиль по ближайшему рангу; None для пустого списка."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, math.ceil(p / 100.0 * len(values)) - 1))
+    return values[index]
+
+
+def process_memory_kb(pid):
+    """Текущий и пиковый RSS процесса (кБ) из /proc; None на системах без /proc."""
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="ascii") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    def kb(name):
+        value = fields.get(name, "").split()
+        return int(value[0]) if value else None
+    return {"rss": kb("VmRSS"), "peak_rss": kb("VmHWM")}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def start_target(target, port, env, workdir):
+    script = TARGETS[target]
+    env = dict(os.environ, **env, PORT=str(port), PYTHONPATH=str(ROOT), JELLYSAY_BASE_DIR=str(workdir))
+    if target == "server":
+        # app/server.py читает app/templates.json и пишет постеры в app/posters относительно текущей директории
+        (workdir / "app").mkdir(parents=True, exist_ok=True)
+        shutil.copy(ROOT / "app" / "templates.json", workdir / "app" / "templates.json")
+    log = open(workdir / "server.out", "wb")
+    process = subprocess.Popen([sys.executable, str(script)], cwd=str(workdir), env=env, stdout=log, stderr=subprocess.STDOUT)
+    return process, log
+
+
+def replay(url, payloads, concurrency, timeout):
+    """Отправляет вебхуки с concurrency параллельными клиентами. Возвращает [(status, секунды)]."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("http://", adapter)
+
+    def send(payload):
+        started = time.perf_counter()
+        try:
+            status = session.post(url, json=payload, timeout=timeout).status_code
+        except requests.RequestException:
+            status = 0
+        return status, time.perf_counter() - started
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(send, payloads))
+
+
+def wait_for_deliveries(telegram, quiet_period, timeout):
+    """Ждёт, пока заглушка Telegram не перестанет получать запросы (ответ 202 не означает доставку)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        last = telegram.last_request_at
+        if last is not None and time.monotonic() - last >= quiet_period:
+            return
+        if last is None and time.monotonic() + quiet_period >= deadline:
+            return
+        time.sleep(0.1)
+
+
+def run(args):
+    payloads = scenarios.load(args.scenario, args.count, args.seed)
+    stubs = start_stubs(
+        jellyfin=StubConfig(latency_ms=args.jellyfin_latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                            poster_bytes=args.poster_kb * 1024),
+        telegram=StubConfig(latency_ms=args.telegram_latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                            flood_rate=args.flood_rate, retry_after=args.retry_after),
+        youtube=StubConfig(latency_ms=args.youtube_latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate),
+    )
+    # лимиты Telegram по умолчанию сняты, чтобы измерять сам конвейер; вернуть их можно через --env
+    env = {"TELEGRAM_GLOBAL_RATE": "100000", "TELEGRAM_CHAT_RATE": "6000000", "NOTIFICATION_PAUSE": "0"}
+    env.update(stub_env(stubs))
+    env.update(dict(item.split("=", 1) for item in args.env))
+
+    workdir = Path(tempfile.mkdtemp(prefix="jellysay-bench-"))
+    port = free_port()
+    process, log = start_target(args.target, port, env, workdir)
+    try:
+        wait_for_port(port, process)
+        memory_before = process_memory_kb(process.pid)
+        started_at = time.monotonic()
+        started = time.perf_counter()
+        results = replay(f"http://127.0.0.1:{port}/webhook", payloads, args.concurrency, args.timeout)
+        duration = time.perf_counter() - started
+        wait_for_deliveries(stubs["telegram"], args.quiet_period, args.settle_timeout)
+        last_delivery = stubs["telegram"].last_request_at
+        memory_after = process_memory_kb(process.pid)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        for stub in stubs.values():
+            stub.stop()
+
+    latencies = [seconds * 1000 for _status, seconds in results]
+    status_codes = {}
+    for status, _seconds in results:
+        status_codes[str(status)] = status_codes.get(str(status), 0) + 1
+    telegram = stubs["telegram"]
+    deliveries = telegram.total("sendMessage", ok_only=True) + telegram.total("sendPhoto", ok_only=True)
+    # время доставки отсчитывается от начала отправки вебхуков до последнего запроса к Telegram
+    delivery_duration = last_delivery - started_at if last_delivery else None
+
+    report = {
+        "version": {"git": git_revision(), "python": platform.python_version()},
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "target": args.target,
+        "scenario": args.scenario,
+        "params": {
+            "count": len(payloads), "concurrency": args.concurrency, "env": dict(item.split("=", 1) for item in args.env),
+            "jellyfin": stubs["jellyfin"].config.as_dict(), "telegram": telegram.config.as_dict(),
+            "youtube": stubs["youtube"].config.as_dict(),
+        },
+        "requests": len(results),
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(results) / duration, 2) if duration else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 2) if latencies else None,
+            "p50": _round(percentile(latencies, 50)),
+            "p90": _round(percentile(latencies, 90)),
+            "p99": _round(percentile(latencies, 99)),
+            "max": _round(max(latencies) if latencies else None),
+        },
+        "status_codes": status_codes,
+        "deliveries": deliveries,
+        "delivery_duration_s": round(delivery_duration, 3) if delivery_duration else None,
+        "delivery_rps": round(deliveries / delivery_duration, 2) if delivery_duration else None,
+        "upstream": {name: stub.stats() for name, stub in stubs.items()},
+        "memory_kb": {"before": memory_before, "after": memory_after},
+    }
+    if not args.keep_workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    else:
+        report["workdir"] = str(workdir)
+    return report
+
+
+def _round(value):
+    return round(value, 2) if value is not None else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Webhook load test against local upstream stubs")
+    parser.add_argument("--target", choices=sorted(TARGETS), default="jellysay")
+    parser.add_argument("--scenario", default="season-import", help="season-import, mixed or file:<payloads.jsonl>")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra server environment")
+    parser.add_argument("--jellyfin-latency-ms", type=float, default=5)
+    parser.add_argument("--telegram-latency-ms", type=float, default=20)
+    parser.add_argument("--youtube-latency-ms", type=float, default=30)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--flood-rate", type=float, default=0, help="share of Telegram requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--poster-kb", type=int, default=60)
+    parser.add_argument("--timeout", type=float, default=120, help="webhook request timeout, seconds")
+    parser.add_argument("--quiet-period", type=float, default=2, help="no Telegram requests for this long = done")
+    parser.add_argument("--settle-timeout", type=float, default=120)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--keep-workdir", action="store_true", help="keep server logs and data")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
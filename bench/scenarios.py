@@ -0,0 +1,71 @@
+"""
+Потоки вебхуков для нагрузочных тестов. Id элементов понимает заглушка Jellyfin (bench/stubs.py).
+"""
+import json
+import random
+
+YEAR = 2026
+
+
+def episode_payload(series, season, episode):
+    return {
+        "ItemType": "Episode",
+        "ItemId": f"ep-{series}-{season}-{episode}",
+        "Name": f"Episode {episode}",
+        "Year": YEAR,
+        "SeriesName": f"Bench Show {series}",
+        "SeasonNumber00": f"{season:02d}",
+        "EpisodeNumber00": f"{episode:02d}",
+        "Overview": "Synthetic episode.",
+    }
+
+
+def movie_payload(n):
+    return {
+        "ItemType": "Movie",
+        "ItemId": f"movie-{n}",
+        "Name": f"Bench Movie {n}",
+        "Year": 2024,
+        "Overview": "Synthetic movie.",
+    }
+
+
+def season_import(count, seed=0):
+    """Импорт сезона: count эпизодов одного сезона подряд (как при сканировании библиотеки)."""
+    return [episode_payload(1, 1, episode) for episode in range(1, count + 1)]
+
+
+def mixed(count, seed=0):
+    """Смешанный поток: эпизоды нескольких сериалов, фильмы и ~10% повторных вебхуков."""
+    rng = random.Random(seed)
+    payloads = []
+    for n in range(count):
+        roll = rng.random()
+        if payloads and roll < 0.1:
+            payloads.append(dict(rng.choice(payloads)))
+        elif roll < 0.4:
+            payloads.append(movie_payload(n))
+        else:
+            payloads.append(episode_payload(rng.randint(1, 5), rng.randint(1, 3), n))
+    return payloads
+
+
+def from_file(path):
+    """JSONL-файл: по одному payload вебхука (объект JSON) на строку; пустые строки пропускаются."""
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+SCENARIOS = {
+    "season-import": season_import,
+    "mixed": mixed,
+}
+
+
+def load(name, count, seed=0):
+    """Сценарий по имени или file:<путь к JSONL>."""
+    if name.startswith("file:"):
+        return from_file(name[len("file:"):])[:count] if count else from_file(name[len("file:"):])
+    if name not in SCENARIOS:
+        raise ValueError(f"Unknown scenario: {name} (known: {', '.join(SCENARIOS)}, file:<path>)")
+    return SCENARIOS[name](count, seed)
@@ -0,0 +1,262 @@
+"""
+Заглушки внешних сервисов для нагрузочных тестов: Jellyfin (/emby/Items и постеры),
+Telegram Bot API (sendMessage/sendPhoto) и поиск YouTube.
+
+У каждой заглушки своя задержка, доля ответов 500 и (для Telegram) доля ответов 429
+с parameters.retry_after. Элементы Jellyfin генерируются по Id (см. bench/scenarios.py):
+movie-<n>, ep-<series>-<season>-<episode>, season-<series>-<season>.
+
+Запуск отдельно (например, для test.sh): python -m bench.stubs
+"""
+import argparse
+import collections
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class StubConfig:
+    """Поведение заглушки: задержка (мс, со случайным разбросом), доля ошибок 500 и 429."""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, flood_rate=0.0, retry_after=1, poster_bytes=60 * 1024):
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.error_rate = float(error_rate)
+        self.flood_rate = float(flood_rate)
+        self.retry_after = int(retry_after)
+        self.poster_bytes = int(poster_bytes)
+
+    def delay(self):
+        latency = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def fake_item(item_id):
+    """Элемент Jellyfin, построенный по синтетическому Id; None — неизвестный Id."""
+    today = datetime.now()
+    match = re.fullmatch(r"ep-(\d+)-(\d+)-(\d+)", item_id)
+    if match:
+        series, season, episode = (int(x) for x in match.groups())
+        return {
+            "Id": item_id, "Type": "Episode", "Name": f"Episode {episode}", "SeriesName": f"Bench Show {series}",
+            "SeasonId": f"season-{series}-{season}", "ParentIndexNumber": season, "IndexNumber": episode,
+            "PremiereDate": today.strftime("%Y-%m-%dT00:00:00.0000000Z"), "Overview": "Synthetic episode.",
+            "ImageTags": {"Primary": f"tag-{item_id}"},
+        }
+    match = re.fullmatch(r"season-(\d+)-(\d+)", item_id)
+    if match:
+        series, season = (int(x) for x in match.groups())
+        created = today - timedelta(days=30)
+        return {
+            "Id": item_id, "Type": "Season", "Name": f"Season {season}", "SeriesName": f"Bench Show {series}",
+            "IndexNumber": season, "DateCreated": created.strftime("%Y-%m-%dT00:00:00.0000000Z"),
+            "ImageTags": {"Primary": f"tag-{item_id}"},
+        }
+    match = re.fullmatch(r"movie-(\d+)", item_id)
+    if match:
+        return {
+            "Id": item_id, "Type": "Movie", "Name": f"Bench Movie {match.group(1)}", "ProductionYear": 2024,
+            "PremiereDate": "2024-01-01T00:00:00.0000000Z", "Overview": "Synthetic movie.",
+            "ImageTags": {"Primary": f"tag-{item_id}"},
+        }
+    return None
+
+
+class StubServer:
+    """HTTP-сервер заглушки в фоновом потоке; counts — число ответов по (путь, статус)."""
+
+    def __init__(self, name, config=None, host="127.0.0.1", port=0):
+        self.name = name
+        self.config = config or StubConfig()
+        self.counts = collections.Counter()
+        self.last_request_at = None
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"stub-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def record(self, endpoint, status):
+        with self._lock:
+            self.counts[(endpoint, status)] += 1
+            self.last_request_at = time.monotonic()
+
+    def total(self, endpoint=None, ok_only=False):
+        with self._lock:
+            return sum(n for (ep, status), n in self.counts.items()
+                       if (endpoint is None or ep == endpoint) and (not ok_only or status < 400))
+
+    def stats(self):
+        with self._lock:
+            by_endpoint = collections.defaultdict(dict)
+            for (endpoint, status), n in sorted(self.counts.items()):
+                by_endpoint[endpoint][str(status)] = n
+        return dict(by_endpoint)
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(_StubHandler):
+            pass
+
+        Handler.stub = stub
+        return Handler
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, endpoint, status, body, content_type="application/json", headers=None):
+        self.stub.record(endpoint, status)
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            size = 0
+            while True:
+                length = int(self.rfile.readline().strip() or b"0", 16)
+                if length == 0:
+                    self.rfile.readline()
+                    return size
+                size += len(self.rfile.read(length))
+                self.rfile.readline()
+        length = int(self.headers.get("Content-Length") or 0)
+        return len(self.rfile.read(length)) if length else 0
+
+    def _failure(self, endpoint):
+        """Случайная ошибка 500 по error_rate; True — ответ уже отправлен."""
+        config = self.stub.config
+        if config.error_rate and random.random() < config.error_rate:
+            self._reply(endpoint, 500, {"error": "stub failure"})
+            return True
+        return False
+
+    def do_GET(self):
+        config = self.stub.config
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        config.delay()
+
+        if parts.path.endswith("/Items") and "Ids" in query:
+            if self._failure("items"):
+                return
+            items = [fake_item(i) for i in query["Ids"][0].split(",")]
+            items = [item for item in items if item is not None]
+            return self._reply("items", 200, {"Items": items, "TotalRecordCount": len(items)})
+
+        match = re.fullmatch(r"/Items/([^/]+)/Images/Primary", parts.path)
+        if match:
+            if self._failure("poster"):
+                return
+            etag = '"' + hashlib.sha1(match.group(1).encode("utf-8")).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                return self._reply("poster", 304, b"", headers={"ETag": etag})
+            return self._reply("poster", 200, b"\xff\xd8" + b"\0" * config.poster_bytes, "image/jpeg", {"ETag": etag})
+
+        if parts.path.endswith("/search"):
+            if self._failure("search"):
+                return
+            video_id = hashlib.sha1(query.get("q", [""])[0].encode("utf-8")).hexdigest()[:11]
+            return self._reply("search", 200, {"items": [{"id": {"kind": "youtube#video", "videoId": video_id}}]})
+
+        self._reply("unknown", 404, {"error": "not found"})
+
+    def do_POST(self):
+        config = self.stub.config
+        size = self._read_body()
+        config.delay()
+        match = re.fullmatch(r"/bot[^/]+/(sendMessage|sendPhoto)", urlsplit(self.path).path)
+        if not match:
+            return self._reply("unknown", 404, {"ok": False, "description": "Not Found"})
+        method = match.group(1)
+        if config.flood_rate and random.random() < config.flood_rate:
+            return self._reply(method, 429, {
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {config.retry_after}",
+                "parameters": {"retry_after": config.retry_after},
+            })
+        if self._failure(method):
+            return
+        result = {"message_id": self.stub.total(ok_only=True) + 1, "date": int(time.time())}
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": f"stub-file-{size}", "width": 600, "height": 900}]
+        self._reply(method, 200, {"ok": True, "result": result})
+
+
+def start_stubs(jellyfin=None, telegram=None, youtube=None):
+    """Запускает три заглушки; возвращает {"jellyfin": StubServer, "telegram": ..., "youtube": ...}."""
+    return {
+        "jellyfin": StubServer("jellyfin", jellyfin).start(),
+        "telegram": StubServer("telegram", telegram).start(),
+        "youtube": StubServer("youtube", youtube).start(),
+    }
+
+
+def stub_env(stubs):
+    """Переменные окружения, направляющие jellysay (и app/server.py) на заглушки."""
+    return {
+        "JELLYFIN_BASE_URL": stubs["jellyfin"].url,
+        "JELLYFIN_API_KEY": "bench",
+        "TELEGRAM_API_URL": stubs["telegram"].url,
+        "TELEGRAM_BOT_TOKEN": "bench",
+        "TELEGRAM_CHAT_ID": "1",
+        "YOUTUBE_API_URL": stubs["youtube"].url + "/youtube/v3",
+        "YOUTUBE_API_KEY": "bench",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Jellyfin/Telegram/YouTube stubs until interrupted")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--flood-rate", type=float, default=0)
+    args = parser.parse_args()
+    config = StubConfig(latency_ms=args.latency_ms, error_rate=args.error_rate)
+    stubs = start_stubs(config, StubConfig(latency_ms=args.latency_ms, error_rate=args.error_rate, flood_rate=args.flood_rate), config)
+    for key, value in stub_env(stubs).items():
+        print(f"{key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for stub in stubs.values():
+            stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,47 +3,110 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 from datetime import datetime, timedelta
 import os
+import re
 import json
 from pathlib import Path
 from dotenv import load_dotenv
 import sys
+import atexit
+import asyncio
 import threading
-import tempfile
+import time
+import contextvars
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
 # Попытка импортировать      с понятным логом при ошибке
 try:
-    import requests
     from requests.exceptions import HTTPError, RequestException
-    from requests.adapters import HTTPAdapter
-    from urllib3.util.retry import Retry
 except Exception as e:
     print(f"Critical: cannot import requests: {e}", file=sys.stderr)
     raise
 
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify, make_response
+
+from app import aio, metrics
+from app.coalesce import Coalescer, format_number_range
+from app.database import Outbox
+from app.digest import CAPTION_LIMIT, DigestScheduler, DigestStore, digest_poster, digest_posters, format_digest
+from app.dedup import create_dedup_store, migrate_json_file
+from app.jellyfin import ItemNotFound, JellyfinItems, TTLCache
+from app.media import FORM_CONTENT_TYPES, MediaItem, first_item, parse_body
+from app.logs import PayloadLogPolicy, correlation_id, log_stage, new_correlation_id, setup_async_logging
+from app.multipart import MultipartStream, file_stream
+from app.poster_cache import PosterTooLarge, iter_limited, max_image_bytes_from_env
+from app.poster_cache import from_env as poster_cache_from_env
+from app.poster_index import PosterIndex, photo_file_id
+from app.profiling import RequestProfiler
+from app.reconcile import Reconciler
+from app.routing import Destination, Router, library_of, parse_routes
+from app.scheduler import TelegramScheduler
+from app.serving import run_gunicorn
+from app.trailers import TrailerCache, YouTubeQuota, quota_exceeded, trailer_key
+from app.upstream import CircuitOpen, UpstreamClient
+from app.workers import AsyncWorkerPool, OutboxDispatcher, WorkerPool
 
 load_dotenv()
 
-app = Flask(__name__)
+# При импорте модуль только читает настройки. Директории, лог, хранилища на диске
+# создаёт configure() (один раз, в том числе в мастер-процессе gunicorn до fork),
+# HTTP-сессию, очереди и кеши процесса — init_process() (лениво, в каждом воркере).
 
 # Пути и директории
 BASE_DIR = Path(os.getenv("JELLYSAY_BASE_DIR", "/app"))
 LOG_DIRECTORY = BASE_DIR / "log"
 DATA_DIRECTORY = BASE_DIR / "data"
-LOG_DIRECTORY.mkdir(parents=True, exist_ok=True)
-DATA_DIRECTORY.mkdir(parents=True, exist_ok=True)
 NOTIFIED_ITEMS_FILE = DATA_DIRECTORY / "notified_items.json"
+DATABASE_FILE = DATA_DIRECTORY / "jellysay.db"
 
-# Логирование
+# Логирование: запись в файл выполняется в отдельном потоке (QueueListener),
+# LOG_FORMAT=json — одна JSON-запись на строку с correlation_id вебхука
 log_filename = LOG_DIRECTORY / "jellyfin_telegram-notifier.log"
 logger = logging.getLogger("jellysay")
 logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-rotating_handler = TimedRotatingFileHandler(str(log_filename), when="midnight", interval=1, backupCount=7, encoding="utf-8")
-rotating_handler.setFormatter(formatter)
-logger.addHandler(rotating_handler)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+
+# Тело вебхука в логе: off, sample (доля LOG_PAYLOAD_SAMPLE_RATE) или full, не длиннее LOG_PAYLOAD_MAX_CHARS
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "sample").lower()
+try:
+    LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+    LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "2000"))
+except ValueError:
+    LOG_PAYLOAD_SAMPLE_RATE = 0.1
+    LOG_PAYLOAD_MAX_CHARS = 2000
+payload_log_policy = PayloadLogPolicy(LOG_PAYLOADS, LOG_PAYLOAD_SAMPLE_RATE, LOG_PAYLOAD_MAX_CHARS)
+
+# Профилирование вебхуков: доля PROFILE_SAMPLE_RATE запросов под cProfile (.pstats на запрос),
+# длительности этапов запросов дольше PROFILE_SLOW_MS (.json) — в DATA_DIRECTORY/profiles,
+# не больше PROFILE_KEEP файлов. По умолчанию выключено; включается и на лету через POST /profile
+try:
+    PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+    PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+except ValueError:
+    PROFILE_SAMPLE_RATE = 0
+    PROFILE_SLOW_MS = 0
+    PROFILE_KEEP = 100
+# Токен для POST /profile (заголовок X-Admin-Token); пусто — менять настройки можно только через окружение
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+profiler = RequestProfiler(DATA_DIRECTORY / "profiles", PROFILE_SAMPLE_RATE, PROFILE_SLOW_MS, keep=PROFILE_KEEP)
+
+# Маршрутизация уведомлений по чатам и темам форумов (app.routing.parse_routes), например
+# TELEGRAM_ROUTES="Movie=-100111;Episode,Season=-100222:7;library:Аниме=-100333;*=-100111".
+# Без правил (и для элементов, не подошедших ни под одно) — TELEGRAM_CHAT_ID
+TELEGRAM_ROUTES = os.getenv("TELEGRAM_ROUTES", "")
+router = None  # configure()
+# Потоки рассылки по остальным получателям: отдельно от enrich_pool — отправки, ждущие лимита
+# Telegram или паузы retry_after, не должны занимать потоки сбора данных для новых вебхуков
+try:
+    FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "8"))
+except ValueError:
+    FANOUT_WORKERS = 8
+fanout_pool = None  # init_process()
+
+# Обязательные переменные окружения (проверяются в configure()); с TELEGRAM_ROUTES чат по умолчанию не обязателен
+REQUIRED_ENV = ("TELEGRAM_BOT_TOKEN", "JELLYFIN_BASE_URL", "JELLYFIN_API_KEY") + (() if TELEGRAM_ROUTES else ("TELEGRAM_CHAT_ID",))
 
-# Проверка обязательных переменных окружения
 def require_env(name):
     value = os.getenv(name)
     if not value:
@@ -51,11 +114,15 @@ def require_env(name):
         raise SystemExit(1)
     return value
 
-TELEGRAM_BOT_TOKEN = require_env("TELEGRAM_BOT_TOKEN")
-TELEGRAM_CHAT_ID = require_env("TELEGRAM_CHAT_ID")
-JELLYFIN_BASE_URL = require_env("JELLYFIN_BASE_URL")
-JELLYFIN_API_KEY = require_env("JELLYFIN_API_KEY")
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "")
+DEFAULT_DESTINATION = Destination.parse(TELEGRAM_CHAT_ID) if TELEGRAM_CHAT_ID else None
+JELLYFIN_BASE_URL = os.getenv("JELLYFIN_BASE_URL", "")
+JELLYFIN_API_KEY = os.getenv("JELLYFIN_API_KEY", "")
 YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY", "")
+# Адреса API (переопределяются для тестовых заглушек, см. bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+YOUTUBE_API_URL = os.getenv("YOUTUBE_API_URL", "https://www.googleapis.com/youtube/v3").rstrip("/")
 try:
     EPISODE_PREMIERED_WITHIN_X_DAYS = int(os.getenv("EPISODE_PREMIERED_WITHIN_X_DAYS", "7"))
     SEASON_ADDED_WITHIN_X_DAYS = int(os.getenv("SEASON_ADDED_WITHIN_X_DAYS", "3"))
@@ -63,55 +130,158 @@ except ValueError:
     EPISODE_PREMIERED_WITHIN_X_DAYS = 7
     SEASON_ADDED_WITHIN_X_DAYS = 3
 
-# Requests: сессия + ретраи + таймаут
-DEFAULT_TIMEOUT = 10
-session = requests.Session()
-retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
-session.mount("https://", HTTPAdapter(max_retries=retries))
-session.mount("http://", HTTPAdapter(max_retries=retries))
+# Асинхронная обработка вебхуков: ответ 202 сразу, работа — в пуле потоков
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "false").lower() in ("1", "true", "yes")
+try:
+    WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+    WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+    WEBHOOK_RETRY_AFTER = int(os.getenv("WEBHOOK_RETRY_AFTER", "5"))
+except ValueError:
+    WEBHOOK_WORKERS = 4
+    WEBHOOK_QUEUE_SIZE = 1000
+    WEBHOOK_RETRY_AFTER = 5
 
-# Работа с notified_items — потокобезопасно
-_notified_lock = threading.Lock()
+# Окно склейки эпизодов одного сезона в одно сообщение (секунды, 0 — выключено)
+try:
+    EPISODE_COALESCE_WINDOW = float(os.getenv("EPISODE_COALESCE_WINDOW", "0"))
+except ValueError:
+    EPISODE_COALESCE_WINDOW = 0
 
-def load_notified_items():
-    with _notified_lock:
-        if NOTIFIED_ITEMS_FILE.exists():
-            try:
-                return json.loads(NOTIFIED_ITEMS_FILE.read_text(encoding="utf-8"))
-            except Exception as e:
-                logger.error("Cannot read notified items file: %s", e)
-                return {}
-        return {}
+# Сбор данных для уведомления (детали, сезон, трейлер, постер) выполняется параллельно.
+# Срок на уведомление (мс, 0 — без срока): что не успело к нему — трейлер, постер — не ждём
+try:
+    NOTIFICATION_DEADLINE_MS = int(os.getenv("NOTIFICATION_DEADLINE_MS", "5000"))
+    ENRICH_WORKERS = int(os.getenv("ENRICH_WORKERS", "32"))
+except ValueError:
+    NOTIFICATION_DEADLINE_MS = 5000
+    ENRICH_WORKERS = 32
+enrich_pool = None  # init_process(): потоки параллельных запросов у каждого процесса свои
+
+# HTTP-клиенты внешних сервисов: у каждого свой пул соединений, таймауты (connect, read),
+# число повторов и circuit breaker — при недоступности сервиса запросы сразу получают ошибку,
+# а уведомление уходит без постера/трейлера. Настройки: JELLYFIN_POOL_SIZE, TELEGRAM_READ_TIMEOUT и т.д.
+UPSTREAM_DEFAULTS = {
+    "jellyfin": {"POOL_SIZE": 20, "CONNECT_TIMEOUT": 3.0, "READ_TIMEOUT": 10.0, "RETRIES": 2},
+    "telegram": {"POOL_SIZE": 10, "CONNECT_TIMEOUT": 5.0, "READ_TIMEOUT": 30.0, "RETRIES": 2},
+    "youtube": {"POOL_SIZE": 4, "CONNECT_TIMEOUT": 3.0, "READ_TIMEOUT": 5.0, "RETRIES": 1},
+}
 
-def save_notified_items(data):
-    with _notified_lock:
+def upstream_settings(name):
+    settings = {}
+    for key, default in UPSTREAM_DEFAULTS[name].items():
         try:
-            # атомарная запись
-            with tempfile.NamedTemporaryFile("w", delete=False, dir=str(DATA_DIRECTORY), encoding="utf-8") as tmp:
-                json.dump(data, tmp, ensure_ascii=False, indent=None)
-                tmp_path = Path(tmp.name)
-            tmp_path.replace(NOTIFIED_ITEMS_FILE)
-        except Exception as e:
-            logger.exception("Failed to save notified items: %s", e)
+            settings[key.lower()] = type(default)(float(os.getenv(f"{name.upper()}_{key}", str(default))))
+        except ValueError:
+            settings[key.lower()] = default
+    return settings
 
-notified_items = load_notified_items()
+# Circuit breaker: сколько ошибок подряд размыкают цепь, через сколько секунд пробовать снова
+# (для YouTube — одним пробным запросом) и как часто фоновая проба проверяет Jellyfin/Telegram
+try:
+    BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+    BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+    BREAKER_PROBE_INTERVAL = float(os.getenv("BREAKER_PROBE_INTERVAL", "5"))
+except ValueError:
+    BREAKER_FAILURE_THRESHOLD = 5
+    BREAKER_RESET_TIMEOUT = 30
+    BREAKER_PROBE_INTERVAL = 5
+
+def upstream_stats():
+    return {client.name: client.stats() for client in (jellyfin_http, telegram_http, youtube_http)}
+
+def create_upstream_client(name, probe_url=None):
+    return UpstreamClient(name, probe_url=probe_url, failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                          reset_timeout=BREAKER_RESET_TIMEOUT, probe_interval=BREAKER_PROBE_INTERVAL,
+                          **upstream_settings(name))
+
+# init_process(): пулы соединений не должны переживать fork
+jellyfin_http = None
+telegram_http = None
+youtube_http = None
+
+# Лимиты Telegram: ~30 сообщений/с глобально, ~20 сообщений/мин в группу
+try:
+    TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+    TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "20"))
+except ValueError:
+    TELEGRAM_GLOBAL_RATE = 30
+    TELEGRAM_CHAT_RATE = 20
+telegram_scheduler = None  # init_process(): потоки очередей чатов у каждого процесса свои
+
+# Отправленные уведомления: индексированное хранилище с TTL вместо notified_items.json
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "sqlite")
+try:
+    DEDUP_TTL_DAYS = int(os.getenv("DEDUP_TTL_DAYS", "365"))
+    # через сколько секунд незавершённая заявка на отправку считается зависшей
+    DEDUP_CLAIM_TIMEOUT = int(os.getenv("DEDUP_CLAIM_TIMEOUT", "600"))
+except ValueError:
+    DEDUP_TTL_DAYS = 365
+    DEDUP_CLAIM_TIMEOUT = 600
+dedup_store = None  # configure()
+
+# Outbox: уведомления, не доставленные из-за временной ошибки Telegram (сеть, 429, 5xx),
+# сохраняются в таблицу webhooks и отправляются повторно с экспоненциальной задержкой
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "true").lower() in ("1", "true", "yes")
+try:
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+    OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "30"))
+    OUTBOX_MAX_DELAY = float(os.getenv("OUTBOX_MAX_DELAY", "3600"))
+    OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+except ValueError:
+    OUTBOX_MAX_ATTEMPTS = 10
+    OUTBOX_RETRY_DELAY = 30
+    OUTBOX_MAX_DELAY = 3600
+    OUTBOX_POLL_INTERVAL = 5
+    OUTBOX_BATCH_SIZE = 50
+outbox = None  # configure()
+outbox_dispatcher = None  # init_process()
+
+# Дайджест: вместо отправки сразу новые элементы (после дедупликации и фильтров по датам) копятся
+# в таблице digest_items и раз в DIGEST_INTERVAL секунд (0 — выключено, уведомления уходят сразу)
+# отправляются одним-несколькими сообщениями, сгруппированными по фильмам и сериалам
+try:
+    DIGEST_INTERVAL = float(os.getenv("DIGEST_INTERVAL", "0"))
+    DIGEST_POLL_INTERVAL = float(os.getenv("DIGEST_POLL_INTERVAL", "60"))
+except ValueError:
+    DIGEST_INTERVAL = 0
+    DIGEST_POLL_INTERVAL = 60
+# Оформление дайджеста: photo — постер у первого сообщения (если текст помещается в подпись),
+# media_group — перед каждым сообщением альбом постеров его элементов (sendMediaGroup, до 10)
+DIGEST_FORMAT = os.getenv("DIGEST_FORMAT", "photo").lower()
+digest_store = None  # configure()
+digest_scheduler = None  # init_process()
 
 def item_key(item_type, item_name, release_year):
     return f"{item_type}:{item_name}:{release_year}"
 
 def item_already_notified(item_type, item_name, release_year):
-    return item_key(item_type, item_name, release_year) in notified_items
-
-def mark_item_as_notified(item_type, item_name, release_year, max_entries=100):
-    key = item_key(item_type, item_name, release_year)
-    with _notified_lock:
-        notified_items[key] = True
-        if len(notified_items) > max_entries:
-            # удаляем самый старый ключ (порядок вставки сохраняется в Python 3.7+)
-            oldest_key = next(iter(notified_items))
-            notified_items.pop(oldest_key, None)
-            logger.info("Key '%s' removed from notified_items", oldest_key)
-        save_notified_items(notified_items)
+    return dedup_store.contains(item_key(item_type, item_name, release_year))
+
+def claim_item(item_type, item_name, release_year):
+    """Атомарно заявляет отправку уведомления; False — его уже отправил или отправляет другой процесс."""
+    return dedup_store.claim(item_key(item_type, item_name, release_year))
+
+def release_item(item_type, item_name, release_year):
+    """Снимает заявку без отправки (элемент пропущен фильтрами)."""
+    dedup_store.release(item_key(item_type, item_name, release_year))
+
+def mark_item_as_notified(item_type, item_name, release_year):
+    dedup_store.mark_sent(item_key(item_type, item_name, release_year))
+
+def mark_item_as_failed(item_type, item_name, release_year):
+    dedup_store.mark_failed(item_key(item_type, item_name, release_year))
+
+# Индекс file_id постеров, уже загруженных в Telegram
+poster_index = None  # configure()
+
+# Дисковый кеш постеров (DATA_DIRECTORY/posters, настройки POSTER_CACHE_* — app.poster_cache.from_env);
+# app/server.py строит такой же кеш в том же каталоге
+POSTER_MAX_BYTES = max_image_bytes_from_env()
+# POSTER_CACHE_MAX_MB=0 — без кеша, постер передаётся из Jellyfin в Telegram напрямую потоком
+poster_cache = None  # configure()
+# Публичный адрес Jellyfin: если задан, Telegram скачивает постеры сам
+JELLYFIN_PUBLIC_URL = os.getenv("JELLYFIN_PUBLIC_URL", "").rstrip("/")
 
 # Утилиты
 def parse_date_only(date_str):
@@ -138,38 +308,154 @@ def is_not_within_last_x_days(date_str, x):
         return True
     return dt < (datetime.now() - timedelta(days=x))
 
+# Path — для определения библиотеки элемента (правила library: в TELEGRAM_ROUTES)
+ITEM_FIELDS = "DateCreated,Overview,PremiereDate,Path"
+
+def fetch_items(item_ids):
+    """Один запрос к Jellyfin за несколькими элементами сразу: {Id: item}."""
+    url = f"{JELLYFIN_BASE_URL}/emby/Items"
+    params = {"api_key": JELLYFIN_API_KEY, "Recursive": "true", "Fields": ITEM_FIELDS, "Ids": ",".join(item_ids)}
+    resp = jellyfin_http.get(url, headers={"accept": "application/json"}, params=params)
+    resp.raise_for_status()
+    return {item.get("Id"): item for item in resp.json().get("Items", [])}
+
+def season_episodes_params(season_id):
+    return {"api_key": JELLYFIN_API_KEY, "ParentId": season_id, "IncludeItemTypes": "Episode", "Recursive": "true",
+            "Fields": ITEM_FIELDS, "SortBy": "IndexNumber"}
+
+def fetch_libraries():
+    """Папки библиотек Jellyfin: [(путь, название библиотеки)]."""
+    resp = jellyfin_http.get(f"{JELLYFIN_BASE_URL}/Library/VirtualFolders", headers={"accept": "application/json"},
+                             params={"api_key": JELLYFIN_API_KEY})
+    resp.raise_for_status()
+    return library_locations(resp.json())
+
+def library_locations(folders):
+    return [(location, folder.get("Name")) for folder in folders or [] for location in folder.get("Locations") or []]
+
+def get_libraries():
+    libraries = libraries_cache.get("libraries")
+    if libraries is None:
+        libraries = fetch_libraries()
+        libraries_cache.set("libraries", libraries)
+    return libraries
+
+def fetch_season_episodes(season_id):
+    """Все эпизоды сезона одним запросом ParentId=; эпизоды попадают в кеш элементов Jellyfin."""
+    url = f"{JELLYFIN_BASE_URL}/emby/Items"
+    resp = jellyfin_http.get(url, headers={"accept": "application/json"}, params=season_episodes_params(season_id))
+    resp.raise_for_status()
+    episodes = resp.json().get("Items", [])
+    jellyfin_items.prime(episodes)
+    return episodes
+
+# Кеш элементов Jellyfin + склейка одновременных запросов в один Ids=a,b,c
+try:
+    JELLYFIN_CACHE_TTL = int(os.getenv("JELLYFIN_CACHE_TTL", "300"))
+    JELLYFIN_CACHE_SIZE = int(os.getenv("JELLYFIN_CACHE_SIZE", "2000"))
+    JELLYFIN_BATCH_WINDOW_MS = int(os.getenv("JELLYFIN_BATCH_WINDOW_MS", "5"))
+except ValueError:
+    JELLYFIN_CACHE_TTL = 300
+    JELLYFIN_CACHE_SIZE = 2000
+    JELLYFIN_BATCH_WINDOW_MS = 5
+jellyfin_items = None  # init_process()
+libraries_cache = None  # init_process(): список библиотек Jellyfin (на JELLYFIN_CACHE_TTL)
+
 def get_item_details(item_id):
-    url = f"{JELLYFIN_BASE_URL}/emby/Items?Recursive=true&Fields=DateCreated,Overview,PremiereDate&Ids={item_id}"
     try:
-        resp = session.get(url, headers={"accept": "application/json"}, params={"api_key": JELLYFIN_API_KEY}, timeout=DEFAULT_TIMEOUT)
-        resp.raise_for_status()
-        return resp.json()
-    except RequestException as e:
+        return {"Items": [jellyfin_items.get(item_id)], "TotalRecordCount": 1}
+    except (RequestException, ItemNotFound) as e:
         logger.exception("Error fetching item details %s: %s", item_id, e)
         raise
 
-def get_youtube_trailer_url(query):
+# Кеш поиска трейлеров (в т.ч. «не найдено») и суточная квота YouTube Data API (поиск — 100 единиц)
+try:
+    TRAILER_CACHE_TTL_DAYS = int(os.getenv("TRAILER_CACHE_TTL_DAYS", "30"))
+    TRAILER_NEGATIVE_TTL_HOURS = int(os.getenv("TRAILER_NEGATIVE_TTL_HOURS", "24"))
+    TRAILER_ERROR_TTL = int(os.getenv("TRAILER_ERROR_TTL", "900"))
+    YOUTUBE_DAILY_QUOTA = int(os.getenv("YOUTUBE_DAILY_QUOTA", "10000"))
+    YOUTUBE_QUOTA_RESERVE = int(os.getenv("YOUTUBE_QUOTA_RESERVE", "500"))
+    YOUTUBE_SEARCH_COST = int(os.getenv("YOUTUBE_SEARCH_COST", "100"))
+except ValueError:
+    TRAILER_CACHE_TTL_DAYS = 30
+    TRAILER_NEGATIVE_TTL_HOURS = 24
+    TRAILER_ERROR_TTL = 900
+    YOUTUBE_DAILY_QUOTA = 10000
+    YOUTUBE_QUOTA_RESERVE = 500
+    YOUTUBE_SEARCH_COST = 100
+trailer_cache = None  # configure()
+youtube_quota = None  # configure()
+
+def trailer_search_params(title, year):
+    return {"part": "snippet", "q": f"{title} Trailer {year}", "type": "video", "key": YOUTUBE_API_KEY, "maxResults": "1"}
+
+def cached_trailer(key):
+    """
+    Проверка перед поиском: (True, url) — ответ уже известен (кеш, в том числе отрицательный,
+    или квота на сегодня исчерпана — тогда url None); (False, None) — нужен запрос к YouTube.
+    """
+    found, url = trailer_cache.get(key)
+    if found:
+        metrics.TRAILER_LOOKUPS.inc("hit" if url else "negative_hit")
+        return True, url
+    if not youtube_http.breaker.available():
+        # YouTube недоступен: не тратим квоту и не ждём таймаута
+        metrics.CIRCUIT_REJECTED.inc("youtube")
+        metrics.TRAILER_LOOKUPS.inc("circuit_open")
+        return True, None
+    if not youtube_quota.try_spend(YOUTUBE_SEARCH_COST):
+        logger.info("YouTube quota budget reached, skipping trailer search: %s", key)
+        metrics.TRAILER_LOOKUPS.inc("quota_skipped")
+        return True, None
+    return False, None
+
+def store_trailer_result(key, resp):
+    """Разбирает ответ поиска YouTube и кеширует результат (или «не найдено»)."""
+    if quota_exceeded(resp):
+        logger.warning("YouTube quota exceeded, trailer search disabled until the quota resets")
+        youtube_quota.exhaust()
+        metrics.TRAILER_LOOKUPS.inc("quota_exceeded")
+        return None
+    resp.raise_for_status()
+    video_id = (resp.json().get("items") or [{}])[0].get("id", {}).get("videoId")
+    trailer = f"https://www.youtube.com/watch?v={video_id}" if video_id else None
+    ttl = TRAILER_CACHE_TTL_DAYS * 86400 if trailer else TRAILER_NEGATIVE_TTL_HOURS * 3600
+    trailer_cache.put(key, trailer, ttl)
+    metrics.TRAILER_LOOKUPS.inc("found" if trailer else "not_found")
+    return trailer
+
+def store_trailer_error(key, e):
+    logger.warning("YouTube search failed: %s", e)
+    if isinstance(e, CircuitOpen):
+        return
+    # ошибку тоже запоминаем ненадолго, чтобы повторные вебхуки не ждали YouTube
+    trailer_cache.put(key, None, TRAILER_ERROR_TTL)
+    metrics.TRAILER_LOOKUPS.inc("error")
+
+def get_youtube_trailer_url(title, year):
+    """Ссылка на трейлер фильма: из кеша, иначе поиск YouTube (если позволяет квота)."""
     if not YOUTUBE_API_KEY:
         return None
-    url = "https://www.googleapis.com/youtube/v3/search"
-    params = {"part": "snippet", "q": query, "type": "video", "key": YOUTUBE_API_KEY, "maxResults": 1}
+    key = trailer_key(title, year)
+    done, trailer = cached_trailer(key)
+    if done:
+        return trailer
     try:
-        resp = session.get(url, params=params, timeout=DEFAULT_TIMEOUT)
-        resp.raise_for_status()
-        data = resp.json()
-        video_id = data.get("items", [{}])[0].get("id", {}).get("videoId")
-        return f"https://www.youtube.com/watch?v={video_id}" if video_id else None
-    except RequestException as e:
-        logger.warning("YouTube search failed: %s", e)
+        resp = youtube_http.get(f"{YOUTUBE_API_URL}/search", params=trailer_search_params(title, year))
+        return store_trailer_result(key, resp)
+    except (RequestException, ValueError) as e:
+        store_trailer_error(key, e)
         return None
 
 def get_poster_url(item_id):
     return f"{JELLYFIN_BASE_URL}/Items/{item_id}/Images/Primary?maxWidth=600&quality=90&X-Emby-Token={JELLYFIN_API_KEY}"
 
-def send_telegram_message(text):
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+def send_telegram_message(text, destination=None):
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    destination = destination or DEFAULT_DESTINATION
     try:
-        resp = session.post(url, data={"chat_id": TELEGRAM_CHAT_ID, "text": text, "parse_mode": "Markdown"}, timeout=DEFAULT_TIMEOUT)
+        data = dict(destination.params(), text=text, parse_mode="Markdown")
+        resp = telegram_send(lambda: telegram_http.post(url, data=data), destination)
         resp.raise_for_status()
         logger.info("Telegram message sent")
         return resp
@@ -177,227 +463,1576 @@ def send_telegram_message(text):
         logger.error("Telegram send message failed: %s", e)
         return None
 
-def send_telegram_photo(photo_url_or_id, caption):
+def get_public_poster_url(item_id, image_tag=None):
+    """URL постера на публичном адресе Jellyfin (без API-ключа) — Telegram скачает его сам."""
+    url = f"{JELLYFIN_PUBLIC_URL}/Items/{item_id}/Images/Primary?maxWidth=600&quality=90"
+    return f"{url}&tag={image_tag}" if image_tag else url
+
+def telegram_send(send, destination):
+    """Отправка через telegram_scheduler (очередь чата destination); время (с ожиданием в очереди) идёт в этап telegram_send."""
+    with metrics.STAGE_SECONDS.time("telegram_send"):
+        return telegram_scheduler.send(destination.chat_id, send)
+
+def _send_photo_reference(url, data, photo, destination):
+    """sendPhoto со ссылкой на фото (file_id или URL) вместо загрузки байтов."""
+    return telegram_send(lambda: telegram_http.post(url, data=dict(data, photo=photo)), destination)
+
+def send_telegram_photo(photo_url_or_id, caption, image_tag=None, destination=None):
     """
-    Надёжно скачивает постер через session и отправляет в Telegram.
+    Надёжно скачивает постер через jellyfin_http и отправляет в Telegram.
+    Если для (id, image_tag) уже известен file_id Telegram — отправляет его без загрузки;
+    если задан JELLYFIN_PUBLIC_URL — передаёт Telegram публичную ссылку на постер.
+    Иначе постер передаётся потоком (из дискового кеша или напрямую из Jellyfin),
+    без чтения изображения в память целиком.
     В случае ошибок — логирует и делает fallback: отправляет текстовое сообщение.
+    destination — получатель (app.routing.Destination), по умолчанию TELEGRAM_CHAT_ID.
     """
+    destination = destination or DEFAULT_DESTINATION
     if not photo_url_or_id:
-        return send_telegram_message(caption)
+        return send_telegram_message(caption, destination)
 
     # Если аргумент — не URL, формируем Jellyfin Primary URL
-    photo_url = photo_url_or_id if str(photo_url_or_id).startswith("http") else get_poster_url(photo_url_or_id)
+    is_url = str(photo_url_or_id).startswith("http")
+    photo_url = photo_url_or_id if is_url else get_poster_url(photo_url_or_id)
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
+    data = dict(destination.params(), caption=caption, parse_mode="Markdown")
+
+    file_id = None if is_url else poster_index.get(photo_url_or_id, image_tag)
+    if file_id:
+        try:
+            resp = _send_photo_reference(url, data, file_id, destination)
+            if resp.ok:
+                logger.info("Telegram photo sent by file_id (status=%s)", resp.status_code)
+                return resp
+            # file_id отклонён Telegram — забываем его и загружаем постер заново
+            logger.warning("Telegram rejected cached file_id: %s %s", resp.status_code, resp.text)
+            poster_index.forget(photo_url_or_id)
+        except RequestException as e:
+            logger.warning("Telegram send photo by file_id failed: %s", e)
+
+    if JELLYFIN_PUBLIC_URL and not is_url:
+        try:
+            resp = _send_photo_reference(url, data, get_public_poster_url(photo_url_or_id, image_tag), destination)
+            if resp.ok:
+                logger.info("Telegram photo sent by public URL (status=%s)", resp.status_code)
+                poster_index.put(photo_url_or_id, image_tag, photo_file_id(resp))
+                return resp
+            logger.warning("Telegram could not fetch public poster URL: %s %s", resp.status_code, resp.text)
+        except RequestException as e:
+            logger.warning("Telegram send photo by public URL failed: %s", e)
 
     try:
-        logger.debug("Downloading poster from %s", photo_url)
-        img_resp = session.get(photo_url, timeout=DEFAULT_TIMEOUT)
-        img_resp.raise_for_status()
-        if not img_resp.content:
-            logger.warning("Poster response is empty: %s", photo_url)
-            return send_telegram_message(caption)
-
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
-        files = {"photo": ("poster.jpg", img_resp.content)}
-        data = {"chat_id": TELEGRAM_CHAT_ID, "caption": caption, "parse_mode": "Markdown"}
-
-        resp = session.post(url, data=data, files=files, timeout=DEFAULT_TIMEOUT)
+        if poster_cache is not None:
+            logger.debug("Fetching poster from %s", photo_url)
+            with metrics.STAGE_SECONDS.time("poster_download"):
+                poster_path = poster_cache.fetch(photo_url_or_id, photo_url, jellyfin_http, timeout=jellyfin_http.timeout)
+            if not poster_path:
+                logger.warning("Poster response is empty: %s", photo_url)
+                return send_telegram_message(caption, destination)
+
+            def upload():
+                body = file_stream(data, "photo", poster_path)
+                return telegram_http.post(url, data=body, headers={"Content-Type": body.content_type})
+        else:
+            def upload():
+                # без кеша: тело ответа Jellyfin сразу уходит в запрос к Telegram (chunked)
+                logger.debug("Streaming poster from %s", photo_url)
+                with jellyfin_http.get(photo_url, stream=True) as img_resp:
+                    img_resp.raise_for_status()
+                    body = MultipartStream(data, "photo", "poster.jpg", lambda: iter_limited(img_resp, POSTER_MAX_BYTES))
+                    return telegram_http.post(url, data=body, headers={"Content-Type": body.content_type})
+
+        resp = telegram_send(upload, destination)
         try:
             resp.raise_for_status()
             logger.info("Telegram photo sent (status=%s)", resp.status_code)
+            if not is_url:
+                poster_index.put(photo_url_or_id, image_tag, photo_file_id(resp))
         except RequestException:
             logger.error("Telegram send photo failed: %s %s", getattr(resp, "status_code", None), getattr(resp, "text", None))
         return resp
 
-    except RequestException as e:
+    except (RequestException, PosterTooLarge) as e:
         # Логируем детально при ошибке подключения к Jellyfin или Telegram
         logger.warning("Ошибка сохранения постера: %s", e)
         # fallback: отправляем обычное текстовое сообщение
         try:
-            return send_telegram_message(caption)
+            return send_telegram_message(caption, destination)
         except Exception as ex:
             logger.exception("Fallback send_telegram_message failed: %s", ex)
             return None
 
-def process_payload(payload):
+def send_photo_by_file_id(file_id, photo_url_or_id, caption, image_tag, destination):
+    """Отправка уже загруженного в Telegram фото; если file_id не принят — обычная отправка."""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
+    try:
+        resp = _send_photo_reference(url, dict(destination.params(), caption=caption, parse_mode="Markdown"), file_id, destination)
+        if resp.ok:
+            return resp
+        logger.warning("Telegram rejected file_id for %s: %s %s", destination, resp.status_code, resp.text)
+    except RequestException as e:
+        logger.warning("Telegram send photo by file_id to %s failed: %s", destination, e)
+    return send_telegram_photo(photo_url_or_id, caption, image_tag, destination)
+
+def send_telegram_photos(photo_url_or_id, caption, image_tag, destinations):
     """
-    Нормализует payload, безопасно извлекает season/episode номера с fallback'ами,
-    определяет тип элемента и отправляет уведомление.
-    Возвращает (dict, status_code).
+    Отправляет уведомление всем получателям: первому — как обычно (с загрузкой постера),
+    остальным — параллельно по file_id из ответа первого. Возвращает [(получатель, ответ)].
+    Порядок сообщений внутри каждого чата держит telegram_scheduler (своя очередь у чата).
     """
-    logger.info("Получен вебхук: %s", payload)
+    first, rest = destinations[0], destinations[1:]
+    resp = send_telegram_photo(photo_url_or_id, caption, image_tag, first)
+    responses = [(first, resp)]
+    if not rest:
+        return responses
+    file_id = photo_file_id(resp) if resp is not None and resp.ok and photo_url_or_id else None
 
-    item_id = payload.get("ItemId")
-    details = None
-    if item_id:
+    def send(destination):
+        if file_id:
+            return send_photo_by_file_id(file_id, photo_url_or_id, caption, image_tag, destination)
+        return send_telegram_photo(photo_url_or_id, caption, image_tag, destination)
+
+    futures = [(destination, fanout_pool.submit(contextvars.copy_context().run, send, destination)) for destination in rest]
+    for destination, future in futures:
         try:
-            details = get_item_details(item_id)
+            responses.append((destination, future.result()))
         except Exception as e:
-            logger.warning("Не удалось получить details для ItemId=%s: %s", item_id, e)
-            details = None
-
-    # Получаем тип (Jellyfin detail -> Items[0].Type) или из payload
-    resolved_type = None
-    if details and isinstance(details, dict):
-        resolved_type = details.get("Items", [{}])[0].get("Type")
-    resolved_type = (resolved_type or payload.get("ItemType") or payload.get("Type") or "Video")
-
-    # Год/уникальный ключ для notified_items
-    release_year = payload.get("Year") or ""
-    if not release_year and details:
+            logger.error("Telegram send to %s failed: %s", destination, e)
+            responses.append((destination, None))
+    return responses
+
+def media_group_plan(photos):
+    """
+    Постеры альбома [(id изображения, image_tag)] -> [(id, image_tag, ссылка)]: ссылка — известный
+    file_id или публичный URL постера, None — постер нужно загрузить (attach://).
+    """
+    plan = []
+    for image_id, image_tag in photos:
+        reference = poster_index.get(image_id, image_tag)
+        if not reference and JELLYFIN_PUBLIC_URL:
+            reference = get_public_poster_url(image_id, image_tag)
+        plan.append((image_id, image_tag, reference))
+    return plan
+
+def media_group_fields(destination, plan, paths):
+    """Поля запроса sendMediaGroup и загружаемые файлы {имя: путь}; paths — пути постеров без ссылки."""
+    media, files, sent = [], {}, []
+    for image_id, image_tag, reference in plan:
+        if reference is None:
+            if not paths.get(image_id):
+                continue
+            reference = f"attach://poster{len(files)}"
+            files[reference[len("attach://"):]] = paths[image_id]
+        media.append({"type": "photo", "media": reference})
+        sent.append((image_id, image_tag))
+    return dict(destination.params(), media=json.dumps(media)), files, sent
+
+def remember_media_group(sent, resp):
+    """file_id постеров альбома из ответа sendMediaGroup (result — сообщения в порядке альбома)."""
+    try:
+        messages = resp.json().get("result")
+    except ValueError:
+        return
+    if not isinstance(messages, list):
+        return
+    for (image_id, image_tag), message in zip(sent, messages):
+        sizes = message.get("photo") or []
+        if sizes:
+            poster_index.put(image_id, image_tag, sizes[-1].get("file_id"))
+
+def send_telegram_media_group(photos, destinations):
+    """
+    Альбом постеров без подписей (sendMediaGroup) в каждый чат destinations — оформление дайджеста.
+    Постеры передаются по file_id или публичному URL, остальные загружаются из кеша постеров
+    (без кеша и JELLYFIN_PUBLIC_URL такие постеры пропускаются); после первого чата загруженные
+    постеры уже известны по file_id. Ошибка только логируется. Возвращает [(получатель, ответ или None)].
+    """
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMediaGroup"
+    responses = []
+    for destination in destinations:
+        resp = None
         try:
-            prod = details.get("Items", [{}])[0].get("ProductionYear")
-            if prod:
-                release_year = str(prod)
-            else:
-                prem = details.get("Items", [{}])[0].get("PremiereDate", "")
-                if prem:
-                    release_year = prem.split("T")[0].split("-")[0]
-        except Exception:
-            release_year = ""
+            plan = media_group_plan(photos)
+            paths = {}
+            for image_id, _image_tag, reference in plan:
+                if reference is None and poster_cache is not None:
+                    with metrics.STAGE_SECONDS.time("poster_download"):
+                        paths[image_id] = poster_cache.fetch(image_id, get_poster_url(image_id), jellyfin_http,
+                                                             timeout=jellyfin_http.timeout)
+            data, files, sent = media_group_fields(destination, plan, paths)
+            if len(sent) >= 2:
+                def upload():
+                    with ExitStack() as stack:
+                        uploads = {name: ("poster.jpg", stack.enter_context(open(path, "rb")), "image/jpeg")
+                                   for name, path in files.items()}
+                        return telegram_http.post(url, data=data, files=uploads or None)
+                resp = telegram_send(upload, destination)
+                resp.raise_for_status()
+                remember_media_group(sent, resp)
+                logger.info("Telegram media group sent to %s: %d photos", destination, len(sent))
+        except (RequestException, PosterTooLarge) as e:
+            logger.warning("Telegram send media group to %s failed: %s", destination, e)
+            resp = None
+        responses.append((destination, resp))
+    return responses
 
-    unique_key = release_year or item_id or str(payload.get("Timestamp") or "")
+def prefetch_poster(item_id):
+    """
+    Заранее скачивает постер в дисковый кеш (параллельно с остальными запросами), чтобы
+    send_telegram_photo взял его из кеша. Ничего не делает, если кеш выключен, Telegram
+    скачивает постеры сам (JELLYFIN_PUBLIC_URL) или для изображения уже есть file_id.
+    """
+    if poster_cache is None or JELLYFIN_PUBLIC_URL or poster_index.known(item_id):
+        return None
+    with metrics.STAGE_SECONDS.time("poster_download"):
+        return poster_cache.fetch(item_id, get_poster_url(item_id), jellyfin_http, timeout=jellyfin_http.timeout)
 
-    # Имя и сериал
-    name = payload.get("Name") or (details.get("Items", [{}])[0].get("Name") if details else "Unknown")
-    series_name = payload.get("SeriesName") or (details.get("Items", [{}])[0].get("SeriesName") if details else "")
+DELIVERY_FAILED = ({"status": "error", "message": "Telegram delivery failed"}, 502)
+DEFERRED = ({"status": "ok", "message": "Delivery deferred"}, 202)
 
-    # Безопасный извлечение номера сезона/эпизода с множеством fallback'ов
-    def first_non_empty(*vals):
-        for v in vals:
-            if v is None:
-                continue
-            # допускаем 0 как валидное значение, поэтому проверяем на пустую строку и None
-            if isinstance(v, (int, float)) or (isinstance(v, str) and v.strip() != ""):
-                return str(v)
-        return ""
-
-    season_num = first_non_empty(
-        payload.get("SeasonNumber00"),
-        payload.get("SeasonNumber"),
-        payload.get("ParentIndexNumber"),
-        payload.get("SeasonIndex"),
-        (details.get("Items", [{}])[0].get("ParentIndexNumber") if details else None),
-        (details.get("Items", [{}])[0].get("SeasonNumber") if details else None)
-    )
+def retryable(resp):
+    """Временная ошибка доставки: нет ответа, 429 или 5xx (4xx — ошибка в самом сообщении)."""
+    return resp is None or resp.status_code == 429 or resp.status_code >= 500
 
-    episode_num = first_non_empty(
-        payload.get("EpisodeNumber00"),
-        payload.get("EpisodeNumber"),
-        payload.get("IndexNumber"),
-        payload.get("EpisodeIndex"),
-        (details.get("Items", [{}])[0].get("IndexNumber") if details else None)
-    )
+def defer_delivery(keys, photo, caption, image_tag, resp, destination=None):
+    """
+    Сохраняет недоставленное получателю destination из-за временной ошибки уведомление в outbox
+    для повторной отправки в фоне. keys — [(тип, имя, год)] элементов уведомления.
+    """
+    if outbox is None or not retryable(resp):
+        return False
+    item_type, name = keys[0][0], keys[0][1]
+    error = f"HTTP {resp.status_code}" if resp is not None else "no response"
+    row_id = outbox.add(photo, item_type, name, caption, image_tag, dedup_keys=[item_key(*key) for key in keys], error=error,
+                        destination=destination)
+    logger.warning("Telegram delivery to %s failed (%s), notification deferred to outbox #%s: %s",
+                   destination or TELEGRAM_CHAT_ID, error, row_id, name)
+    return True
 
-    overview = payload.get("Overview") or (details.get("Items", [{}])[0].get("Overview") if details else "")
+def settle_delivery(keys, responses, photo, caption, image_tag):
+    """
+    Итог отправки уведомления всем получателям (responses — [(получатель, ответ)]):
+    "notified" — хотя бы один чат принял сообщение, "deferred" — не принял ни один, но есть
+    отложенные в outbox (недоставленное из-за временной ошибки уходит в outbox по каждому чату
+    отдельно), иначе "delivery_failed". Элементы keys отмечаются отправленными, если сообщение
+    доставлено или отложено хотя бы для одного чата (иначе повторный вебхук продублировал бы его
+    в чатах, которые его уже получили), и неотправленными — если доставить не удалось никуда.
+    """
+    delivered = any(resp is not None and resp.ok for _destination, resp in responses)
+    failed = [(destination, resp) for destination, resp in responses if resp is None or not resp.ok]
+    deferred = [destination for destination, resp in failed if defer_delivery(keys, photo, caption, image_tag, resp, destination)]
+    for destination, resp in failed:
+        if destination not in deferred:
+            logger.error("Telegram delivery to %s failed: %s", destination, getattr(resp, "status_code", "no response"))
+    if delivered or deferred:
+        for key in keys:
+            mark_item_as_notified(*key)
+        return "notified" if delivered else "deferred"
+    for key in keys:
+        mark_item_as_failed(*key)
+    return "delivery_failed"
+
+def delivery_result(kind, name, unique_key, responses, photo, caption, image_tag, notified):
+    """Итог отправки по заявке: уведомлено, отложено в outbox или ошибка доставки."""
+    outcome = settle_delivery([(kind, name, unique_key)], responses, photo, caption, image_tag)
+    if outcome == "notified":
+        return {"status": "ok", "message": notified}, 200
+    if outcome == "deferred":
+        return DEFERRED
+    return DELIVERY_FAILED
+
+def deliver_deferred(row):
+    """Повторная отправка уведомления из outbox (OutboxDispatcher)."""
+    token = correlation_id.set(new_correlation_id())
+    try:
+        logger.info("Outbox: retrying notification #%s (attempt %d): %s", row["id"], row["attempts"] + 1, row["name"])
+        destination = Destination.parse(row["destination"]) if row["destination"] else None
+        resp = send_telegram_photo(row["item_id"] or None, row["caption"], row["image_tag"], destination)
+    finally:
+        correlation_id.reset(token)
+    if resp is not None and resp.ok:
+        return True, None
+    return False, f"HTTP {resp.status_code}" if resp is not None else "no response"
+
+def dead_lettered(row):
+    # уведомление так и не доставлено — следующий вебхук для этих элементов сможет отправить его снова
+    for key in json.loads(row["dedup_keys"] or "[]"):
+        dedup_store.mark_failed(key)
+
+# Обработка вебхука описана шагами-генераторами без ввода-вывода: шаг отдаёт (yield)
+# запрос к внешнему сервису и получает его результат (или исключение). Выполняет
+# запросы драйвер — run_steps (синхронно) или run_steps_async (asyncio), поэтому
+# логика принятия решений одна и та же в обоих режимах сервера.
+ITEM = "item"        # (ITEM, item_id) -> get_item_details
+SEASON = "season"    # (SEASON, season_id) -> get_item_details (отдельный этап в логах и метриках)
+TRAILER = "trailer"  # (TRAILER, title, year) -> get_youtube_trailer_url
+PHOTO = "photo"      # (PHOTO, photo_url_or_id, caption, image_tag, destinations) -> send_telegram_photos: [(получатель, ответ)]
+LIBRARIES = "libraries"  # (LIBRARIES,) -> get_libraries (для правил library: в TELEGRAM_ROUTES)
+POSTER = "poster"    # (POSTER, item_id) -> prefetch_poster
+EPISODES = "episodes"  # (EPISODES, season_id) -> fetch_season_episodes (все эпизоды сезона одним запросом)
+MEDIA_GROUP = "media_group"  # (MEDIA_GROUP, [(image_id, image_tag)], destinations) -> send_telegram_media_group
+# (ENRICH, required, optional, deadline) -> список результатов (или исключений) вызовов required + optional,
+# выполненных параллельно; optional, не успевшие к deadline (time.monotonic()), — DeadlineExceeded
+ENRICH = "enrich"
+
+class DeadlineExceeded(Exception):
+    """Необязательный запрос не успел к сроку уведомления (NOTIFICATION_DEADLINE_MS)."""
+
+def enrichment_calls(payload):
+    """
+    Обязательные запросы по данным вебхука (детали элемента и сезона, эпизоды сезона, библиотеки) —
+    нужны для дедупликации, фильтров и маршрута, выполняются параллельно до принятия решения.
+    """
+    item_id = payload.get("ItemId")
+    payload_type = str(payload.get("ItemType") or payload.get("Type") or "").lower()
+    required = []
+    if item_id:
+        required.append((ITEM, item_id))
+    if payload_type == "episode" and payload.get("SeasonId"):
+        required.append((SEASON, payload["SeasonId"]))
+    if payload_type == "season" and item_id:
+        required.append((EPISODES, item_id))
+    if router.needs_library and item_id:
+        required.append((LIBRARIES,))
+    return required
+
+def optional_calls(item):
+    """
+    Необязательные запросы — трейлер и постер. Запрашиваются только для элемента, который точно
+    будет отправлен (после дедупликации и фильтров по датам): дубликаты и отфильтрованные вебхуки
+    не тратят квоту YouTube и не скачивают постеры.
+    """
+    optional = []
+    if item.kind == "Movie" and YOUTUBE_API_KEY:
+        optional.append((TRAILER,) + trailer_query(item.name, item.year))
+    # эпизоды при склейке и элементы дайджеста отправляются позже — постер для них заранее не качаем
+    if item.item_id and digest_store is None and not (item.kind == "Episode" and episode_coalescer is not None):
+        optional.append((POSTER, item.item_id))
+    return optional
+
+def fetch_optional(item, deadline):
+    """Шаги: необязательные запросы параллельно, со сроком deadline. Возвращает {вызов: результат или исключение}."""
+    optional = optional_calls(item)
+    if not optional:
+        return {}
+    results = yield (ENRICH, [], optional, deadline)
+    return dict(zip(optional, results))
+
+def trailer_query(name, release_year):
+    """(название без года, год) — аргументы поиска трейлера."""
+    clean_name = name.replace(f" ({release_year})", "").strip() if release_year else name
+    return clean_name, release_year
+
+def dropped(result, part):
+    """True, если необязательная часть не получена к сроку или с ошибкой (тогда уведомление уходит без неё)."""
+    if not isinstance(result, Exception):
+        return False
+    logger.info("Уведомление отправляется без части %s: %s", part, str(result) or type(result).__name__)
+    metrics.ENRICHMENT_DROPPED.inc(part, "deadline" if isinstance(result, DeadlineExceeded) else "error")
+    return True
 
-    # Дубликат?
-    if item_already_notified(resolved_type, name, unique_key):
-        logger.info("Уведомление уже отправлено: %s %s %s", resolved_type, name, unique_key)
+def notification_steps(payload):
+    """
+    Нормализует payload вместе с деталями Jellyfin в MediaItem (app.media),
+    определяет тип элемента и отправляет уведомление.
+    Генератор шагов (см. выше); результат — (dict, status_code).
+    """
+    logger.info("Получен вебхук: %s %s (ItemId=%s)", payload.get("ItemType") or payload.get("Type"), payload.get("Name"),
+                payload.get("ItemId"), extra={"event": "webhook", "item_type": payload.get("ItemType"), "item_id": payload.get("ItemId")})
+
+    item_id = payload.get("ItemId")
+    # эпизод сезона, о котором уже объявлено, — пропускаем без запросов к Jellyfin
+    if str(payload.get("ItemType") or payload.get("Type") or "").lower() == "episode" and season_announced(payload.get("SeasonId")):
+        logger.info("Сезон уже объявлен, пропускаем уведомление об эпизоде: %s", payload.get("Name"))
+        return SEASON_ANNOUNCED
+
+    # дешёвая проверка до запросов к Jellyfin: дубликат по данным самого вебхука
+    # (если вебхук без Name/Year, ключ уточнится по деталям и заявка ниже поймает дубликат)
+    webhook_item = MediaItem.from_webhook(payload)
+    if payload.get("Name") and item_already_notified(webhook_item.kind, webhook_item.name, webhook_item.unique_key):
+        logger.info("Уведомление уже отправлено: %s %s %s", webhook_item.item_type, webhook_item.name, webhook_item.unique_key)
+        return {"status": "ok", "message": "Already notified"}, 200
+
+    deadline = time.monotonic() + NOTIFICATION_DEADLINE_MS / 1000.0 if NOTIFICATION_DEADLINE_MS > 0 else None
+    required = enrichment_calls(payload)
+    prefetched = {}
+    if required:
+        results = yield (ENRICH, required, [], None)
+        prefetched = dict(zip(required, results))
+
+    details = prefetched.get((ITEM, item_id))
+    if isinstance(details, Exception):
+        logger.warning("Не удалось получить details для ItemId=%s: %s", item_id, details)
+        details = None
+
+    # Один проход нормализации: дальше работаем только с атрибутами item
+    item = MediaItem.from_webhook(payload, first_item(details))
+    kind, name, unique_key = item.kind, item.name, item.unique_key
+    if kind == "Episode" and season_announced(*season_keys(item)):
+        logger.info("Сезон уже объявлен, пропускаем уведомление об эпизоде: %s", name)
+        return SEASON_ANNOUNCED
+
+    destinations = route_item(item, prefetched.get((LIBRARIES,)))
+    if not destinations:
+        logger.info("Нет получателей для %s %s (TELEGRAM_ROUTES), пропуск", kind, name)
+        return NO_DESTINATION
+
+    # Дубликат? Заявка атомарна и общая для всех процессов
+    if not claim_item(kind, name, unique_key):
+        logger.info("Уведомление уже отправлено: %s %s %s", item.item_type, name, unique_key)
         return {"status": "ok", "message": "Already notified"}, 200
 
     try:
         # Movie
-        if resolved_type and resolved_type.lower() == "movie":
-            clean_name = name.replace(f" ({release_year})", "").strip() if release_year else name
-            message = f"*🍿 Добавлен новый фильм*\n\n*{clean_name}* ({release_year})\n\n{overview}"
-            trailer = get_youtube_trailer_url(f"{clean_name} Trailer {release_year}") if YOUTUBE_API_KEY else None
+        if kind == "Movie":
+            prefetched.update((yield from fetch_optional(item, deadline)))
+            clean_name, _year = trailer_query(name, item.year)
+            message = f"*🍿 Добавлен новый фильм*\n\n*{clean_name}* ({item.year})\n\n{item.overview}"
+            trailer = None
+            if YOUTUBE_API_KEY:
+                trailer_call = (TRAILER, clean_name, item.year)
+                if trailer_call in prefetched:
+                    trailer = prefetched[trailer_call]
+                    if dropped(trailer, "trailer"):
+                        trailer = None
+                else:
+                    trailer = yield trailer_call
+            if digest_store is not None:
+                return add_to_digest(item, destinations, trailer)
             if trailer:
                 message += f"\n\n[Трейлер]({trailer})"
-            send_telegram_photo(item_id, message)
-            mark_item_as_notified("Movie", name, unique_key)
-            return {"status": "ok", "message": "Movie notified"}, 200
+            photo = poster_source(prefetched, item_id)
+            responses = yield (PHOTO, photo, message, item.image_tag, destinations)
+            return delivery_result(kind, name, unique_key, responses, photo, message, item.image_tag, "Movie notified")
 
-        # Episode (учитываем разные форматы)
-        if resolved_type and resolved_type.lower() == "episode":
-            premiere = None
-            try:
-                premiere = (details.get("Items", [{}])[0].get("PremiereDate") or "").split("T")[0] if details else None
-            except Exception:
-                premiere = None
+        # Season: одно уведомление со списком эпизодов; последующие вебхуки эпизодов сезона пропускаются
+        if kind == "Season":
+            announce_season(item)
+            prefetched.update((yield from fetch_optional(item, deadline)))
+            episodes = prefetched.get((EPISODES, item_id), [])
+            if isinstance(episodes, Exception):
+                logger.warning("Не удалось получить эпизоды сезона %s: %s", item_id, episodes)
+                episodes = []
+            numbers = [episode_number(episode) for episode in episodes]
+            if digest_store is not None:
+                # в дайджесте номер эпизода сезона — диапазон его эпизодов
+                item.episode_number = format_number_range(numbers)
+                return add_to_digest(item, destinations)
+            message = season_message(item, episodes, numbers)
+            photo = poster_source(prefetched, item_id)
+            responses = yield (PHOTO, photo, message, item.image_tag, destinations)
+            result = delivery_result(kind, name, unique_key, responses, photo, message, item.image_tag, "Season notified")
+            if result == DELIVERY_FAILED:
+                forget_season(item)
+            return result
 
+        # Episode (учитываем разные форматы)
+        if kind == "Episode":
             # проверка возраста сезона (если доступна)
             try:
-                season_id = payload.get("SeasonId") or (details.get("Items", [{}])[0].get("SeasonId") if details else None)
                 season_date_created = None
-                if season_id:
-                    sdet = get_item_details(season_id)
-                    season_date_created = sdet.get("Items", [{}])[0].get("DateCreated", "").split("T")[0]
+                if item.season_id:
+                    key = (SEASON, item.season_id)
+                    sdet = prefetched[key] if key in prefetched else (yield key)
+                    if isinstance(sdet, Exception):
+                        raise sdet
+                    season = first_item(sdet)
+                    season_date_created = (season.get("DateCreated") or "").split("T")[0]
+                    item.season_image_tag = (season.get("ImageTags") or {}).get("Primary")
                 if season_date_created and not is_not_within_last_x_days(season_date_created, SEASON_ADDED_WITHIN_X_DAYS):
                     logger.info("Сезон добавлен недавно, пропускаем уведомление об эпизоде: %s", name)
+                    release_item(kind, name, unique_key)
                     return {"status": "ok", "message": "Season added recently, skipped"}, 200
             except Exception:
                 logger.debug("Не удалось получить дату создания сезона — продолжаем")
 
             # проверка премьеры эпизода
-            if premiere and not is_within_last_x_days(premiere, EPISODE_PREMIERED_WITHIN_X_DAYS):
+            if item.premiere_date and not is_within_last_x_days(item.premiere_date, EPISODE_PREMIERED_WITHIN_X_DAYS):
                 logger.info("Эпизод премьеровался раньше порога, пропуск: %s", name)
+                release_item(kind, name, unique_key)
                 return {"status": "ok", "message": "Episode too old, skipped"}, 200
 
-            s = season_num or "?"
-            e = episode_num or "?"
-            message = f"*🎬 Добавлен новый эпизод*\n\n*Сериал*: {series_name}\nСезон: {s}  Эпизод: {e}\n*Название*: {name}\n\n{overview}"
-            send_telegram_photo(item_id or season_id, message)
-            mark_item_as_notified("Episode", name, unique_key)
-            return {"status": "ok", "message": "Episode notified"}, 200
+            prefetched.update((yield from fetch_optional(item, deadline)))
+            if digest_store is not None:
+                return add_to_digest(item, destinations)
+            s = item.season_number or "?"
+            e = item.episode_number or "?"
+            if episode_coalescer is not None:
+                if not episode_coalescer.add((item.series_name, s, tuple(destinations)), item, dedup_key=(name, unique_key)):
+                    logger.info("Эпизод уже ожидает отправки: %s", name)
+                    return {"status": "ok", "message": "Already notified"}, 200
+                return {"status": "ok", "message": "Episode queued for coalescing"}, 200
+
+            message = f"*🎬 Добавлен новый эпизод*\n\n*Сериал*: {item.series_name}\nСезон: {s}  Эпизод: {e}\n*Название*: {name}\n\n{item.overview}"
+            photo = poster_source(prefetched, item_id) if item_id else item.season_id
+            photo_tag = item.image_tag if item_id else item.season_image_tag
+            responses = yield (PHOTO, photo, message, photo_tag, destinations)
+            return delivery_result(kind, name, unique_key, responses, photo, message, photo_tag, "Episode notified")
 
         # Fallback — generic video
-        message = f"*Добавлен новый медиафайл*\n\n*{name}*\n\n{overview}"
-        send_telegram_photo(item_id, message)
-        mark_item_as_notified("Video", name, unique_key)
-        return {"status": "ok", "message": "Generic video notified"}, 200
+        prefetched.update((yield from fetch_optional(item, deadline)))
+        if digest_store is not None:
+            return add_to_digest(item, destinations)
+        message = f"*Добавлен новый медиафайл*\n\n*{name}*\n\n{item.overview}"
+        photo = poster_source(prefetched, item_id)
+        responses = yield (PHOTO, photo, message, item.image_tag, destinations)
+        return delivery_result(kind, name, unique_key, responses, photo, message, item.image_tag, "Generic video notified")
 
     except Exception as e:
         logger.exception("Ошибка при обработке payload в process_payload: %s", e)
+        mark_item_as_failed(kind, name, unique_key)
         return {"status": "error", "message": str(e)}, 500
 
 
+SEASON_ANNOUNCED = ({"status": "ok", "message": "Season announced, episode skipped"}, 200)
+NO_DESTINATION = ({"status": "ok", "message": "No destination, skipped"}, 200)
+
+def route_item(item, libraries):
+    """Получатели уведомления по TELEGRAM_ROUTES: по типу элемента и (если нужны) по его библиотеке."""
+    library = None
+    if router.needs_library:
+        if isinstance(libraries, Exception):
+            logger.warning("Не удалось получить библиотеки Jellyfin, маршрут только по типу: %s", libraries)
+        elif libraries:
+            library = library_of(item.path, libraries)
+    return router.route(item.kind, library)
+announced_seasons = None  # init_process(): TTLCache сезонов, о которых уже отправлено уведомление
+
+def season_number_key(number):
+    # "01" и 1 — один и тот же сезон
+    return str(int(number)) if number.isdigit() else number
+
+def season_keys(item):
+    """Ключи индекса объявленных сезонов: Id сезона и (сериал, номер сезона) — для вебхуков без SeasonId."""
+    keys = []
+    if item.season_id:
+        keys.append(str(item.season_id))
+    if item.series_name and item.season_number:
+        keys.append((item.series_name, season_number_key(item.season_number)))
+    return keys
+
+def season_announced(*keys):
+    return announced_seasons is not None and any(key and announced_seasons.get(key) for key in keys)
+
+def announce_season(item):
+    for key in season_keys(item):
+        announced_seasons.set(key, True)
+
+def forget_season(item):
+    for key in season_keys(item):
+        announced_seasons.pop(key)
+
+def episode_number(episode):
+    number = episode.get("IndexNumber")
+    return str(number) if number is not None else "?"
+
+def season_message(item, episodes, numbers):
+    series_name = item.series_name or item.name
+    message = f"*📺 Добавлен новый сезон*\n\n*Сериал*: {series_name}\nСезон: {item.season_number or '?'}"
+    if numbers:
+        message += f"  Эпизоды: {format_number_range(numbers)}"
+    if item.overview:
+        message += f"\n\n{item.overview}"
+    lines = "\n".join(f"{number}. {episode.get('Name') or ''}" for number, episode in zip(numbers, episodes))
+    # подпись к фото в Telegram ограничена 1024 символами
+    if lines and len(message) + len(lines) + 2 <= 1024:
+        message += f"\n\n{lines}"
+    return message
+
+def poster_source(prefetched, item_id):
+    """item_id для PHOTO или None (отправить текстом), если постер не скачался к сроку уведомления."""
+    if item_id and dropped(prefetched.get((POSTER, item_id)), "poster"):
+        return None
+    return item_id
+
+def coalesced_steps(key, episodes):
+    """Отправляет эпизоды одного сезона (MediaItem), накопленные за окно склейки, одним сообщением (генератор шагов)."""
+    series_name, s, destinations = key
+    if len(episodes) == 1:
+        ep = episodes[0]
+        message = f"*🎬 Добавлен новый эпизод*\n\n*Сериал*: {series_name}\nСезон: {s}  Эпизод: {ep.episode_number or '?'}\n*Название*: {ep.name}\n\n{ep.overview}"
+        if ep.item_id:
+            photo, tag = ep.item_id, ep.image_tag
+        else:
+            photo, tag = ep.season_id, ep.season_image_tag
+    else:
+        def sort_key(ep):
+            return int(ep.episode_number) if ep.episode_number.isdigit() else 0
+        episodes = sorted(episodes, key=sort_key)
+        lines = "\n".join(f"{ep.episode_number or '?'}. {ep.name}" for ep in episodes)
+        episode_range = format_number_range([ep.episode_number or "?" for ep in episodes])
+        message = f"*🎬 Добавлены новые эпизоды*\n\n*Сериал*: {series_name}\nСезон: {s}  Эпизоды: {episode_range}"
+        # подпись к фото в Telegram ограничена 1024 символами
+        if len(message) + len(lines) + 2 <= 1024:
+            message += f"\n\n{lines}"
+        first = episodes[0]
+        if first.season_id:
+            photo, tag = first.season_id, first.season_image_tag
+        else:
+            photo, tag = first.item_id, first.image_tag
+        logger.info("Склеено %d эпизодов в одно уведомление: %s, сезон %s", len(episodes), series_name, s)
+    responses = yield (PHOTO, photo, message, tag, list(destinations))
+    keys = [("Episode", ep.name, ep.unique_key) for ep in episodes]
+    outcome = settle_delivery(keys, responses, photo, message, tag)
+    metrics.OUTCOMES.inc(outcome, amount=len(keys))
+
+
+def add_to_digest(item, destinations, trailer=None):
+    """
+    Откладывает уведомление в дайджест. Элемент сразу отмечается отправленным (заявка в хранилище
+    дедупликации истекла бы раньше отправки дайджеста); при ошибке отправки отметка снимается.
+    """
+    row_id = digest_store.add(item, destinations, trailer)
+    mark_item_as_notified(item.kind, item.name, item.unique_key)
+    logger.info("Добавлено в дайджест #%s: %s %s", row_id, item.kind, item.name)
+    return {"status": "ok", "message": "Added to digest"}, 200
+
+def digest_steps(rows, done=None):
+    """
+    Отправляет накопленный дайджест (генератор шагов). Элементы с одинаковым набором получателей
+    собираются в общий дайджест. DIGEST_FORMAT=photo: постер — только у первого сообщения, если
+    подпись помещается; media_group: перед сообщением — альбом постеров его элементов.
+    done(строки) вызывается после каждого сообщения, доставленного, отложенного в outbox или
+    отклонённого Telegram (DigestScheduler сразу убирает их из накопителя); строки сообщения,
+    не доставленного из-за временной ошибки при выключенном outbox, остаются в накопителе.
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(row["destinations"] or "", []).append(row)
+    for destinations, group in groups.items():
+        destinations = [Destination.parse(d) for d in destinations.split(",")] if destinations else [DEFAULT_DESTINATION]
+        messages = format_digest(group)
+        logger.info("Отправка дайджеста: %d элементов, %d сообщений, получатели: %s",
+                    len(group), len(messages), ", ".join(str(d) for d in destinations))
+        for index, (message, included) in enumerate(messages):
+            album = digest_posters(included) if DIGEST_FORMAT == "media_group" else []
+            if len(album) >= 2:
+                # альбом — оформление; сам текст дайджеста уходит отдельным сообщением (с outbox при сбое)
+                yield (MEDIA_GROUP, album, destinations)
+                photo, tag = None, None
+            elif index == 0 and len(message) <= CAPTION_LIMIT:
+                photo, tag = digest_poster(included)
+            else:
+                photo, tag = None, None
+            responses = yield (PHOTO, photo, message, tag, destinations)
+            keys = [(row["kind"], row["name"], row["unique_key"]) for row in included]
+            if outbox is None and all(retryable(resp) for _destination, resp in responses):
+                # временная ошибка, а outbox выключен: элементы остаются в накопителе до следующего дайджеста
+                logger.warning("Digest message not delivered (%d items), kept for the next digest", len(included))
+                continue
+            # как и у отдельных уведомлений: по каждому чату с временной ошибкой — в outbox
+            outcome = settle_delivery(keys, responses, photo, message, tag)
+            metrics.OUTCOMES.inc(outcome, amount=len(keys))
+            if done is not None:
+                done(included)
+
+def send_digest(rows, done=None):
+    token = correlation_id.set(new_correlation_id())
+    try:
+        run_steps(digest_steps(rows, done))
+    finally:
+        correlation_id.reset(token)
+
+
+def _call_sync(call):
+    op, args = call[0], call[1:]
+    if op in (ITEM, SEASON):
+        return get_item_details(*args)
+    if op == TRAILER:
+        return get_youtube_trailer_url(*args)
+    if op == PHOTO:
+        return send_telegram_photos(*args)
+    if op == LIBRARIES:
+        return get_libraries()
+    if op == POSTER:
+        return prefetch_poster(*args)
+    if op == EPISODES:
+        return fetch_season_episodes(*args)
+    if op == MEDIA_GROUP:
+        return send_telegram_media_group(*args)
+    if op == ENRICH:
+        return _enrich_sync(*args)
+    raise ValueError(f"Unknown step: {op}")
+
+def _timed_call_sync(call):
+    with log_stage(logger, call[0]), metrics.STAGE_SECONDS.time(call[0]):
+        return _call_sync(call)
+
+def _enrich_sync(required, optional, deadline):
+    """Выполняет вызовы в enrich_pool параллельно (с контекстом запроса: correlation_id)."""
+    futures = [enrich_pool.submit(contextvars.copy_context().run, _timed_call_sync, call) for call in required + optional]
+    results = []
+    for index, future in enumerate(futures):
+        timeout = None
+        if index >= len(required) and deadline is not None:
+            timeout = max(0.0, deadline - time.monotonic())
+        try:
+            results.append(future.result(timeout=timeout))
+        except FutureTimeout:
+            # запрос продолжает выполняться и заполнит кеш постеров/трейлеров для следующих уведомлений
+            results.append(DeadlineExceeded(f"{optional[index - len(required)][0]} missed the deadline"))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def run_steps(steps):
+    """Синхронный драйвер шагов: выполняет запросы через HTTP-клиенты сервисов (requests)."""
+    result, error = None, None
+    while True:
+        try:
+            call = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result, error = None, None
+        try:
+            result = _timed_call_sync(call)
+        except Exception as e:
+            error = e
+
+# Итог обработки вебхука для счётчика jellysay_notifications_total
+OUTCOMES = {
+    "Movie notified": "notified",
+    "Episode notified": "notified",
+    "Generic video notified": "notified",
+    "Season notified": "notified",
+    "Season announced, episode skipped": "season_announced",
+    "No destination, skipped": "no_destination",
+    "Episode queued for coalescing": "queued",
+    "Already notified": "already_notified",
+    "Season added recently, skipped": "season_too_new",
+    "Episode too old, skipped": "episode_too_old",
+    "Delivery deferred": "deferred",
+    "Added to digest": "digest",
+}
+
+def record_outcome(result):
+    body, status = result
+    if status >= 500:
+        outcome = "delivery_failed" if result == DELIVERY_FAILED else "error"
+    else:
+        outcome = OUTCOMES.get(body.get("message"), "other")
+    metrics.OUTCOMES.inc(outcome)
+    return result
+
+def process_payload(payload):
+    """Обрабатывает вебхук синхронно. Возвращает (dict, status_code)."""
+    with log_stage(logger, "process"), metrics.STAGE_SECONDS.time("process"):
+        return record_outcome(run_steps(notification_steps(payload)))
+
+def send_coalesced_episodes(key, episodes):
+    run_steps(coalesced_steps(key, episodes))
+
+
+episode_coalescer = None  # init_process(): таймеры склейки у каждого процесса свои
+
+# Сверка с Jellyfin: раз в RECONCILE_INTERVAL секунд (0 — выключено) находит фильмы и эпизоды,
+# о которых не пришёл вебхук, и отправляет их по обычному пути обработки (с той же дедупликацией)
+try:
+    RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "0"))
+    RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "200"))
+    RECONCILE_OVERLAP = int(os.getenv("RECONCILE_OVERLAP", "60"))
+    # при первом запуске (курсора ещё нет) — за сколько часов назад проверить элементы
+    RECONCILE_INITIAL_LOOKBACK_HOURS = int(os.getenv("RECONCILE_INITIAL_LOOKBACK_HOURS", "24"))
+except ValueError:
+    RECONCILE_INTERVAL = 0
+    RECONCILE_PAGE_SIZE = 200
+    RECONCILE_OVERLAP = 60
+    RECONCILE_INITIAL_LOOKBACK_HOURS = 24
+reconciler = None  # init_process()
+
+def fetch_new_items(min_date, start_index, limit):
+    """Страница фильмов и эпизодов с DateLastSaved >= min_date, по возрастанию DateCreated, минимум полей."""
+    url = f"{JELLYFIN_BASE_URL}/emby/Items"
+    params = {
+        "api_key": JELLYFIN_API_KEY, "Recursive": "true", "IncludeItemTypes": "Movie,Episode",
+        "Fields": "DateCreated", "MinDateLastSaved": min_date, "SortBy": "DateCreated", "SortOrder": "Ascending",
+        "StartIndex": str(start_index), "Limit": str(limit),
+        "EnableImages": "false", "EnableUserData": "false", "EnableTotalRecordCount": "false",
+    }
+    resp = jellyfin_http.get(url, headers={"accept": "application/json"}, params=params)
+    resp.raise_for_status()
+    return resp.json().get("Items", [])
+
+def reconcile_payload(item):
+    """Payload в формате вебхука Jellyfin для элемента, найденного сверкой."""
+    payload = {"ItemId": item.get("Id"), "ItemType": item.get("Type"), "Name": item.get("Name"),
+               "Year": str(item.get("ProductionYear") or "")}
+    for key in ("SeriesName", "SeasonId", "ParentIndexNumber", "IndexNumber"):
+        if item.get(key) is not None:
+            payload[key] = item[key]
+    return payload
+
+def reconcile_item(item):
+    """Обрабатывает элемент из сверки. False — уведомление не доставлено (курсор не сдвигается дальше него)."""
+    token = correlation_id.set(new_correlation_id())
+    try:
+        _result, status = process_payload(reconcile_payload(item))
+    finally:
+        correlation_id.reset(token)
+    return status < 500
+
+
+def validate_payload(payload):
+    """Проверяет разобранный payload вебхука. Возвращает текст ошибки для ответа 400 или None."""
+    if not isinstance(payload, dict):
+        logger.warning("Invalid payload format, cannot parse to dict")
+        return "Invalid payload format"
+
+    # проверяем обязательные поля
+    if not payload.get("ItemType") or not payload.get("Name") or not payload.get("Year"):
+        logger.warning("Missing required fields: ItemType/Name/Year. Payload keys: %s", list(payload.keys()))
+        return "Missing required fields: ItemType/Name/Year"
+    return None
+
+
+# X-Request-Id попадает в каждую строку лога и в заголовок ответа: пробелы, CR/LF и прочие
+# символы позволили бы подделывать строки текстового лога
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+def request_correlation_id(headers):
+    """correlation_id вебхука: X-Request-Id от вызывающей стороны, если он допустим, иначе новый."""
+    request_id = headers.get("X-Request-Id") or ""
+    return request_id if REQUEST_ID_PATTERN.fullmatch(request_id) else new_correlation_id()
+
+def log_webhook_request(headers, content_type, raw_body):
+    # Заголовки — только на DEBUG, тело — по политике LOG_PAYLOADS (с выборкой и обрезкой);
+    # raw_body — bytes, декодируется только если запрос попал в выборку
+    logger.debug("Webhook headers: %s", dict(headers))
+    logger.debug("Webhook content-type: %s", content_type)
+    if payload_log_policy.should_log():
+        text = raw_body.decode("utf-8", "replace")
+        logger.info("Webhook raw body: %s", payload_log_policy.truncate(text),
+                    extra={"event": "payload", "body_chars": len(text)})
+
+
+webhooks = Blueprint("jellysay", __name__)
+
+
 # Основной webhook
-@app.route("/webhook", methods=["POST"])
+@webhooks.route("/webhook", methods=["POST"])
 def announce_new_releases_from_jellyfin():
+    token = correlation_id.set(request_correlation_id(request.headers))
     try:
-        # Логируем заголовки и сырое тело для диагностики
-        try:
-            raw_body = request.get_data(as_text=True)
-        except Exception:
-            raw_body = "<cannot read body>"
-        logger.info("Webhook headers: %s", dict(request.headers))
-        logger.info("Webhook content-type: %s", request.content_type)
-        logger.info("Webhook raw body (first 2000 chars): %s", raw_body[:2000])
-
-        # Попытки парсинга: 1) JSON автоматически, 2) form-data, 3) явный json.loads(raw)
-        payload = None
-        payload = request.get_json(force=False, silent=True)
-        if payload is None and request.form:
-            payload = request.form.to_dict()
-            logger.info("Parsed payload from form-data")
-        if payload is None and raw_body:
-            try:
-                payload = json.loads(raw_body)
-                logger.info("Parsed payload from raw JSON")
-            except Exception:
-                payload = None
-
-        if not isinstance(payload, dict):
-            logger.warning("Invalid payload format, cannot parse to dict")
-            return jsonify({"status": "error", "message": "Invalid payload format"}), 400
-
-        # проверяем обязательные поля
-        item_type = payload.get("ItemType")
-        item_name = payload.get("Name")
-        release_year = payload.get("Year")
-        if not item_type or not item_name or not release_year:
-            logger.warning("Missing required fields: ItemType/Name/Year. Payload keys: %s", list(payload.keys()))
-            return jsonify({"status": "error", "message": "Missing required fields: ItemType/Name/Year"}), 400
-
-        # ...далее оставьте вашу существующую логику обработки (Movie/Season/Episode)...
-        # для компактности — вызываем существующую логику через вспомогательную функцию process_payload
+        resp = make_response(profiler.run("webhook", _handle_webhook) if profiler.enabled else _handle_webhook())
+        resp.headers["X-Request-Id"] = correlation_id.get()
+        return resp
+    finally:
+        correlation_id.reset(token)
+
+def _handle_webhook():
+    try:
+        # Тело читается и разбирается один раз: form-data/urlencoded или JSON (в том числе без Content-Type)
+        raw_body = request.get_data()
+        log_webhook_request(request.headers, request.content_type, raw_body)
+        form = request.form.to_dict() if request.mimetype in FORM_CONTENT_TYPES else None
+        payload = parse_body(raw_body, form)
+
+        error = validate_payload(payload)
+        if error:
+            return jsonify({"status": "error", "message": error}), 400
+
+        if webhook_pool is not None:
+            if not webhook_pool.submit((correlation_id.get(), payload)):
+                logger.warning("Webhook queue is full, rejecting: %s", payload.get("Name"))
+                resp = jsonify({"status": "error", "message": "Queue is full"})
+                resp.headers["Retry-After"] = str(WEBHOOK_RETRY_AFTER)
+                return resp, 503
+            return jsonify({"status": "accepted"}), 202
+
         return process_payload(payload)
 
-            # Проверяем, что эпизод премьеровался недавно (если есть)
-            if premiere and not is_within_last_x_days(premiere, EPISODE_PREMIERED_WITHIN_X_DAYS):
-                logger.info("Эпизод премьеровался раньше порога, пропуск: %s", name)
-                return {"status": "ok", "message": "Episode too old, skipped"}, 200     
+    except Exception as e:
+        logger.exception("Ошибка обработки вебхука: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+def _process_queued_payload(task):
+    cid, payload = task
+    token = correlation_id.set(cid)
+    try:
+        result, status = profiler.run("queued", process_payload, payload) if profiler.enabled else process_payload(payload)
+    finally:
+        correlation_id.reset(token)
+    if status >= 500:
+        raise RuntimeError(result.get("message"))
+
+
+webhook_pool = None  # init_process()
+
+
+@webhooks.route("/stats", methods=["GET"])
+def stats():
+    data = {"mode": "async" if webhook_pool is not None else "sync"}
+    if webhook_pool is not None:
+        data["queue"] = webhook_pool.stats()
+    data["telegram"] = telegram_scheduler.stats()
+    data["routes"] = [str(destination) for destination in router.destinations()]
+    data["jellyfin_cache"] = jellyfin_items.stats()
+    data["trailers"] = dict(trailer_cache.stats(), quota=youtube_quota.stats())
+    data["upstreams"] = upstream_stats()
+    if poster_cache is not None:
+        data["poster_cache"] = poster_cache.stats()
+    if reconciler is not None:
+        data["reconcile"] = reconciler.stats()
+    if outbox_dispatcher is not None:
+        data["outbox"] = outbox_dispatcher.stats()
+    if digest_scheduler is not None:
+        data["digest"] = digest_scheduler.stats()
+    if profiler.enabled:
+        data["profiling"] = profiler.stats()
+    return jsonify(data)
+
+
+@webhooks.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.REGISTRY.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+
+def update_profiling(headers, settings):
+    """
+    POST /profile {"sample_rate": 0.1, "slow_ms": 500}: включает/меняет профилирование на лету
+    (в процессах gunicorn — только в процессе, принявшем запрос). Возвращает (dict, status_code).
+    """
+    if not PROFILE_ADMIN_TOKEN or headers.get("X-Admin-Token") != PROFILE_ADMIN_TOKEN:
+        return {"status": "error", "message": "Forbidden"}, 403
+    if not isinstance(settings, dict):
+        return {"status": "error", "message": "Expected a JSON object"}, 400
+    try:
+        profiler.configure(settings.get("sample_rate"), settings.get("slow_ms"))
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}, 400
+    logger.info("Profiling settings changed: %s", profiler.stats())
+    return profiler.stats(), 200
+
+
+@webhooks.route("/profile", methods=["GET", "POST"])
+def profile_endpoint():
+    if request.method == "GET":
+        return jsonify(profiler.stats())
+    result, status = update_profiling(request.headers, request.get_json(silent=True))
+    return jsonify(result), status
+
+
+# Асинхронный режим сервера (SERVER_MODE=async): тот же контракт /webhook на aiohttp,
+# клиенты Jellyfin, YouTube и Telegram асинхронные — с теми же настройками пулов и таймаутов
+# и общими с синхронными клиентами circuit breaker'ами.
+aio_jellyfin = None
+aio_telegram = None
+aio_youtube = None
+aio_telegram_scheduler = None
+async_webhook_pool = None
+
+async def fetch_items_async(item_ids):
+    url = f"{JELLYFIN_BASE_URL}/emby/Items"
+    params = {"api_key": JELLYFIN_API_KEY, "Recursive": "true", "Fields": ITEM_FIELDS, "Ids": ",".join(item_ids)}
+    resp = await aio_jellyfin.request("GET", url, headers={"accept": "application/json"}, params=params)
+    resp.raise_for_status()
+    return {item.get("Id"): item for item in resp.json().get("Items", [])}
+
+async def get_libraries_async():
+    libraries = libraries_cache.get("libraries")
+    if libraries is None:
+        resp = await aio_jellyfin.request("GET", f"{JELLYFIN_BASE_URL}/Library/VirtualFolders",
+                                          headers={"accept": "application/json"}, params={"api_key": JELLYFIN_API_KEY})
+        resp.raise_for_status()
+        libraries = library_locations(resp.json())
+        libraries_cache.set("libraries", libraries)
+    return libraries
+
+async def fetch_season_episodes_async(season_id):
+    url = f"{JELLYFIN_BASE_URL}/emby/Items"
+    resp = await aio_jellyfin.request("GET", url, headers={"accept": "application/json"}, params=season_episodes_params(season_id))
+    resp.raise_for_status()
+    episodes = resp.json().get("Items", [])
+    jellyfin_items.prime(episodes)
+    return episodes
+
+async def get_item_details_async(item_id):
+    try:
+        return {"Items": [await jellyfin_items.aget(item_id)], "TotalRecordCount": 1}
+    except (RequestException, ItemNotFound) as e:
+        logger.exception("Error fetching item details %s: %s", item_id, e)
+        raise
+
+async def get_youtube_trailer_url_async(title, year):
+    if not YOUTUBE_API_KEY:
+        return None
+    key = trailer_key(title, year)
+    done, trailer = await asyncio.to_thread(cached_trailer, key)
+    if done:
+        return trailer
+    try:
+        resp = await aio_youtube.request("GET", f"{YOUTUBE_API_URL}/search", params=trailer_search_params(title, year))
+        return await asyncio.to_thread(store_trailer_result, key, resp)
+    except (RequestException, ValueError) as e:
+        await asyncio.to_thread(store_trailer_error, key, e)
+        return None
+
+async def send_telegram_message_async(text, destination=None):
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+    destination = destination or DEFAULT_DESTINATION
+    try:
+        data = dict(destination.params(), text=text, parse_mode="Markdown")
+        resp = await telegram_send_async(lambda: aio_telegram.request("POST", url, data=data), destination)
+        resp.raise_for_status()
+        logger.info("Telegram message sent")
+        return resp
+    except RequestException as e:
+        logger.error("Telegram send message failed: %s", e)
+        return None
+
+async def telegram_send_async(send, destination):
+    with metrics.STAGE_SECONDS.time("telegram_send"):
+        return await aio_telegram_scheduler.send(destination.chat_id, send)
+
+async def _send_photo_reference_async(url, data, photo, destination):
+    return await telegram_send_async(lambda: aio_telegram.request("POST", url, data=dict(data, photo=photo)), destination)
+
+async def send_telegram_photo_async(photo_url_or_id, caption, image_tag=None, destination=None):
+    """Асинхронный аналог send_telegram_photo с тем же порядком: file_id, публичный URL, загрузка."""
+    destination = destination or DEFAULT_DESTINATION
+    if not photo_url_or_id:
+        return await send_telegram_message_async(caption, destination)
+
+    is_url = str(photo_url_or_id).startswith("http")
+    photo_url = photo_url_or_id if is_url else get_poster_url(photo_url_or_id)
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
+    data = dict(destination.params(), caption=caption, parse_mode="Markdown")
+
+    file_id = None if is_url else await asyncio.to_thread(poster_index.get, photo_url_or_id, image_tag)
+    if file_id:
+        try:
+            resp = await _send_photo_reference_async(url, data, file_id, destination)
+            if resp.ok:
+                logger.info("Telegram photo sent by file_id (status=%s)", resp.status_code)
+                return resp
+            logger.warning("Telegram rejected cached file_id: %s %s", resp.status_code, resp.text)
+            await asyncio.to_thread(poster_index.forget, photo_url_or_id)
+        except RequestException as e:
+            logger.warning("Telegram send photo by file_id failed: %s", e)
+
+    if JELLYFIN_PUBLIC_URL and not is_url:
+        try:
+            resp = await _send_photo_reference_async(url, data, get_public_poster_url(photo_url_or_id, image_tag), destination)
+            if resp.ok:
+                logger.info("Telegram photo sent by public URL (status=%s)", resp.status_code)
+                await asyncio.to_thread(poster_index.put, photo_url_or_id, image_tag, photo_file_id(resp))
+                return resp
+            logger.warning("Telegram could not fetch public poster URL: %s %s", resp.status_code, resp.text)
+        except RequestException as e:
+            logger.warning("Telegram send photo by public URL failed: %s", e)
+
+    def form_with(photo):
+        form = aio.aiohttp.FormData()
+        for key, value in data.items():
+            form.add_field(key, str(value))
+        form.add_field("photo", photo, filename="poster.jpg", content_type="image/jpeg")
+        return form
+
+    try:
+        if poster_cache is not None:
+            logger.debug("Fetching poster from %s", photo_url)
+            with metrics.STAGE_SECONDS.time("poster_download"):
+                poster_path = await aio.fetch_poster(poster_cache, photo_url_or_id, photo_url, aio_jellyfin)
+            if not poster_path:
+                logger.warning("Poster response is empty: %s", photo_url)
+                return await send_telegram_message_async(caption, destination)
+
+            async def upload():
+                with open(poster_path, "rb") as photo:
+                    return await aio_telegram.request("POST", url, data=form_with(photo))
+        else:
+            async def upload():
+                # без кеша: тело ответа Jellyfin сразу уходит в запрос к Telegram (chunked)
+                logger.debug("Streaming poster from %s", photo_url)
+                async with aio_jellyfin.stream("GET", photo_url) as img_resp:
+                    if img_resp.status >= 400:
+                        raise HTTPError(f"{img_resp.status} Error for url: {photo_url}")
+                    return await aio_telegram.request("POST", url, data=form_with(aio.iter_limited(img_resp, POSTER_MAX_BYTES)))
+
+        resp = await telegram_send_async(upload, destination)
+        try:
+            resp.raise_for_status()
+            logger.info("Telegram photo sent (status=%s)", resp.status_code)
+            if not is_url:
+                await asyncio.to_thread(poster_index.put, photo_url_or_id, image_tag, photo_file_id(resp))
+        except RequestException:
+            logger.error("Telegram send photo failed: %s %s", getattr(resp, "status_code", None), getattr(resp, "text", None))
+        return resp
+
+    except (RequestException, PosterTooLarge) + aio.CLIENT_ERRORS as e:
+        logger.warning("Ошибка сохранения постера: %s", e)
+        try:
+            return await send_telegram_message_async(caption, destination)
+        except Exception as ex:
+            logger.exception("Fallback send_telegram_message failed: %s", ex)
+            return None
+
+async def send_photo_by_file_id_async(file_id, photo_url_or_id, caption, image_tag, destination):
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendPhoto"
+    try:
+        resp = await _send_photo_reference_async(url, dict(destination.params(), caption=caption, parse_mode="Markdown"), file_id, destination)
+        if resp.ok:
+            return resp
+        logger.warning("Telegram rejected file_id for %s: %s %s", destination, resp.status_code, resp.text)
+    except RequestException as e:
+        logger.warning("Telegram send photo by file_id to %s failed: %s", destination, e)
+    return await send_telegram_photo_async(photo_url_or_id, caption, image_tag, destination)
+
+async def send_telegram_photos_async(photo_url_or_id, caption, image_tag, destinations):
+    """Асинхронный аналог send_telegram_photos: остальные получатели — параллельными задачами."""
+    first, rest = destinations[0], destinations[1:]
+    resp = await send_telegram_photo_async(photo_url_or_id, caption, image_tag, first)
+    responses = [(first, resp)]
+    if not rest:
+        return responses
+    file_id = photo_file_id(resp) if resp is not None and resp.ok and photo_url_or_id else None
+    if file_id:
+        sends = [send_photo_by_file_id_async(file_id, photo_url_or_id, caption, image_tag, d) for d in rest]
+    else:
+        sends = [send_telegram_photo_async(photo_url_or_id, caption, image_tag, d) for d in rest]
+    for destination, result in zip(rest, await asyncio.gather(*sends, return_exceptions=True)):
+        if isinstance(result, Exception):
+            logger.error("Telegram send to %s failed: %s", destination, result)
+            result = None
+        responses.append((destination, result))
+    return responses
+
+async def send_telegram_media_group_async(photos, destinations):
+    """Асинхронный аналог send_telegram_media_group."""
+    url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/sendMediaGroup"
+    responses = []
+    for destination in destinations:
+        resp = None
+        try:
+            plan = await asyncio.to_thread(media_group_plan, photos)
+            paths = {}
+            for image_id, _image_tag, reference in plan:
+                if reference is None and poster_cache is not None:
+                    with metrics.STAGE_SECONDS.time("poster_download"):
+                        paths[image_id] = await aio.fetch_poster(poster_cache, image_id, get_poster_url(image_id), aio_jellyfin)
+            data, files, sent = media_group_fields(destination, plan, paths)
+            if len(sent) >= 2:
+                async def upload():
+                    with ExitStack() as stack:
+                        form = aio.aiohttp.FormData()
+                        for key, value in data.items():
+                            form.add_field(key, str(value))
+                        for name, path in files.items():
+                            form.add_field(name, stack.enter_context(open(path, "rb")), filename="poster.jpg",
+                                           content_type="image/jpeg")
+                        return await aio_telegram.request("POST", url, data=form)
+                resp = await telegram_send_async(upload, destination)
+                resp.raise_for_status()
+                await asyncio.to_thread(remember_media_group, sent, resp)
+                logger.info("Telegram media group sent to %s: %d photos", destination, len(sent))
+        except (RequestException, PosterTooLarge) + aio.CLIENT_ERRORS as e:
+            logger.warning("Telegram send media group to %s failed: %s", destination, e)
+            resp = None
+        responses.append((destination, resp))
+    return responses
+
+async def prefetch_poster_async(item_id):
+    if poster_cache is None or JELLYFIN_PUBLIC_URL or await asyncio.to_thread(poster_index.known, item_id):
+        return None
+    with metrics.STAGE_SECONDS.time("poster_download"):
+        return await aio.fetch_poster(poster_cache, item_id, get_poster_url(item_id), aio_jellyfin)
+
+async def _call_async(call):
+    op, args = call[0], call[1:]
+    if op in (ITEM, SEASON):
+        return await get_item_details_async(*args)
+    if op == TRAILER:
+        return await get_youtube_trailer_url_async(*args)
+    if op == PHOTO:
+        return await send_telegram_photos_async(*args)
+    if op == LIBRARIES:
+        return await get_libraries_async()
+    if op == POSTER:
+        return await prefetch_poster_async(*args)
+    if op == EPISODES:
+        return await fetch_season_episodes_async(*args)
+    if op == MEDIA_GROUP:
+        return await send_telegram_media_group_async(*args)
+    if op == ENRICH:
+        return await _enrich_async(*args)
+    raise ValueError(f"Unknown step: {op}")
+
+async def _timed_call_async(call):
+    with log_stage(logger, call[0]), metrics.STAGE_SECONDS.time(call[0]):
+        return await _call_async(call)
+
+# незавершённые к сроку задачи доделываются в фоне; ссылки держим, чтобы их не собрал GC
+_background_tasks = set()
+
+def _forget_task(task):
+    _background_tasks.discard(task)
+    if not task.cancelled():
+        task.exception()
+
+async def _enrich_async(required, optional, deadline):
+    """Асинхронный аналог _enrich_sync: задачи asyncio вместо пула потоков."""
+    tasks = [asyncio.ensure_future(_timed_call_async(call)) for call in required + optional]
+    if required:
+        await asyncio.wait(tasks[:len(required)])
+    if optional:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        await asyncio.wait(tasks[len(required):], timeout=timeout)
+    results = []
+    for index, task in enumerate(tasks):
+        if not task.done():
+            _background_tasks.add(task)
+            task.add_done_callback(_forget_task)
+            results.append(DeadlineExceeded(f"{optional[index - len(required)][0]} missed the deadline"))
+        elif task.exception() is not None:
+            results.append(task.exception())
+        else:
+            results.append(task.result())
+    return results
+
+def _advance(steps, result, error):
+    """Один шаг генератора: (True, итог) после StopIteration или (False, следующий вызов)."""
+    try:
+        return False, steps.throw(error) if error is not None else steps.send(result)
+    except StopIteration as stop:
+        return True, stop.value
+
+async def run_steps_async(steps):
+    """Асинхронный драйвер шагов: выполняет запросы через асинхронные клиенты сервисов (aiohttp)."""
+    result, error = None, None
+    while True:
+        # шаги генератора ходят в SQLite (дедупликация, outbox, индекс постеров, дайджест) —
+        # продвигаем его в пуле потоков, в цикле событий остаются только сетевые вызовы
+        finished, call = await asyncio.to_thread(_advance, steps, result, error)
+        if finished:
+            return call
+        result, error = None, None
+        try:
+            result = await _timed_call_async(call)
+        except Exception as e:
+            error = e
+
+async def process_payload_async(payload):
+    """Обрабатывает вебхук в цикле событий. Возвращает (dict, status_code)."""
+    with log_stage(logger, "process"), metrics.STAGE_SECONDS.time("process"):
+        return record_outcome(await run_steps_async(notification_steps(payload)))
+
+async def _process_queued_payload_async(task):
+    cid, payload = task
+    token = correlation_id.set(cid)
+    try:
+        if profiler.enabled:
+            result, status = await profiler.run_async("queued", process_payload_async, payload)
+        else:
+            result, status = await process_payload_async(payload)
+    finally:
+        correlation_id.reset(token)
+    if status >= 500:
+        raise RuntimeError(result.get("message"))
+
+async def announce_new_releases_async(req):
+    # у каждого запроса aiohttp своя задача — correlation_id не пересекается между вебхуками
+    correlation_id.set(request_correlation_id(req.headers))
+    if profiler.enabled:
+        resp = await profiler.run_async("webhook", _handle_webhook_async, req)
+    else:
+        resp = await _handle_webhook_async(req)
+    resp.headers["X-Request-Id"] = correlation_id.get()
+    return resp
+
+async def _handle_webhook_async(req):
+    web = aio.web
+    try:
+        # тот же разбор, что и у Flask-обработчика: form-data/urlencoded или JSON
+        form = dict(await req.post()) if req.content_type in FORM_CONTENT_TYPES else None
+        raw_body = await req.read()
+        log_webhook_request(req.headers, req.content_type, raw_body)
+        payload = parse_body(raw_body, form)
+
+        error = validate_payload(payload)
+        if error:
+            return web.json_response({"status": "error", "message": error}, status=400)
+
+        if async_webhook_pool is not None:
+            if not async_webhook_pool.submit((correlation_id.get(), payload)):
+                logger.warning("Webhook queue is full, rejecting: %s", payload.get("Name"))
+                return web.json_response({"status": "error", "message": "Queue is full"}, status=503,
+                                         headers={"Retry-After": str(WEBHOOK_RETRY_AFTER)})
+            return web.json_response({"status": "accepted"}, status=202)
+
+        result, status = await process_payload_async(payload)
+        return web.json_response(result, status=status)
+
+    except Exception as e:
+        logger.exception("Ошибка обработки вебхука: %s", e)
+        return aio.web.json_response({"status": "error", "message": str(e)}, status=500)
+
+async def stats_async(req):
+    def collect():
+        # счётчики outbox и дайджеста читаются из SQLite — собираем их в пуле потоков
+        data = {"mode": "asyncio" + ("+queue" if async_webhook_pool is not None else "")}
+        if async_webhook_pool is not None:
+            data["queue"] = async_webhook_pool.stats()
+        data["telegram"] = aio_telegram_scheduler.stats()
+        data["routes"] = [str(destination) for destination in router.destinations()]
+        data["jellyfin_cache"] = jellyfin_items.stats()
+        data["trailers"] = dict(trailer_cache.stats(), quota=youtube_quota.stats())
+        data["upstreams"] = upstream_stats()
+        if poster_cache is not None:
+            data["poster_cache"] = poster_cache.stats()
+        if reconciler is not None:
+            data["reconcile"] = reconciler.stats()
+        if outbox_dispatcher is not None:
+            data["outbox"] = outbox_dispatcher.stats()
+        if digest_scheduler is not None:
+            data["digest"] = digest_scheduler.stats()
+        if profiler.enabled:
+            data["profiling"] = profiler.stats()
+        return data
+    return aio.web.json_response(await asyncio.to_thread(collect))
+
+async def metrics_async(req):
+    return aio.web.Response(body=metrics.REGISTRY.render().encode("utf-8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+async def profile_async(req):
+    if req.method != "POST":
+        return aio.web.json_response(profiler.stats())
+    result, status = update_profiling(req.headers, parse_body(await req.read()))
+    return aio.web.json_response(result, status=status)
+
+def create_async_upstream_client(client):
+    """Асинхронный клиент сервиса с настройками и circuit breaker синхронного client."""
+    settings = upstream_settings(client.name)
+    return aio.AsyncUpstreamClient(client.name, settings["pool_size"], client.timeout, settings["retries"], client.breaker)
+
+async def _start_async_clients(web_app):
+    global aio_jellyfin, aio_telegram, aio_youtube, aio_telegram_scheduler, async_webhook_pool
+    init_process()
+    aio_jellyfin = create_async_upstream_client(jellyfin_http)
+    aio_telegram = create_async_upstream_client(telegram_http)
+    aio_youtube = create_async_upstream_client(youtube_http)
+    # лимиты общие с telegram_scheduler: им пользуются outbox, сверка и отправка склейки при выходе
+    aio_telegram_scheduler = aio.AsyncTelegramScheduler(global_rate=TELEGRAM_GLOBAL_RATE, chat_rate_per_minute=TELEGRAM_CHAT_RATE,
+                                                        limits=telegram_scheduler)
+    jellyfin_items.enable_async(fetch_items_async)
+    if WEBHOOK_ASYNC:
+        async_webhook_pool = AsyncWorkerPool(_process_queued_payload_async, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE)
+        async_webhook_pool.start()
+    if episode_coalescer is not None:
+        # таймер склейки срабатывает в отдельном потоке — отправку выполняем в цикле событий
+        loop = asyncio.get_running_loop()
+        episode_coalescer.flush = lambda key, episodes: asyncio.run_coroutine_threadsafe(
+            run_steps_async(coalesced_steps(key, episodes)), loop).result()
+    if digest_scheduler is not None:
+        loop = asyncio.get_running_loop()
+        digest_scheduler.flush = lambda rows, done: asyncio.run_coroutine_threadsafe(
+            run_steps_async(digest_steps(rows, done)), loop).result()
+
+async def _close_async_clients(web_app):
+    if episode_coalescer is not None:
+        episode_coalescer.flush = send_coalesced_episodes
+    if digest_scheduler is not None:
+        digest_scheduler.flush = send_digest
+    for client in (aio_jellyfin, aio_telegram, aio_youtube):
+        await client.close()
+
+def create_async_app():
+    """aiohttp-приложение с тем же контрактом /webhook, /stats, /metrics и /profile, что и Flask-приложение."""
+    aio.require_aiohttp()
+    configure()
+    web_app = aio.web.Application()
+    web_app.router.add_post("/webhook", announce_new_releases_async)
+    web_app.router.add_get("/stats", stats_async)
+    web_app.router.add_get("/metrics", metrics_async)
+    web_app.router.add_get("/profile", profile_async)
+    web_app.router.add_post("/profile", profile_async)
+    web_app.on_startup.append(_start_async_clients)
+    web_app.on_cleanup.append(_close_async_clients)
+    return web_app
+
+
+# Жизненный цикл: configure() — один раз на процесс (можно до fork), init_process() — в каждом воркере
+_configured = False
+_configure_lock = threading.Lock()
+_process_pid = None
+_process_lock = threading.Lock()
+
+def configure():
+    """
+    Проверяет окружение и готовит общее состояние на диске: директории, лог, хранилища SQLite,
+    кеш постеров. Безопасно до fork: соединения SQLite открываются в каждом процессе заново
+    (app.database.get_connection), поток записи лога перезапускается в дочернем процессе.
+    """
+    global _configured, dedup_store, poster_index, poster_cache, trailer_cache, youtube_quota, outbox, digest_store, router
+    global DEFAULT_DESTINATION
+    with _configure_lock:
+        if _configured:
+            return
+        LOG_DIRECTORY.mkdir(parents=True, exist_ok=True)
+        DATA_DIRECTORY.mkdir(parents=True, exist_ok=True)
+        rotating_handler = TimedRotatingFileHandler(str(log_filename), when="midnight", interval=1, backupCount=7, encoding="utf-8")
+        setup_async_logging(logger, [rotating_handler], LOG_FORMAT)
+        for name in REQUIRED_ENV:
+            require_env(name)
+        try:
+            router = Router(parse_routes(TELEGRAM_ROUTES), default=DEFAULT_DESTINATION)
+        except ValueError as e:
+            logger.error("%s", e)
+            raise SystemExit(1)
+        if not router.destinations():
+            logger.error("TELEGRAM_ROUTES has no destinations and TELEGRAM_CHAT_ID is not set")
+            raise SystemExit(1)
+        # без TELEGRAM_CHAT_ID чат по умолчанию (outbox, дайджест без получателей) — первый из правил
+        DEFAULT_DESTINATION = DEFAULT_DESTINATION or (router.fallback + router.destinations())[0]
+
+        metrics.register_upstream("telegram", TELEGRAM_API_URL)
+        metrics.register_upstream("youtube", YOUTUBE_API_URL)
+        metrics.register_upstream("jellyfin", JELLYFIN_BASE_URL)
+        metrics.register_upstream("jellyfin", JELLYFIN_PUBLIC_URL)
+
+        dedup_store = create_dedup_store(DEDUP_BACKEND, DATABASE_FILE, DEDUP_TTL_DAYS * 86400, DEDUP_CLAIM_TIMEOUT)
+        migrate_json_file(dedup_store, NOTIFIED_ITEMS_FILE)
+        poster_index = PosterIndex(DATABASE_FILE)
+        poster_cache = poster_cache_from_env(DATA_DIRECTORY / "posters")
+        trailer_cache = TrailerCache(DATABASE_FILE)
+        youtube_quota = YouTubeQuota(DATABASE_FILE, daily_budget=YOUTUBE_DAILY_QUOTA, reserve=YOUTUBE_QUOTA_RESERVE)
+        outbox = Outbox(DATABASE_FILE, max_attempts=OUTBOX_MAX_ATTEMPTS, retry_delay=OUTBOX_RETRY_DELAY,
+                        max_delay=OUTBOX_MAX_DELAY) if OUTBOX_ENABLED else None
+        digest_store = DigestStore(DATABASE_FILE) if DIGEST_INTERVAL > 0 else None
+        _configured = True
+
+def init_process():
+    """
+    Состояние процесса-обработчика: HTTP-клиенты сервисов, очередь Telegram, кеш Jellyfin, склейка эпизодов,
+    пул вебхуков, разбор outbox, сверка с Jellyfin. Создаётся лениво при первом запросе в каждом процессе (после fork — заново),
+    повторный вызов в том же процессе ничего не делает.
+    """
+    global _process_pid, jellyfin_http, telegram_http, youtube_http, telegram_scheduler, jellyfin_items, episode_coalescer, webhook_pool, reconciler
+    global enrich_pool, fanout_pool, outbox_dispatcher, digest_scheduler, announced_seasons, libraries_cache
+    pid = os.getpid()
+    if _process_pid == pid:
+        return
+    with _process_lock:
+        if _process_pid == pid:
+            return
+        configure()
+        # пробы восстановления: лёгкие запросы без авторизации/квоты; YouTube проверяется пробным поиском
+        jellyfin_http = create_upstream_client("jellyfin", f"{JELLYFIN_BASE_URL}/System/Ping")
+        telegram_http = create_upstream_client("telegram", f"{TELEGRAM_API_URL}/bot{TELEGRAM_BOT_TOKEN}/getMe")
+        youtube_http = create_upstream_client("youtube")
+        telegram_scheduler = TelegramScheduler(global_rate=TELEGRAM_GLOBAL_RATE, chat_rate_per_minute=TELEGRAM_CHAT_RATE)
+        enrich_pool = ThreadPoolExecutor(max_workers=max(1, ENRICH_WORKERS), thread_name_prefix="enrich")
+        fanout_pool = ThreadPoolExecutor(max_workers=max(1, FANOUT_WORKERS), thread_name_prefix="fanout")
+        jellyfin_items = JellyfinItems(fetch_items, ttl=JELLYFIN_CACHE_TTL, maxsize=JELLYFIN_CACHE_SIZE, window=JELLYFIN_BATCH_WINDOW_MS / 1000.0)
+        # индекс объявленных сезонов — в памяти процесса; после перезапуска эпизоды проверяются по дате создания сезона
+        announced_seasons = TTLCache(maxsize=JELLYFIN_CACHE_SIZE, ttl=max(SEASON_ADDED_WITHIN_X_DAYS, 1) * 86400)
+        libraries_cache = TTLCache(maxsize=1, ttl=JELLYFIN_CACHE_TTL)
+        episode_coalescer = Coalescer(EPISODE_COALESCE_WINDOW, send_coalesced_episodes) if EPISODE_COALESCE_WINDOW > 0 else None
+        if episode_coalescer is not None:
+            atexit.register(episode_coalescer.flush_all)
+            if DEDUP_CLAIM_TIMEOUT <= EPISODE_COALESCE_WINDOW:
+                # заявка эпизода держится всё окно склейки: иначе её перехватит повторный вебхук
+                logger.warning("DEDUP_CLAIM_TIMEOUT (%ss) should exceed EPISODE_COALESCE_WINDOW (%ss): "
+                               "pending episodes may be announced twice", DEDUP_CLAIM_TIMEOUT, EPISODE_COALESCE_WINDOW)
+        webhook_pool = WorkerPool(_process_queued_payload, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE) if WEBHOOK_ASYNC else None
+        if outbox is not None:
+            # строки забираются атомарно, поэтому разбирать outbox могут все процессы сразу
+            outbox_dispatcher = OutboxDispatcher(outbox, deliver_deferred, ready=telegram_http.breaker.available,
+                                                 on_dead=dead_lettered, interval=OUTBOX_POLL_INTERVAL, batch_size=OUTBOX_BATCH_SIZE)
+            outbox_dispatcher.start()
+        if digest_store is not None:
+            # элементы забираются атомарно — дайджест отправит тот процесс, который первым его заберёт
+            digest_scheduler = DigestScheduler(digest_store, send_digest, interval=DIGEST_INTERVAL,
+                                               ready=telegram_http.breaker.available, poll_interval=DIGEST_POLL_INTERVAL)
+            digest_scheduler.start()
+        if RECONCILE_INTERVAL > 0:
+            # поток есть в каждом процессе, опрашивает Jellyfin только владелец аренды в SQLite
+            reconciler = Reconciler(DATABASE_FILE, fetch_new_items, reconcile_item, interval=RECONCILE_INTERVAL,
+                                    page_size=RECONCILE_PAGE_SIZE, overlap=RECONCILE_OVERLAP,
+                                    initial_lookback=RECONCILE_INITIAL_LOOKBACK_HOURS * 3600)
+            reconciler.start()
+        _process_pid = pid
+
+def create_app():
+    """Flask-приложение (WSGI). Для внешнего gunicorn: gunicorn "jellysay:create_app()" (или прежнее "jellysay:app")."""
+    configure()
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(webhooks)
+    flask_app.before_request(init_process)
+    return flask_app
+
+_app_lock = threading.Lock()
+
+def __getattr__(name):
+    """
+    Прежняя точка входа gunicorn "jellysay:app": приложение создаётся при первом обращении
+    (а не при импорте) и дальше остаётся атрибутом модуля.
+    """
+    if name != "app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _app_lock:
+        if "app" not in globals():
+            globals()["app"] = create_app()
+    return globals()["app"]
+
+
+# Режим сервера: threaded (один процесс, потоки werkzeug), gunicorn (процессы gunicorn gthread),
+# async (aiohttp; при WEB_WORKERS > 1 — несколько процессов под gunicorn)
+SERVER_MODE = os.getenv("SERVER_MODE", "threaded").lower()
+HOST = os.getenv("HOST", "0.0.0.0")
+try:
+    PORT = int(os.getenv("PORT", "5000"))
+    # по умолчанию один процесс: лимиты Telegram, склейка эпизодов, индекс сезонов, /stats и /metrics —
+    # состояние процесса, при N процессах лимиты отправки фактически умножаются на N, а ротация
+    # общего лог-файла (TimedRotatingFileHandler) выполняется каждым процессом независимо
+    WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+    WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))
+    WEB_TIMEOUT = int(os.getenv("WEB_TIMEOUT", "120"))
+except ValueError:
+    PORT = 5000
+    WEB_WORKERS = 1
+    WEB_THREADS = 8
+    WEB_TIMEOUT = 120
+
+def _post_fork(server, worker):
+    init_process()
+
+def main():
+    mode = "threaded" if SERVER_MODE == "flask" else SERVER_MODE
+    if mode == "threaded":
+        flask_app = create_app()
+        # сразу, а не при первом запросе: сверка с Jellyfin должна работать и без входящих вебхуков
+        init_process()
+        flask_app.run(host=HOST, port=PORT, threaded=True)
+        return
+    if mode == "async" and WEB_WORKERS <= 1:
+        aio.web.run_app(create_async_app(), host=HOST, port=PORT)
+        return
+    if mode not in ("gunicorn", "async"):
+        raise SystemExit(f"Unknown SERVER_MODE: {SERVER_MODE} (threaded, gunicorn or async)")
+
+    workers = max(WEB_WORKERS, 1)
+    application = create_app() if mode == "gunicorn" else create_async_app()
+    if workers > 1:
+        logger.warning("WEB_WORKERS=%d: Telegram rate limits, /stats and /metrics are per process, "
+                       "the effective send rate is up to %d times TELEGRAM_GLOBAL_RATE", workers, workers)
+    if workers > 1 and DEDUP_BACKEND == "memory":
+        logger.warning("DEDUP_BACKEND=memory with %d workers: duplicates are detected per process only", workers)
+    if workers > 1 and EPISODE_COALESCE_WINDOW > 0:
+        logger.warning("EPISODE_COALESCE_WINDOW with %d workers: episodes are coalesced per process only", workers)
+    # preload: приложение создаётся один раз до fork, воркеры стартуют быстро;
+    # состояние процесса (сессии, очереди, кеши) создаёт init_process() в каждом воркере
+    run_gunicorn(
+        application,
+        bind=f"{HOST}:{PORT}",
+        workers=workers,
+        worker_class="gthread" if mode == "gunicorn" else "aiohttp.GunicornWebWorker",
+        threads=WEB_THREADS if mode == "gunicorn" else None,
+        timeout=WEB_TIMEOUT,
+        preload_app=True,
+        post_fork=_post_fork if mode == "gunicorn" else None,
+    )
+
 
 if __name__ == "__main__":
-    # Для продакшена используйте gunicorn; этот запуск — для локальной отладки
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
\ No newline at end of file
+    main()
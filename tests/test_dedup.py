@@ -0,0 +1,116 @@
+"""
+Заявки дедупликации (app/dedup.py): inflight -> sent | failed, перехват зависшей заявки
+и перенос старого notified_items.json. Оба хранилища проверяются одними тестами;
+SQLite — на временном файле, время подменяется часами теста.
+"""
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from app import dedup
+from app.dedup import MemoryDedupStore, SQLiteDedupStore, migrate_json_file
+
+TTL = 3600
+CLAIM_TIMEOUT = 600
+
+
+class Clock:
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(dedup, "time", SimpleNamespace(time=clock.time))
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryDedupStore(TTL, CLAIM_TIMEOUT)
+    return SQLiteDedupStore(tmp_path / "dedup.db", TTL, CLAIM_TIMEOUT)
+
+
+def test_concurrent_claims_have_one_winner(store):
+    start = threading.Barrier(8)
+    results = []
+
+    def worker():
+        # у каждого потока своё соединение SQLite (app.database.get_connection)
+        start.wait()
+        results.append(store.claim("movie:film:2024"))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 7 + [True]
+
+
+def test_sent_key_is_not_claimed_again_until_ttl(store, clock):
+    assert store.claim("key")
+    store.mark_sent("key")
+    assert store.contains("key")
+    assert not store.claim("key")
+    clock.now += TTL + 1
+    assert not store.contains("key")
+    assert store.claim("key")
+
+
+def test_failed_claim_can_be_claimed_again(store, clock):
+    assert store.claim("key")
+    store.mark_failed("key")
+    assert not store.contains("key")
+    assert store.claim("key")
+    assert not store.claim("key")
+
+
+def test_released_claim_can_be_claimed_again(store, clock):
+    assert store.claim("key")
+    store.release("key")
+    assert store.claim("key")
+
+
+def test_stale_inflight_claim_is_taken_over(store, clock):
+    assert store.claim("key")
+    # владелец заявки «упал» и не вызвал mark_sent/mark_failed/release
+    clock.now += CLAIM_TIMEOUT - 1
+    assert not store.claim("key")
+    clock.now += 2
+    assert store.claim("key")
+    assert not store.claim("key")
+
+
+def test_release_keeps_sent_key(store, clock):
+    assert store.claim("key")
+    store.mark_sent("key")
+    store.release("key")
+    assert store.contains("key")
+
+
+def test_migrate_json_file_renames_old_file(store, tmp_path):
+    json_path = tmp_path / "notified_items.json"
+    json_path.write_text(json.dumps(["movie:a:2020", "episode:b:2021"]), encoding="utf-8")
+    assert migrate_json_file(store, json_path) == 2
+    assert not json_path.exists()
+    assert (tmp_path / "notified_items.json.migrated").exists()
+    assert store.contains("movie:a:2020")
+    assert store.contains("episode:b:2021")
+    assert not store.claim("movie:a:2020")
+    # повторный запуск ничего не переносит
+    assert migrate_json_file(store, json_path) == 0
+
+
+def test_unreadable_json_file_is_left_in_place(store, tmp_path):
+    json_path = tmp_path / "notified_items.json"
+    json_path.write_text("{not json", encoding="utf-8")
+    assert migrate_json_file(store, json_path) == 0
+    assert json_path.exists()
@@ -0,0 +1,131 @@
+"""
+Состояния строк Outbox (app/database.py): атомарный claim, аренда, повторы, DEAD и release.
+Каждый тест работает со своим временным файлом SQLite; время подменяется часами теста.
+"""
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from app import database
+from app.database import DEAD, Outbox, get_connection
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(database, "time", SimpleNamespace(time=clock.time))
+    # без разброса задержек: retry_delay * 2^(attempts-1) ровно
+    monkeypatch.setattr(database.random, "uniform", lambda a, b: b)
+    return clock
+
+
+def make_outbox(tmp_path, **kwargs):
+    kwargs.setdefault("retry_delay", 10)
+    kwargs.setdefault("lease", 60)
+    return Outbox(tmp_path / "outbox.db", **kwargs)
+
+
+def add_rows(outbox, count):
+    return [outbox.add(f"item-{n}", "Movie", f"Movie {n}", f"caption {n}") for n in range(count)]
+
+
+def state(outbox, row_id):
+    return get_connection(outbox.path).execute(
+        "SELECT sent, attempts, claim FROM webhooks WHERE id = ?", (row_id,)).fetchone()
+
+
+def test_added_row_waits_for_first_retry(tmp_path, clock):
+    outbox = make_outbox(tmp_path)
+    add_rows(outbox, 1)
+    assert outbox.claim() == []
+    clock.now += 10
+    [row] = outbox.claim()
+    assert (row["item_id"], row["caption"], row["attempts"]) == ("item-0", "caption 0", 1)
+
+
+def test_claim_is_atomic_across_connections(tmp_path, clock):
+    outbox = make_outbox(tmp_path)
+    ids = add_rows(outbox, 40)
+    clock.now += 10
+    start = threading.Barrier(4)
+    claimed = []
+
+    def worker():
+        # у каждого потока своё соединение get_connection
+        start.wait()
+        claimed.append([row["id"] for row in Outbox(outbox.path, retry_delay=10, lease=60).claim(limit=15)])
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    flat = [row_id for batch in claimed for row_id in batch]
+    assert sorted(flat) == ids
+    assert len(flat) == len(set(flat))
+
+
+def test_claimed_rows_return_after_lease(tmp_path, clock):
+    outbox = make_outbox(tmp_path, lease=60)
+    [row_id] = add_rows(outbox, 1)
+    clock.now += 10
+    assert [row["id"] for row in outbox.claim()] == [row_id]
+    # процесс «упал», не вызвав complete/retry: до конца аренды строку никто не заберёт
+    clock.now += 59
+    assert outbox.claim() == []
+    clock.now += 1
+    [row] = outbox.claim()
+    assert row["id"] == row_id
+    assert row["attempts"] == 1
+
+
+def test_retry_backs_off_and_goes_dead_at_max_attempts(tmp_path, clock):
+    outbox = make_outbox(tmp_path, max_attempts=3)
+    [row_id] = add_rows(outbox, 1)
+    clock.now += 10
+    [row] = outbox.claim()
+    assert outbox.retry([(row, "boom")]) == []
+    assert state(outbox, row_id) == (database.PENDING, 2, None)
+
+    clock.now += 19
+    assert outbox.claim() == []
+    clock.now += 1
+    [row] = outbox.claim()
+    dead = outbox.retry([(row, "boom again")])
+    assert [r["id"] for r in dead] == [row_id]
+    assert state(outbox, row_id) == (DEAD, 3, None)
+
+    clock.now += 10000
+    assert outbox.claim() == []
+    assert outbox.stats() == {"pending": 0, "dead": 1}
+
+
+def test_release_does_not_spend_an_attempt(tmp_path, clock):
+    outbox = make_outbox(tmp_path)
+    [row_id] = add_rows(outbox, 1)
+    clock.now += 10
+    rows = outbox.claim()
+    outbox.release(rows)
+    assert state(outbox, row_id) == (database.PENDING, 1, None)
+    [row] = outbox.claim()
+    assert row["attempts"] == 1
+
+
+def test_complete_deletes_delivered_rows(tmp_path, clock):
+    outbox = make_outbox(tmp_path)
+    ids = add_rows(outbox, 3)
+    clock.now += 10
+    rows = outbox.claim(limit=2)
+    outbox.complete([row["id"] for row in rows])
+    assert state(outbox, ids[0]) is None
+    assert state(outbox, ids[1]) is None
+    assert outbox.stats() == {"pending": 1, "dead": 0}
@@ -0,0 +1,86 @@
+"""
+Паритет режимов сервера: одни и те же вебхуки, отправленные в jellysay.py с SERVER_MODE=threaded
+и SERVER_MODE=async, должны давать одинаковые ответы и одинаковые запросы к Jellyfin, Telegram
+и YouTube. Каждый режим запускается отдельным процессом с чистой DATA_DIRECTORY и своими
+заглушками (bench/stubs.py).
+
+Запуск: python -m pytest -q tests
+"""
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+import pytest
+import requests
+
+from bench.run import free_port, start_target, wait_for_deliveries, wait_for_port
+from bench.scenarios import episode_payload, movie_payload
+from bench.stubs import start_stubs, stub_env
+
+pytest.importorskip("flask")
+pytest.importorskip("aiohttp")
+
+CASES = [
+    ("new movie", movie_payload(1)),
+    ("duplicate movie", movie_payload(1)),
+    ("new episode", episode_payload(1, 1, 1)),
+    ("next episode", episode_payload(1, 1, 2)),
+    ("unknown item", dict(movie_payload(2), ItemId="missing-2")),
+    ("invalid payload", {"Name": "No type"}),
+]
+
+
+def run_mode(mode):
+    """Прогоняет CASES через сервер в режиме mode: ([(status, ответ)], запросы к заглушкам)."""
+    stubs = start_stubs()
+    # лимиты Telegram сняты, чтобы тест не ждал интервалов между сообщениями в один чат
+    env = {"SERVER_MODE": mode, "TELEGRAM_GLOBAL_RATE": "100000", "TELEGRAM_CHAT_RATE": "6000000",
+           "NOTIFICATION_PAUSE": "0"}
+    env.update(stub_env(stubs))
+    workdir = Path(tempfile.mkdtemp(prefix=f"jellysay-parity-{mode}-"))
+    port = free_port()
+    process, log = start_target("jellysay", port, env, workdir)
+    try:
+        wait_for_port(port, process)
+        responses = []
+        for _name, payload in CASES:
+            resp = requests.post(f"http://127.0.0.1:{port}/webhook", json=payload, timeout=30)
+            responses.append((resp.status_code, resp.json()))
+        wait_for_deliveries(stubs["telegram"], quiet_period=1.0, timeout=30)
+        upstream = {name: stub.stats() for name, stub in stubs.items()}
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        for stub in stubs.values():
+            stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return responses, upstream
+
+
+@pytest.fixture(scope="module")
+def results():
+    return {mode: run_mode(mode) for mode in ("threaded", "async")}
+
+
+@pytest.mark.parametrize("index", range(len(CASES)), ids=[name for name, _payload in CASES])
+def test_same_response(results, index):
+    assert results["threaded"][0][index] == results["async"][0][index]
+
+
+def test_same_upstream_calls(results):
+    assert results["threaded"][1] == results["async"][1]
+
+
+def test_cases_are_delivered(results):
+    responses, upstream = results["threaded"]
+    assert [body["message"] for _status, body in responses] == [
+        "Movie notified", "Already notified", "Episode notified", "Episode notified", "Movie notified",
+        "Missing required fields: ItemType/Name/Year",
+    ]
+    # неизвестный Jellyfin элемент объявляется по данным вебхука; повтор и неверный payload не отправляются
+    assert upstream["telegram"] == {"sendPhoto": {"200": 4}}